@@ -8,30 +8,38 @@ const path = require("path");
 const subscriptionKey = process.env.AZURE_SPEECH_SUBSCRIPTION_KEY;
 const serviceRegion = process.env.AZURE_SPEECH_SERVICE_REGION; 
 
+// Usage: node azure-speech.js <text> [outputFile] [voice] [rate]
+const text = process.argv[2] || "Hello from Azure TTS!";
+
 // Create a speech configuration using your subscription key and service region
 const speechConfig = sdk.SpeechConfig.fromSubscription(subscriptionKey, serviceRegion);
 // (Optional) Set a voice name, e.g., "en-US-AriaNeural, en-US-AvaMultilingualNeural, en-US-GuyNeural, en-US-ChristopherNeural"
-speechConfig.speechSynthesisVoiceName = "en-US-ChristopherNeural";
+speechConfig.speechSynthesisVoiceName = process.argv[4] || "en-US-ChristopherNeural";
 
 // Check and create the output directory before using it
-const outputDir = path.join(__dirname, "../output");
+const outputFile = process.argv[3] || path.join(__dirname, "../output", "speech.wav");
+const outputDir = path.dirname(outputFile);
 if (!fs.existsSync(outputDir)) {
     fs.mkdirSync(outputDir, { recursive: true });
 }
-const outputFile = path.join(outputDir, "speech.wav");
 
 // Create an audio configuration using the output file
 const audioConfig = sdk.AudioConfig.fromAudioFileOutput(outputFile);
 const synthesizer = new sdk.SpeechSynthesizer(speechConfig, audioConfig);
 
-const text = process.argv[2] || "Hello from Azure TTS!";
-const rate = "2"; // You can adjust this value ("1.0" is normal speed, below 1.0 is slower, above 1.0 is faster)
+const rate = process.argv[5] || "2"; // You can adjust this value ("1.0" is normal speed, below 1.0 is slower, above 1.0 is faster)
+
+// Escape characters that would otherwise break the SSML document
+const escapeXml = (value) => value
+  .replace(/&/g, "&amp;")
+  .replace(/</g, "&lt;")
+  .replace(/>/g, "&gt;");
 
 // Wrap your text in SSML with the prosody tag
 const ssml = `<speak version="1.0" xml:lang="en-US">
   <voice name="${speechConfig.speechSynthesisVoiceName}">
     <prosody rate="${rate}">
-      ${text}
+      ${escapeXml(text)}
     </prosody>
   </voice>
 </speak>`;
@@ -39,11 +47,17 @@ const ssml = `<speak version="1.0" xml:lang="en-US">
 synthesizer.speakSsmlAsync(
   ssml,
   (result) => {
-    console.log("Speech synthesized to 'output.wav' with rate", rate + ":", text);
     synthesizer.close();
+    if (result.reason !== sdk.ResultReason.SynthesizingAudioCompleted) {
+      console.error("Speech synthesis failed:", result.errorDetails);
+      process.exitCode = 1;
+      return;
+    }
+    console.log("Speech synthesized to", outputFile, "with rate", rate + ":", text);
   },
   (err) => {
     console.error(err);
     synthesizer.close();
+    process.exitCode = 1;
   }
 );
\ No newline at end of file
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import requests
+
+########################################
+# Serving benchmark for the review frontend
+#
+# Measures, against one or more running servers:
+#   - page load: GET / + first page of /api/records + first full record
+#   - autosave:  POST /update_record patches (flag toggled and restored)
+#
+# With --compare, starts the debug server and the production server on
+# separate ports from the repository root and benchmarks both:
+#   python3 frontend/bench_serving.py --compare
+# Each server gets a temporary copy of the records (OUTPUT_DIR), so the
+# autosave patches never reach output/. Against a server given with --url
+# the autosave benchmark writes to that server's records, and only runs
+# with --write.
+########################################
+script_dir = os.path.dirname(os.path.abspath(__file__))
+repo_root = os.path.join(script_dir, "..")
+OUTPUT_FILES = ["5html_converted_content.json", "6email_feedback.json"]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def summarize(name, timings):
+    ms = [t * 1000 for t in timings]
+    return (f"{name:<10} n={len(ms):<4} mean={statistics.mean(ms):7.1f}ms "
+            f"p50={percentile(ms, 50):7.1f}ms p95={percentile(ms, 95):7.1f}ms")
+
+
+def bench_page_load(session, base_url, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        session.get(f"{base_url}/").raise_for_status()
+        page = session.get(f"{base_url}/api/records", params={"offset": 0, "limit": 500}).json()
+        if page["records"]:
+            email = page["records"][0]["Email"]
+            session.get(f"{base_url}/api/records/{requests.utils.quote(email)}").raise_for_status()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_autosave(session, base_url, iterations):
+    page = session.get(f"{base_url}/api/records", params={"offset": 0, "limit": 1}).json()
+    if not page["records"]:
+        return []
+    email = page["records"][0]["Email"]
+    original_flag = bool(page["records"][0].get("flag"))
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        response = session.post(f"{base_url}/update_record",
+                                json={"email": email, "fields": {"flag": (i % 2 == 0) != original_flag}})
+        response.raise_for_status()
+        timings.append(time.perf_counter() - start)
+    session.post(f"{base_url}/update_record", json={"email": email, "fields": {"flag": original_flag}})
+    return timings
+
+
+def run_benchmarks(base_url, iterations, autosave=True):
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = "gzip, br"
+    print(f"== {base_url}")
+    print(summarize("page load", bench_page_load(session, base_url, iterations)))
+    if autosave:
+        print(summarize("autosave", bench_autosave(session, base_url, iterations)))
+
+
+def wait_until_healthy(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/healthz", timeout=1).ok:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def copy_output(destination):
+    """
+    Copy the records the frontend serves (and any unflushed journals) into destination.
+    """
+    for name in OUTPUT_FILES:
+        for path in (name, name + ".journal"):
+            source = os.path.join(repo_root, "output", path)
+            if os.path.exists(source):
+                shutil.copy2(source, os.path.join(destination, path))
+
+
+def start_server(port, production, output_dir):
+    command = [sys.executable, os.path.join(script_dir, "main.py"), "--port", str(port)]
+    if production:
+        command.append("--production")
+    env = dict(os.environ, OUTPUT_DIR=output_dir, EMAILPIPE_EVENTS_FILE=os.path.join(output_dir, "events.jsonl"))
+    return subprocess.Popen(command, cwd=repo_root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark page-load and autosave latency of the review frontend.")
+    parser.add_argument("--url", action="append", default=[],
+                        help="Base URL of a running server (repeatable).")
+    parser.add_argument("--compare", action="store_true",
+                        help="Start the debug and production servers on temporary copies of the records "
+                             "and benchmark both.")
+    parser.add_argument("--write", action="store_true",
+                        help="Also benchmark autosave against --url servers (toggles and restores a "
+                             "record's flag, bumping its version).")
+    parser.add_argument("--iterations", type=int, default=50)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for url in args.url:
+        run_benchmarks(url.rstrip("/"), args.iterations, autosave=args.write)
+    if not args.compare:
+        return
+    for label, port, production in [("debug server", 5191, False), ("production server", 5192, True)]:
+        output_dir = tempfile.mkdtemp(prefix="bench-serving-")
+        copy_output(output_dir)
+        process = start_server(port, production, output_dir)
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            if not wait_until_healthy(base_url):
+                print(f"{label} did not start on {base_url}")
+                continue
+            print(f"-- {label}")
+            run_benchmarks(base_url, args.iterations)
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import sys
+import json
+import math
+import time
+import base64
+import struct
+
+########################################
+# Offline stand-in for tts-worker.js
+#
+# Speaks the same stdin/stdout JSON-lines protocol but generates a quiet tone
+# (about 40ms per character, capped at 10s) instead of calling Azure, so the
+# review frontend can be run and exercised without network or credentials:
+#   TTS_WORKER=fake python3 frontend/main.py
+########################################
+SAMPLE_RATE = 24000
+CHUNK_SAMPLES = 2400  # 100ms of audio per chunk
+CHUNK_DELAY = 0.01
+
+
+def send(message):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def tone(num_samples, offset, frequency=440.0, amplitude=2000):
+    return b"".join(
+        struct.pack("<h", int(amplitude * math.sin(2 * math.pi * frequency * (offset + i) / SAMPLE_RATE)))
+        for i in range(num_samples)
+    )
+
+
+def main():
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+        except json.JSONDecodeError as e:
+            send({"id": None, "error": f"Invalid job: {e}"})
+            continue
+        text = job.get("text", "")
+        if text == "__fail__":
+            send({"id": job.get("id"), "error": "Fake synthesis failure"})
+            continue
+        total_samples = min(len(text) * SAMPLE_RATE // 25, SAMPLE_RATE * 10)
+        for offset in range(0, total_samples, CHUNK_SAMPLES):
+            samples = min(CHUNK_SAMPLES, total_samples - offset)
+            send({"id": job.get("id"), "chunk": base64.b64encode(tone(samples, offset)).decode("ascii")})
+            time.sleep(CHUNK_DELAY)
+        send({"id": job.get("id"), "done": True})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import json
+import queue
+import threading
+from collections import deque
+
+########################################
+# Live record updates for the review UI
+#
+# EventIngestor follows the pipeline event log (src/scripts/events.py) in one
+# background thread: streamed records are upserted into the matching record
+# store and every change is handed to the EventBroadcaster, which fans it out
+# to the browsers connected to /events (server-sent events).
+#
+# Browser-facing events:
+#   record_upserted   {"source", "index", "created", "summary"}
+#   records_reloaded  {"source"}  (the file was rewritten; reload the list)
+########################################
+class Subscription:
+    def __init__(self, max_pending):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.dropped = False
+
+
+class EventBroadcaster:
+    def __init__(self, history=500, max_pending=1000):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.history = deque(maxlen=history)
+        self.max_pending = max_pending
+        self.last_id = 0
+
+    def publish(self, event):
+        with self.lock:
+            self.last_id += 1
+            event = dict(event, id=self.last_id)
+            self.history.append(event)
+            for sub in list(self.subscribers):
+                try:
+                    sub.queue.put_nowait(event)
+                except queue.Full:
+                    # A stalled client; it reconnects and resumes from Last-Event-ID.
+                    sub.dropped = True
+                    self.subscribers.discard(sub)
+
+    def subscribe(self, last_event_id=None):
+        """
+        Return (subscription, backlog) where backlog holds the remembered events
+        after last_event_id (for reconnecting clients).
+        """
+        sub = Subscription(self.max_pending)
+        with self.lock:
+            backlog = [e for e in self.history if last_event_id is not None and e["id"] > last_event_id]
+            self.subscribers.add(sub)
+        return sub, backlog
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+
+def format_sse(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def sse_stream(broadcaster, last_event_id=None, keepalive=15):
+    """
+    Generator of server-sent event text for one client.
+    """
+    sub, backlog = broadcaster.subscribe(last_event_id)
+    try:
+        yield "retry: 3000\n\n"
+        for event in backlog:
+            yield format_sse(event)
+        while not sub.dropped:
+            try:
+                event = sub.queue.get(timeout=keepalive)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield format_sse(event)
+    finally:
+        broadcaster.unsubscribe(sub)
+
+
+class EventIngestor:
+    def __init__(self, event_log, sources, broadcaster, summarize):
+        """
+        sources: {"5html_converted_content.json": ("main", store), ...}
+        summarize: record -> summary dict sent to browsers
+        """
+        self.event_log = event_log
+        self.sources = sources
+        self.broadcaster = broadcaster
+        self.summarize = summarize
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        # Pick up records from a run that was already in progress when the server started.
+        offset = self.event_log.size()
+        for file_name in self.sources:
+            pending, _ = self.event_log.pending_run_records(file_name)
+            for record in pending:
+                self.handle({"type": "record_completed", "file": file_name, "record": record})
+        for offset, event in self.event_log.follow(offset, stop_event=self._stop_event):
+            try:
+                self.handle(event)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error handling {event.get('type')} event: {e}")
+
+    def handle(self, event):
+        source_store = self.sources.get(event.get("file"))
+        if source_store is None:
+            return
+        source, store = source_store
+        if event["type"] == "record_completed":
+            idx, record, created = store.upsert_record(event["record"])
+            if idx is not None:
+                self._publish_record(source, idx, record, created)
+        elif event["type"] == "record_updated":
+            # Already written to the file or its journal by another process; the store catches up.
+            idx, record = store.get_record(event.get("email"))
+            if record is not None:
+                self._publish_record(source, idx, record, False)
+        elif event["type"] == "records_replaced":
+            self.broadcaster.publish({"type": "records_reloaded", "source": source})
+
+    def _publish_record(self, source, idx, record, created):
+        summary = self.summarize(record)
+        summary["index"] = idx
+        self.broadcaster.publish({
+            "type": "record_upserted",
+            "source": source,
+            "index": idx,
+            "created": created,
+            "summary": summary
+        })
@@ -1,8 +1,19 @@
 import os
-import json
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import sys
+import argparse
+import threading
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from dotenv import load_dotenv
-from subprocess import check_output, CalledProcessError
+from record_store import get_store, VersionConflict, VERSION_FIELD
+from record_index import RecordIndex, BOOLEAN_FIELDS, SORTED_FIELDS
+from tts_cache import AudioCache, PrefetchWorker, DEFAULT_TTS_VOICE, DEFAULT_TTS_RATE
+from tts_worker import TTSWorkerClient, TTSWorkerError, NoAudioError, default_worker_command
+from serving import OutputFileServer, install_compression, run_production
+from live_events import EventBroadcaster, EventIngestor, sse_stream
+
+# The pipeline's event log module is shared with src/scripts.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "scripts"))
+from events import EventLog
 
 # Load environment variables from .env
 load_dotenv()
@@ -10,120 +21,390 @@ load_dotenv()
 ########################################
 # JSON file helpers: load and save records
 ########################################
+# The pipeline's output folder; OUTPUT_DIR serves another copy of it (bench_serving.py uses a temporary one)
+OUTPUT_DIR = os.getenv("OUTPUT_DIR", "output")
+
 # Updated JSON file locations (only index.html is used)
 JSON_FILES = {
-    "index.html": "output/5html_converted_content.json"
+    "index.html": os.path.join(OUTPUT_DIR, "5html_converted_content.json")
 }
 
-QA_JSON_FILE = "output/6email_feedback.json"
+QA_JSON_FILE = os.path.join(OUTPUT_DIR, "6email_feedback.json")
+
+# Records are parsed once per process and revalidated against the file's mtime/size.
+# Autosaves are journaled and written back to the JSON file in the background.
+RECORD_FLUSH_INTERVAL = float(os.getenv("RECORD_FLUSH_INTERVAL", "5"))
+main_store = get_store(JSON_FILES["index.html"], flush_interval=RECORD_FLUSH_INTERVAL)
+feedback_store = get_store(QA_JSON_FILE, flush_interval=RECORD_FLUSH_INTERVAL)
+
+# Search indexes, built lazily on the first query and kept current by store patches.
+main_index = RecordIndex(main_store)
+feedback_index = RecordIndex(feedback_store)
 
 def load_records(template):
     # Force using "index.html"
-    json_file = JSON_FILES["index.html"]
-    print("Loading JSON from:", json_file)  # Debug line
-    if os.path.exists(json_file):
-        with open(json_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
-
-def save_records(template, records):
-    json_file = JSON_FILES["index.html"]
-    with open(json_file, "w", encoding="utf-8") as f:
-        json.dump(records, f, indent=4, ensure_ascii=False)
+    return main_store.get_records()
 
 def load_feedback_records():
-    if os.path.exists(QA_JSON_FILE):
-        with open(QA_JSON_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
+    return feedback_store.get_records()
+
+def get_source_store(source):
+    return feedback_store if source == "qa" else main_store
+
+def get_source_index(source):
+    return feedback_index if source == "qa" else main_index
+
+def parse_optional_index(value):
+    if value is None:
+        return None
+    return int(value)
+
+def record_etag(record):
+    return f'"v{record.get(VERSION_FIELD, 0)}"'
+
+def parse_base_version(data):
+    """
+    Read the version a client's edit was based on from the If-Match header
+    (e.g. If-Match: "v3") or a "version" key in the request body.
+    """
+    if_match = request.headers.get("If-Match", "").strip()
+    if if_match and if_match != "*":
+        value = if_match.split(",")[0].strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        value = value.strip('"')
+        if value.startswith("v"):
+            value = value[1:]
+        return int(value)
+    if data.get("version") is not None:
+        return int(data["version"])
+    return None
+
+def apply_record_update(store, data, success_message, on_saved=None):
+    """
+    Apply a field-level patch (or a complete record, reduced to the changed fields)
+    to the record identified by Email. A client-sent index is only a hint.
+    With If-Match, concurrent edits are merged per field and only conflicting
+    fields are rejected with 409.
+    """
+    if not data:
+        return jsonify({"status": "error", "message": "No data received."}), 400
+
+    fields = data.get("fields")
+    updated_record = data.get("record")
+    if not fields and not updated_record:
+        return jsonify({"status": "error", "message": "No record provided."}), 400
+    if fields is not None and not isinstance(fields, dict):
+        return jsonify({"status": "error", "message": "Fields must be an object."}), 400
+
+    try:
+        index_hint = parse_optional_index(data.get("index"))
+    except (ValueError, TypeError):
+        return jsonify({"status": "error", "message": "Invalid record index."}), 400
+    try:
+        base_version = parse_base_version(data)
+    except (ValueError, TypeError):
+        return jsonify({"status": "error", "message": "Invalid If-Match version."}), 400
 
-def save_feedback_records(records):
-    with open(QA_JSON_FILE, "w", encoding="utf-8") as f:
-        json.dump(records, f, indent=4, ensure_ascii=False)
+    email = data.get("email") or (updated_record or {}).get("Email")
+    idx = store.find_index(email=email, index=index_hint)
+    if idx is None:
+        return jsonify({"status": "error", "message": "Record not found."}), 404
+
+    if fields is None:
+        current = store.get_records()[idx]
+        fields = {k: v for k, v in updated_record.items() if current.get(k) != v}
+    fields.pop("Email", None)
+
+    try:
+        record = store.apply_patch(idx, fields, email=email, base_version=base_version)
+    except VersionConflict as e:
+        response = jsonify({
+            "status": "conflict",
+            "message": f"Another reviewer changed {', '.join(e.conflicts)}. The latest version has been loaded.",
+            "conflicts": e.conflicts,
+            "version": e.record.get(VERSION_FIELD, 0),
+            "record": e.record
+        })
+        response.headers["ETag"] = record_etag(e.record)
+        return response, 409
+    if record is None:
+        return jsonify({"status": "error", "message": "Record not found."}), 404
+
+    if on_saved is not None:
+        on_saved(record, fields)
+    response = jsonify({"status": "success", "message": success_message, "version": record.get(VERSION_FIELD, 0)})
+    response.headers["ETag"] = record_etag(record)
+    return response
 
 ########################################
 # Flask App & Routes
 ########################################
 app = Flask(__name__)
 
-# Serve output folder files
+install_compression(app)
+output_files = OutputFileServer(os.path.join(app.root_path, '..', OUTPUT_DIR))
+
+# Journal flushing runs in each serving process, whichever server imported the app.
+@app.before_first_request
+def start_background_tasks():
+    main_store.start()
+    feedback_store.start()
+    event_ingestor.start()
+
+# Serve output folder files with strong ETags, conditional GET and range support.
+# Cached speech audio is content-addressed and never changes, so it may be cached forever.
 @app.route('/output/<path:filename>')
 def serve_output(filename):
-    output_dir = os.path.join(app.root_path, '../output')
-    return send_from_directory(output_dir, filename)
+    return output_files.send(filename, immutable=filename.startswith("tts_cache/"))
+
+@app.route("/healthz")
+def healthz():
+    return jsonify({
+        "status": "ok",
+        "records": len(main_store.get_records()),
+        "feedback_records": len(feedback_store.get_records())
+    })
 
-# Main UI route with template selection
+# Main UI route with template selection.
+# Records are no longer embedded in the page; the UI pages through /api/records.
 @app.route("/")
 @app.route("/<template>")
 def index(template="index.html"):
-    records = load_records("index.html")
-    return render_template("index.html", records=records)
+    return render_template("index.html")
 
-# Auto-update endpoint for live changes in record fields
-@app.route("/update_record", methods=["POST"])
-def update_record():
-    data = request.get_json()
-    if not data:
-        return jsonify({"status": "error", "message": "No data received."}), 400
+########################################
+# Record API: lightweight summaries and per-record detail
+########################################
+SUMMARY_FIELDS = ["Email", "First Name", "Last Name", "Title", "Company",
+                  "exclude", "flag", "viewed", "exported"]
+MAX_PAGE_SIZE = 500
 
-    record_index = data.get("index")
-    updated_record = data.get("record")  # Expecting record as a complete object following your schema
+def load_source_records(source):
+    return get_source_store(source).get_records()
 
-    if not updated_record:
-        return jsonify({"status": "error", "message": "No record provided."}), 400
+@app.route("/api/records")
+def list_records():
+    source = request.args.get("source", "main")
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+        limit = min(max(int(request.args.get("limit", 100)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"status": "error", "message": "offset and limit must be integers."}), 400
+    fields_arg = request.args.get("fields", "")
+    fields = [f.strip() for f in fields_arg.split(",") if f.strip()] or SUMMARY_FIELDS
+
+    records = load_source_records(source)
+    page = []
+    for idx, record in enumerate(records[offset:offset + limit], start=offset):
+        summary = {field: record.get(field) for field in fields}
+        summary["index"] = idx
+        page.append(summary)
+    return jsonify({
+        "status": "success",
+        "total": len(records),
+        "offset": offset,
+        "limit": limit,
+        "records": page
+    })
+
+@app.route("/api/records/<path:email>")
+def get_record(email):
+    source = request.args.get("source", "main")
+    idx, record = get_source_store(source).get_record(email)
+    if record is None:
+        return jsonify({"status": "error", "message": "Record not found."}), 404
+    response = jsonify({"status": "success", "index": idx, "record": record})
+    response.headers["ETag"] = record_etag(record)
+    return response
+
+# Indexed search: /api/search?q=cloud+migration&viewed=false&company=acme
+# Text terms must all match; exclude/flag/viewed/exported take true/false;
+# company/title match exactly (case-insensitive), or as prefixes with prefix=true.
+def parse_bool_arg(value):
+    value = value.strip().lower()
+    if value in ("true", "1", "yes"):
+        return True
+    if value in ("false", "0", "no"):
+        return False
+    raise ValueError(value)
 
+@app.route("/api/search")
+def search_records():
+    source = request.args.get("source", "main")
     try:
-        idx = int(record_index)
-    except (ValueError, TypeError):
-        return jsonify({"status": "error", "message": "Invalid record index."}), 400
+        flags = {field: parse_bool_arg(request.args[field])
+                 for field in BOOLEAN_FIELDS if request.args.get(field, "").strip()}
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Expected true or false, got '{e}'."}), 400
+    sorted_filters = {name: request.args.get(name, "") for name in SORTED_FIELDS}
+    prefix = request.args.get("prefix", "").lower() in ("true", "1", "yes")
 
-    records = load_records("index.html")
-    if idx < 0 or idx >= len(records):
-        return jsonify({"status": "error", "message": "Record index out of range."}), 400
+    indices = get_source_index(source).search(request.args.get("q", ""), flags, sorted_filters, prefix)
+    records = load_source_records(source)
+    return jsonify({
+        "status": "success",
+        "total": len(indices),
+        "indices": indices,
+        "emails": [records[i].get("Email") for i in indices if i < len(records)]
+    })
 
-    # Replace the record completely with the updated record
-    records[idx] = updated_record
-    save_records("index.html", records)
-    return jsonify({"status": "success", "message": "Record updated successfully."})
+########################################
+# Live updates: records streamed from running pipeline stages
+########################################
+def summarize_record(record):
+    return {field: record.get(field) for field in SUMMARY_FIELDS}
 
-@app.route("/update_feedback", methods=["POST"])
-def update_feedback():
-    data = request.get_json()
-    if not data:
-        return jsonify({"status": "error", "message": "No data received."}), 400
+event_log = EventLog()
+live_events = EventBroadcaster()
+event_ingestor = EventIngestor(event_log, {
+    os.path.basename(main_store.json_file): ("main", main_store),
+    os.path.basename(feedback_store.json_file): ("qa", feedback_store),
+}, live_events, summarize_record)
 
-    record_index = data.get("index")
-    updated_record = data.get("record")
-    if not updated_record:
-        return jsonify({"status": "error", "message": "No record provided."}), 400
+# Server-sent events; each open tab holds one connection (and one server thread).
+@app.route("/events")
+def events_stream():
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else None
+    response = Response(stream_with_context(sse_stream(live_events, last_event_id)),
+                        mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
-    try:
-        idx = int(record_index)
-    except (ValueError, TypeError):
-        return jsonify({"status": "error", "message": "Invalid record index."}), 400
+# Auto-update endpoint for live changes in record fields.
+# Accepts a field-level patch: {"email": "...", "fields": {"flag": true}}.
+# A complete "record" is still accepted and reduced to the fields that changed.
+@app.route("/update_record", methods=["POST"])
+def update_record():
+    return apply_record_update(main_store, request.get_json(), "Record updated successfully.",
+                               on_saved=publish_feedback_saved)
+
+# The feedback worker (src/scripts/feedback_worker.py) regenerates the QA email from these events.
+# Events carry only the record's Email (the worker reads the record from the file and
+# its journal), and are coalesced per record: one event once its autosaves pause.
+FEEDBACK_EVENT_DELAY = float(os.getenv("FEEDBACK_EVENT_DELAY", "2"))
+feedback_event_timers = {}
+feedback_event_lock = threading.Lock()
+
+def publish_feedback_saved(record, fields):
+    email = record.get("Email")
+    if "email_feedback" not in fields or not email or not (record.get("email_feedback") or "").strip():
+        return
+    with feedback_event_lock:
+        timer = feedback_event_timers.pop(email, None)
+        if timer is not None:
+            timer.cancel()
+        timer = threading.Timer(FEEDBACK_EVENT_DELAY, send_feedback_saved, args=(email,))
+        timer.daemon = True
+        feedback_event_timers[email] = timer
+        timer.start()
+
+def send_feedback_saved(email):
+    with feedback_event_lock:
+        feedback_event_timers.pop(email, None)
+    event_log.publish("feedback_saved", file=os.path.basename(main_store.json_file), email=email)
+
+@app.route("/update_feedback", methods=["POST"])
+def update_feedback():
+    return apply_record_update(feedback_store, request.get_json(), "QA feedback updated successfully.")
 
-    records = load_feedback_records()
-    if idx < 0 or idx >= len(records):
-        return jsonify({"status": "error", "message": "Record index out of range."}), 400
+########################################
+# Text-to-speech: a warm synthesizer worker, content-addressed audio cache
+# and background pre-synthesis
+########################################
+TTS_CACHE_DIR = os.path.join(app.root_path, "..", OUTPUT_DIR, "tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+tts_worker = TTSWorkerClient(default_worker_command(app.root_path), cwd=app.root_path)
+# Prefetches run on their own worker process (started on the first prefetch), so a
+# reviewer's /speech request never waits behind the queued emails of upcoming records.
+prefetch_tts_worker = TTSWorkerClient(default_worker_command(app.root_path), cwd=app.root_path)
+audio_cache = AudioCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, tts_worker,
+                         background_synthesizer=prefetch_tts_worker)
+speech_prefetcher = PrefetchWorker(audio_cache)
 
-    records[idx] = updated_record
-    save_feedback_records(records)
-    return jsonify({"status": "success", "message": "QA feedback updated successfully."})
+def speech_text(record, source):
+    # The same field the UI puts in the email textarea, so prefetched audio matches playback.
+    if source == "qa":
+        return record.get("email_after_feedback", "")
+    return record.get("email_output_final", "")
 
+# Returns a URL for the audio without waiting for synthesis; fetching the URL
+# streams audio as it is synthesized (or from the cache when already available).
 @app.route("/synthesizeSpeech", methods=["POST"])
 def synthesize_speech():
     data = request.get_json()
     text = data.get("text", "Hello from Azure TTS!")
+    voice = data.get("voice", DEFAULT_TTS_VOICE)
+    rate = str(data.get("rate", DEFAULT_TTS_RATE))
+    key = audio_cache.register(text, voice, rate)
+    return jsonify({
+        "status": "success",
+        "message": "Speech synthesized",
+        "audioUrl": f"/speech/{key}.wav"
+    })
+
+@app.route("/speech/<key>.wav")
+def speech_audio(key):
+    cached_path = audio_cache.get(key)
+    if cached_path:
+        return output_files.send(os.path.join("tts_cache", os.path.basename(cached_path)), immutable=True)
+    if not audio_cache.is_known(key):
+        return jsonify({"status": "error", "message": "Unknown audio."}), 404
+
+    audio = audio_cache.stream(key)
     try:
-        # Set working directory to app.root_path so that Node can locate azure-speech.js
-        check_output(["node", "azure-speech.js", text], cwd=app.root_path)
-        return jsonify({
-            "status": "success",
-            "message": "Speech synthesized",
-            "audioUrl": "/output/speech.wav"
-        })
-    except CalledProcessError as e:
+        # Pull the first bytes before responding so synthesis errors still produce a 500
+        # (502 when the synthesizer produced no audio at all; nothing is cached then).
+        first_chunk = next(audio, None)
+        if first_chunk is None:
+            raise NoAudioError("The synthesizer returned no audio")
+    except KeyError:
+        # Its text was dropped from the registry since the check above.
+        return jsonify({"status": "error", "message": "Unknown audio."}), 404
+    except NoAudioError as e:
+        return jsonify({"status": "error", "message": str(e)}), 502
+    except TTSWorkerError as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+    def generate():
+        yield first_chunk
+        try:
+            yield from audio
+        except TTSWorkerError as e:
+            print(f"Speech stream for {key} failed: {e}")
+
+    return Response(stream_with_context(generate()), mimetype="audio/wav")
+
+# Queue synthesis for the emails of upcoming records: {"emails": [...], "source": "main"}
+@app.route("/prefetchSpeech", methods=["POST"])
+def prefetch_speech():
+    data = request.get_json() or {}
+    source = data.get("source", "main")
+    voice = data.get("voice", DEFAULT_TTS_VOICE)
+    rate = str(data.get("rate", DEFAULT_TTS_RATE))
+    store = get_source_store(source)
+    queued = 0
+    for email in data.get("emails", []):
+        _, record = store.get_record(email)
+        if record and speech_text(record, source).strip():
+            queued += speech_prefetcher.enqueue(speech_text(record, source), voice, rate)
+    return jsonify({"status": "success", "queued": queued})
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Review frontend for generated emails.")
+    parser.add_argument("--production", action="store_true",
+                        help="Serve with a multi-threaded WSGI server instead of the debug server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--threads", type=int, default=16,
+                        help="Worker threads in production mode (each open tab's /events stream holds one).")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=5100, debug=True)
\ No newline at end of file
+    args = parse_args()
+    if args.production:
+        run_production(app, args.host, args.port, args.threads)
+    else:
+        app.run(host=args.host, port=args.port, debug=True)
\ No newline at end of file
@@ -0,0 +1,251 @@
+import re
+import bisect
+import threading
+from collections import defaultdict
+
+########################################
+# Search index over review records
+#
+# - Inverted index: token -> bitmap of record positions, over the email text,
+#   prospect_info and most_relevant_topic (HTML tags stripped).
+# - Bitmaps for the boolean review fields (exclude, flag, viewed, exported).
+# - Sorted (value, position) lists for Company and Title, for case-insensitive
+#   exact or prefix matches via bisect.
+#
+# Bitmaps are Python ints (bit i = record i), so a query is a handful of
+# AND/NOT operations regardless of list size. Postings are collected as
+# position lists and turned into bitmaps once per build. The index follows
+# its store: patches update only the affected record, records appended to
+# the store are added incrementally, and a reload of the underlying file
+# triggers a full rebuild on the next query. Builds run from a snapshot of
+# the records outside the store lock, so saves are not blocked meanwhile;
+# patches that arrive during a build are replayed once it is installed.
+########################################
+TEXT_FIELDS = ["email_output_final", "email_subject_extract", "email_after_feedback",
+               "email_subject_extract_after_feedback", "prospect_info", "most_relevant_topic"]
+BOOLEAN_FIELDS = ["exclude", "flag", "viewed", "exported"]
+SORTED_FIELDS = {"company": "Company", "title": "Title"}
+
+TAG_RE = re.compile(r"<[^>]+>")
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    if not isinstance(text, str) or not text:
+        return set()
+    return set(TOKEN_RE.findall(TAG_RE.sub(" ", text).lower()))
+
+
+def normalize(value):
+    return value.strip().lower() if isinstance(value, str) else ""
+
+
+def bitmap_from_positions(positions):
+    """
+    Bitmap with the bits of the given (ascending or not) record positions set.
+    """
+    if not positions:
+        return 0
+    if len(positions) < 8:
+        bitmap = 0
+        for idx in positions:
+            bitmap |= 1 << idx
+        return bitmap
+    data = bytearray(max(positions) // 8 + 1)
+    for idx in positions:
+        data[idx >> 3] |= 1 << (idx & 7)
+    return int.from_bytes(data, "little")
+
+
+def iter_bits(bitmap):
+    """
+    Positions of the set bits, ascending. Scans a byte at a time.
+    """
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for byte_idx, byte in enumerate(data):
+        if not byte:
+            continue
+        base = byte_idx * 8
+        for bit in range(8):
+            if byte >> bit & 1:
+                yield base + bit
+
+
+class RecordIndex:
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.RLock()
+        self.build_lock = threading.Lock()
+        self.generation = None
+        self.size = 0
+        self.postings = {}
+        self.record_tokens = []
+        self.bitmaps = {field: 0 for field in BOOLEAN_FIELDS}
+        self.sorted_values = {name: [] for name in SORTED_FIELDS}
+        # (generation, idx, record, changes) of patches to positions being built, replayed after the build
+        self.pending = None
+        self.build_start = 0
+        store.add_listener(self._on_patch)
+
+    ########################################
+    # Building and incremental updates
+    ########################################
+    def _build(self, records, start):
+        """
+        Index structures for records, which sit at positions start, start + 1, ...
+        """
+        positions = defaultdict(list)
+        record_tokens = []
+        flags = {field: [] for field in BOOLEAN_FIELDS}
+        sorted_values = {name: [] for name in SORTED_FIELDS}
+        for idx, record in enumerate(records, start):
+            tokens = self._record_tokens(record)
+            record_tokens.append(tokens)
+            for token in tokens:
+                positions[token].append(idx)
+            for field in BOOLEAN_FIELDS:
+                if record.get(field):
+                    flags[field].append(idx)
+            for name, field in SORTED_FIELDS.items():
+                sorted_values[name].append((normalize(record.get(field)), idx))
+        return {
+            "postings": {token: bitmap_from_positions(idxs) for token, idxs in positions.items()},
+            "record_tokens": record_tokens,
+            "bitmaps": {field: bitmap_from_positions(idxs) for field, idxs in flags.items()},
+            "sorted_values": sorted_values,
+        }
+
+    def _install(self, built, start, size):
+        # Called with self.lock held
+        if start == 0:
+            self.postings = built["postings"]
+            self.record_tokens = built["record_tokens"]
+            self.bitmaps = built["bitmaps"]
+            self.sorted_values = {name: sorted(values) for name, values in built["sorted_values"].items()}
+        else:
+            for token, bitmap in built["postings"].items():
+                self.postings[token] = self.postings.get(token, 0) | bitmap
+            self.record_tokens.extend(built["record_tokens"])
+            for field, bitmap in built["bitmaps"].items():
+                self.bitmaps[field] |= bitmap
+            for name, values in built["sorted_values"].items():
+                self.sorted_values[name] = sorted(self.sorted_values[name] + values)
+        self.size = size
+
+    def _record_tokens(self, record):
+        return tokenize(" ".join(value for value in map(record.get, TEXT_FIELDS) if isinstance(value, str)))
+
+    def _ensure_current(self):
+        """
+        Rebuild after a reload, or add records appended since the last build.
+        The records are snapshotted under the store lock and indexed outside it.
+        """
+        with self.build_lock:
+            with self.lock:
+                self.pending = []
+                self.build_start = 0
+            try:
+                with self.store.lock:
+                    records = self.store.get_records()
+                    generation = self.store.generation
+                    start = 0 if generation != self.generation else self.size
+                    snapshot = [dict(record) for record in records[start:]]
+                    with self.lock:
+                        self.build_start = start
+                # After a reload everything is replaced, even by an empty list
+                if snapshot or generation != self.generation:
+                    built = self._build(snapshot, start)
+                    with self.lock:
+                        self._install(built, start, start + len(snapshot))
+                        self.generation = generation
+            finally:
+                with self.lock:
+                    pending, self.pending = self.pending, None
+                    for patch_generation, idx, record, changes in pending:
+                        if patch_generation == self.generation and idx < self.size:
+                            self._apply_patch(idx, record, changes)
+
+    def _on_patch(self, idx, record, changes):
+        # Called by the store with its lock held
+        with self.lock:
+            if self.pending is not None and idx >= self.build_start:
+                self.pending.append((self.store.generation, idx, record, changes))
+                return
+            if self.generation != self.store.generation:
+                return  # rebuilt on the next query
+            if idx == self.size:
+                # A record appended to the store
+                self._install(self._build([record], idx), idx, idx + 1)
+                return
+            if idx > self.size:
+                return  # added on the next query
+            self._apply_patch(idx, record, changes)
+
+    def _apply_patch(self, idx, record, changes):
+        bit = 1 << idx
+        for field in BOOLEAN_FIELDS:
+            if field in changes:
+                if record.get(field):
+                    self.bitmaps[field] |= bit
+                else:
+                    self.bitmaps[field] &= ~bit
+        if any(field in changes for field in TEXT_FIELDS):
+            old_tokens = self.record_tokens[idx]
+            new_tokens = self._record_tokens(record)
+            for token in old_tokens - new_tokens:
+                remaining = self.postings.get(token, 0) & ~bit
+                if remaining:
+                    self.postings[token] = remaining
+                else:
+                    self.postings.pop(token, None)
+            for token in new_tokens - old_tokens:
+                self.postings[token] = self.postings.get(token, 0) | bit
+            self.record_tokens[idx] = new_tokens
+        for name, field in SORTED_FIELDS.items():
+            if field in changes:
+                values = [v for v in self.sorted_values[name] if v[1] != idx]
+                bisect.insort(values, (normalize(record.get(field)), idx))
+                self.sorted_values[name] = values
+
+    ########################################
+    # Queries
+    ########################################
+    def _prefix_bitmap(self, name, value, exact):
+        values = self.sorted_values[name]
+        value = normalize(value)
+        positions = []
+        pos = bisect.bisect_left(values, (value, -1))
+        while pos < len(values):
+            candidate, idx = values[pos]
+            if exact and candidate != value:
+                break
+            if not exact and not candidate.startswith(value):
+                break
+            positions.append(idx)
+            pos += 1
+        return bitmap_from_positions(positions)
+
+    def search(self, text="", flags=None, sorted_filters=None, prefix=False):
+        """
+        Return the matching record positions in list order.
+
+        text: every token must appear in the record's text fields.
+        flags: {"viewed": False, "exclude": False, ...}
+        sorted_filters: {"company": "Acme", "title": "vp"} (exact, or prefix with prefix=True)
+        """
+        # Builds take the store lock only for the snapshot; the query itself
+        # holds only the index lock, so saves are never blocked behind it.
+        self._ensure_current()
+        with self.lock:
+            result = (1 << self.size) - 1
+            for token in tokenize(text):
+                result &= self.postings.get(token, 0)
+                if not result:
+                    return []
+            for field, wanted in (flags or {}).items():
+                bitmap = self.bitmaps[field]
+                result &= bitmap if wanted else ~bitmap
+            for name, value in (sorted_filters or {}).items():
+                if value:
+                    result &= self._prefix_bitmap(name, value, exact=not prefix)
+            return list(iter_bits(result))
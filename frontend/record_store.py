@@ -0,0 +1,383 @@
+import os
+import json
+import atexit
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+########################################
+# Journaled record store
+#
+# Autosaves arrive as small field-level patches. Each patch is applied to the
+# in-memory records and appended (fsync'd) to "<json_file>.journal", so an
+# acknowledged save survives a crash. The canonical JSON file is rewritten
+# atomically (temp file + os.replace) only by flush(), which runs on a
+# background timer and at shutdown, after which the journal is truncated.
+#
+# On load, any journal entries left behind by a crash are replayed on top of
+# the canonical file. Patches only set field values, so replaying an entry
+# that already reached the canonical file is harmless.
+#
+# The parsed records are cached for the life of the process and validated
+# against the file's mtime and size on every access. If another process
+# rewrites the file (e.g. an export marking records "exported"), the cache is
+# reloaded and the not-yet-flushed journal is replayed on top of it. An
+# Email -> index map makes identity lookups O(1).
+#
+# Concurrency: every record carries a "record_version" counter and a
+# "field_versions" map (field -> version that last changed it). A patch may
+# name the version it was based on; it is merged field by field and only
+# rejected if one of its fields was changed to a different value after that
+# version. Writers hold an exclusive lock on "<json_file>.lock", and before
+# each patch or flush the store catches up on journal entries appended by
+# other processes, so several servers can share one list.
+#
+# Listeners (e.g. the search index) are told about every applied patch, and
+# "generation" is bumped whenever the records are reloaded from disk.
+#
+# Records streamed in from a running pipeline stage are added with
+# upsert_record(): new Emails are appended, and existing records only take
+# the pipeline's fields, never review flags or fields a reviewer has edited.
+########################################
+VERSION_FIELD = "record_version"
+FIELD_VERSIONS_FIELD = "field_versions"
+PROTECTED_FIELDS = {"Email", VERSION_FIELD, FIELD_VERSIONS_FIELD}
+# Set by reviewers, not by the pipeline (same list as src/scripts/record_files.py)
+REVIEW_FIELDS = {"exclude", "email_feedback", "flag", "viewed", "exported"}
+
+
+class VersionConflict(Exception):
+    """
+    Raised when a patch changes a field that another writer changed after the patch's base version.
+    """
+    def __init__(self, record, conflicts):
+        super().__init__(f"Conflicting changes to: {', '.join(conflicts)}")
+        self.record = record
+        self.conflicts = conflicts
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    Exclusive advisory lock shared with any other process that locks the same path.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class JournaledRecordStore:
+    def __init__(self, json_file, flush_interval=5.0):
+        self.json_file = json_file
+        self.journal_file = json_file + ".journal"
+        self.lock_file = json_file + ".lock"
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.records = None
+        self.email_index = {}
+        self.dirty = False
+        self._stat = None
+        self._journal_offset = 0
+        self._flush_thread = None
+        self._stop_event = threading.Event()
+        self.generation = 0
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """
+        Call listener(index, record, changed_fields) after every patch, local or replayed.
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, idx, record, changes):
+        for listener in self.listeners:
+            listener(idx, record, changes)
+
+    ########################################
+    # Loading and journal replay
+    ########################################
+    def _read_canonical(self):
+        if os.path.exists(self.json_file):
+            with open(self.json_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return []
+
+    def _read_journal(self, offset=0):
+        """
+        Return (entries, end_offset) for the complete journal lines after `offset`.
+        """
+        entries = []
+        if not os.path.exists(self.journal_file):
+            return entries, 0
+        with open(self.journal_file, "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    # A torn final line from a crash or a concurrent append; stop before it.
+                    break
+                offset += len(raw)
+                line = raw.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+        return entries, offset
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.journal_file)
+        except OSError:
+            return 0
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.json_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _build_email_index(self, records):
+        email_index = {}
+        for i, record in enumerate(records):
+            email = record.get("Email")
+            if email and email not in email_index:
+                email_index[email] = i
+        return email_index
+
+    def _resolve(self, records, email_index, index, email):
+        # Email is the record identity; a client-sent index is only trusted when it agrees with it.
+        if email:
+            if index is not None and 0 <= index < len(records) and records[index].get("Email") == email:
+                return index
+            return email_index.get(email)
+        if index is not None and 0 <= index < len(records):
+            return index
+        return None
+
+    def _replay(self, records, email_index, entries):
+        replayed = 0
+        for entry in entries:
+            idx = self._resolve(records, email_index, entry.get("index"), entry.get("email"))
+            if idx is None and entry.get("upsert") and entry.get("email"):
+                records.append({})
+                idx = email_index[entry["email"]] = len(records) - 1
+            if idx is None:
+                continue
+            records[idx].update(entry.get("fields", {}))
+            if records is self.records:
+                self._notify(idx, records[idx], entry.get("fields", {}))
+            replayed += 1
+        return replayed
+
+    def _load(self):
+        stat = self._file_stat()
+        records = self._read_canonical()
+        email_index = self._build_email_index(records)
+        entries, offset = self._read_journal()
+        replayed = self._replay(records, email_index, entries)
+        self.records = records
+        self.email_index = email_index
+        self._stat = stat
+        self._journal_offset = offset
+        self.generation += 1
+        if replayed:
+            print(f"Replayed {replayed} journaled change(s) into {self.json_file}")
+            self.dirty = True
+
+    def _catch_up(self):
+        """
+        Bring the cache up to date with the canonical file and with journal
+        entries appended by other processes since the last read.
+        """
+        if self.records is None or self._file_stat() != self._stat:
+            self._load()
+            return
+        if self._journal_size() == self._journal_offset:
+            return
+        if self._journal_size() < self._journal_offset:
+            # Another process flushed and truncated the journal.
+            self._load()
+            return
+        entries, offset = self._read_journal(self._journal_offset)
+        if self._replay(self.records, self.email_index, entries):
+            self.dirty = True
+        self._journal_offset = offset
+
+    def get_records(self):
+        with self.lock:
+            try:
+                self._catch_up()
+            except json.JSONDecodeError as e:
+                # Another process is mid-write; keep serving the last good copy.
+                if self.records is None:
+                    raise
+                print(f"Keeping cached {self.json_file}; file is not valid JSON yet: {e}")
+            return self.records
+
+    def find_index(self, email=None, index=None):
+        """
+        Return the position of a record by Email (O(1)), falling back to a plain index
+        only when no Email is given. Returns None if the record does not exist.
+        """
+        with self.lock:
+            records = self.get_records()
+            return self._resolve(records, self.email_index, index, email)
+
+    def get_record(self, email):
+        with self.lock:
+            idx = self.find_index(email)
+            if idx is None:
+                return None, None
+            return idx, self.records[idx]
+
+    ########################################
+    # Patches
+    ########################################
+    def apply_patch(self, index, fields, email=None, base_version=None):
+        """
+        Merge the given fields into one record and journal the change.
+
+        If base_version is given and the record has moved on since, the patch is
+        still applied unless one of its fields was changed to a different value
+        after base_version, in which case VersionConflict is raised.
+        Returns the updated record, or None if the record cannot be found.
+        """
+        with self.lock, file_lock(self.lock_file):
+            records = self.get_records()
+            idx = self._resolve(records, self.email_index, index, email)
+            if idx is None:
+                return None
+            current = records[idx]
+            version = current.get(VERSION_FIELD, 0)
+            field_versions = current.get(FIELD_VERSIONS_FIELD, {})
+
+            changes = {k: v for k, v in fields.items() if k not in PROTECTED_FIELDS and current.get(k) != v}
+            if base_version is not None and base_version != version:
+                conflicts = sorted(k for k in changes if field_versions.get(k, 0) > base_version)
+                if conflicts:
+                    raise VersionConflict(current, conflicts)
+            if not changes:
+                return current
+
+            new_version = version + 1
+            new_field_versions = dict(field_versions)
+            for key in changes:
+                new_field_versions[key] = new_version
+            changes[VERSION_FIELD] = new_version
+            changes[FIELD_VERSIONS_FIELD] = new_field_versions
+
+            self._append_journal({"index": idx, "email": current.get("Email"), "fields": changes})
+            current.update(changes)
+            self.dirty = True
+            self._notify(idx, current, changes)
+            return current
+
+    def upsert_record(self, record):
+        """
+        Append a record produced by the pipeline, or update the pipeline-owned
+        fields of the record with the same Email. Returns (index, record, created),
+        or (None, None, False) if the record has no Email.
+        """
+        email = record.get("Email")
+        if not email:
+            return None, None, False
+        with self.lock, file_lock(self.lock_file):
+            records = self.get_records()
+            idx = self.email_index.get(email)
+            if idx is None:
+                fields = {k: v for k, v in record.items() if k not in (VERSION_FIELD, FIELD_VERSIONS_FIELD)}
+            else:
+                current = records[idx]
+                owned = PROTECTED_FIELDS | REVIEW_FIELDS | set(current.get(FIELD_VERSIONS_FIELD, {}))
+                fields = {k: v for k, v in record.items() if k not in owned and current.get(k) != v}
+                if not fields:
+                    return idx, current, False
+                # New version so open editors see a new ETag; field_versions stay reviewer-only.
+                fields[VERSION_FIELD] = current.get(VERSION_FIELD, 0) + 1
+
+            self._append_journal({"email": email, "fields": fields, "upsert": True})
+            created = idx is None
+            if created:
+                records.append({})
+                idx = self.email_index[email] = len(records) - 1
+            records[idx].update(fields)
+            self.dirty = True
+            self._notify(idx, records[idx], fields)
+            return idx, records[idx], created
+
+    def _append_journal(self, entry):
+        with open(self.journal_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_offset = self._journal_size()
+
+    ########################################
+    # Flushing
+    ########################################
+    def flush(self):
+        with self.lock:
+            if not self.dirty or self.records is None:
+                return False
+            with file_lock(self.lock_file):
+                # Include anything other processes journaled before we truncate the journal.
+                self._catch_up()
+                tmp_file = self.json_file + ".tmp"
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump(self.records, f, indent=4, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.json_file)
+                self._stat = self._file_stat()
+                # Only truncate once the canonical file holds every journaled change.
+                open(self.journal_file, "w").close()
+                self._journal_offset = 0
+                self.dirty = False
+            return True
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except (OSError, ValueError) as e:
+                print(f"Error flushing {self.json_file}: {e}")
+
+    def start(self):
+        """
+        Start the periodic background flush and flush once more at interpreter exit.
+        """
+        if self._flush_thread is not None:
+            return
+        self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flush_thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        self._stop_event.set()
+        self.flush()
+
+
+########################################
+# Process-level registry: one store per JSON file
+########################################
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(json_file, flush_interval=5.0):
+    path = os.path.abspath(json_file)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = JournaledRecordStore(json_file, flush_interval=flush_interval)
+        return _stores[path]
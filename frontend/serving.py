@@ -0,0 +1,145 @@
+import os
+import gzip
+import hashlib
+import threading
+from flask import request, send_from_directory, Response, abort
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+########################################
+# Production serving helpers for the review frontend
+#
+# - Response compression (brotli when installed, else gzip) for JSON, HTML,
+#   CSS and JS bodies.
+# - /output assets with strong content-hash ETags, conditional GET (304),
+#   HTTP range requests (audio seeking) and pre-compressed JSON variants.
+# - A production server: waitress when installed, otherwise Werkzeug's
+#   threaded server with the debugger and reloader off.
+########################################
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/html", "text/css", "application/javascript", "text/plain"}
+MIN_COMPRESS_SIZE = 1024
+
+
+def choose_encoding():
+    accepted = request.headers.get("Accept-Encoding", "").lower()
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def install_compression(app):
+    """
+    Compress buffered text responses for clients that accept it. Streamed and
+    file responses (audio, ranges) are left untouched.
+    """
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough or response.is_streamed
+                or response.status_code != 200
+                or "Content-Encoding" in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        encoding = choose_encoding()
+        if encoding is None:
+            return response
+        response.set_data(compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+        return response
+
+
+########################################
+# Static /output assets
+########################################
+class OutputFileServer:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # (path, mtime_ns, size) -> sha256 hex; (etag, encoding) -> compressed bytes
+        self._hashes = {}
+        self._compressed = {}
+
+    def _content_hash(self, path, st):
+        cache_key = (path, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            if cache_key in self._hashes:
+                return self._hashes[cache_key]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        content_hash = digest.hexdigest()[:32]
+        with self.lock:
+            self._hashes = {k: v for k, v in self._hashes.items() if k[0] != path}
+            self._hashes[cache_key] = content_hash
+        return content_hash
+
+    def _compressed_body(self, path, etag, encoding):
+        with self.lock:
+            body = self._compressed.get((path, etag, encoding))
+        if body is None:
+            with open(path, "rb") as f:
+                body = compress(f.read(), encoding)
+            with self.lock:
+                self._compressed = {k: v for k, v in self._compressed.items() if k[0] != path}
+                self._compressed[(path, etag, encoding)] = body
+        return body
+
+    def send(self, filename, immutable=False):
+        path = safe_join(self.directory, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        st = os.stat(path)
+        etag = self._content_hash(path, st)
+        cache_control = "public, max-age=31536000, immutable" if immutable else "no-cache"
+
+        encoding = choose_encoding() if filename.endswith(".json") and "Range" not in request.headers else None
+        if encoding and st.st_size >= MIN_COMPRESS_SIZE:
+            response = Response(self._compressed_body(path, etag, encoding), mimetype="application/json")
+            response.headers["Content-Encoding"] = encoding
+            response.vary.add("Accept-Encoding")
+            response.set_etag(f"{etag}-{encoding}")
+            response.last_modified = st.st_mtime
+            response.headers["Cache-Control"] = cache_control
+            return response.make_conditional(request)
+
+        # send_from_directory handles If-None-Match / If-Modified-Since and Range requests.
+        response = send_from_directory(self.directory, filename, conditional=True, etag=etag)
+        response.headers["Cache-Control"] = cache_control
+        response.headers["Accept-Ranges"] = "bytes"
+        return response
+
+
+########################################
+# Production server
+########################################
+def run_production(app, host, port, threads):
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+    if serve is not None:
+        print(f"Serving with waitress on http://{host}:{port} ({threads} threads)")
+        serve(app, host=host, port=port, threads=threads)
+        return
+    from werkzeug.serving import run_simple
+    print(f"waitress is not installed; serving with threaded Werkzeug on http://{host}:{port}")
+    run_simple(host, port, app, threaded=True, use_reloader=False, use_debugger=False)
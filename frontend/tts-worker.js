@@ -0,0 +1,89 @@
+// Long-lived Azure TTS worker used by main.py.
+//
+// Reads one JSON job per line on stdin:
+//   {"id": "...", "text": "...", "voice": "en-US-ChristopherNeural", "rate": "2"}
+// and writes one JSON message per line on stdout:
+//   {"id": "...", "chunk": "<base64 raw PCM, 24kHz 16-bit mono>"}   (zero or more)
+//   {"id": "...", "done": true}
+//   {"id": "...", "error": "..."}
+//
+// The SpeechConfig and SpeechSynthesizer are created once and reused, so each
+// job only pays for synthesis. Jobs run one at a time in arrival order, and
+// audio chunks are forwarded as soon as the service produces them.
+require('dotenv').config();
+const sdk = require("microsoft-cognitiveservices-speech-sdk");
+const readline = require("readline");
+
+const subscriptionKey = process.env.AZURE_SPEECH_SUBSCRIPTION_KEY;
+const serviceRegion = process.env.AZURE_SPEECH_SERVICE_REGION;
+
+const speechConfig = sdk.SpeechConfig.fromSubscription(subscriptionKey, serviceRegion);
+speechConfig.speechSynthesisOutputFormat = sdk.SpeechSynthesisOutputFormat.Raw24Khz16BitMonoPcm;
+// No audio output device: audio is delivered through events and results only.
+const synthesizer = new sdk.SpeechSynthesizer(speechConfig, null);
+
+const escapeXml = (value) => value
+  .replace(/&/g, "&amp;")
+  .replace(/</g, "&lt;")
+  .replace(/>/g, "&gt;");
+
+const send = (message) => process.stdout.write(JSON.stringify(message) + "\n");
+
+const jobs = [];
+let currentJob = null;
+
+synthesizer.synthesizing = (sender, event) => {
+  if (currentJob && event.result.audioData && event.result.audioData.byteLength > 0) {
+    send({ id: currentJob.id, chunk: Buffer.from(event.result.audioData).toString("base64") });
+  }
+};
+
+function runNext() {
+  if (currentJob || jobs.length === 0) return;
+  currentJob = jobs.shift();
+  const job = currentJob;
+  const voice = job.voice || "en-US-ChristopherNeural";
+  const rate = job.rate || "2";
+  const ssml = `<speak version="1.0" xml:lang="en-US">
+  <voice name="${voice}">
+    <prosody rate="${rate}">
+      ${escapeXml(job.text || "")}
+    </prosody>
+  </voice>
+</speak>`;
+
+  const finish = (message) => {
+    send(message);
+    currentJob = null;
+    runNext();
+  };
+
+  synthesizer.speakSsmlAsync(
+    ssml,
+    (result) => {
+      if (result.reason === sdk.ResultReason.SynthesizingAudioCompleted) {
+        finish({ id: job.id, done: true });
+      } else {
+        finish({ id: job.id, error: result.errorDetails || "Speech synthesis failed" });
+      }
+    },
+    (err) => finish({ id: job.id, error: String(err) })
+  );
+}
+
+const input = readline.createInterface({ input: process.stdin });
+input.on("line", (line) => {
+  if (!line.trim()) return;
+  let job;
+  try {
+    job = JSON.parse(line);
+  } catch (err) {
+    send({ id: null, error: "Invalid job: " + err.message });
+    return;
+  }
+  jobs.push(job);
+  runNext();
+});
+input.on("close", () => {
+  synthesizer.close();
+});
@@ -0,0 +1,232 @@
+import os
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from tts_worker import TTSWorkerError, NoAudioError, wav_header
+
+########################################
+# Text-to-speech audio cache
+#
+# Synthesized audio is stored as "<sha256(text, voice, rate)>.wav", so the
+# same email read with the same voice and rate is synthesized once and every
+# tab gets its own stable URL. Files are evicted least-recently-used first
+# (by mtime, refreshed on every hit) once the cache exceeds max_bytes.
+#
+# Audio comes from a streaming synthesizer (see tts_worker.py). stream()
+# yields a playable WAV while synthesis is still running and writes the same
+# bytes to the cache, so the next request for that text is served from disk.
+# Background pre-synthesis can use its own synthesizer (a second worker
+# process), so a reviewer's request never queues behind prefetched emails.
+########################################
+DEFAULT_TTS_VOICE = "en-US-ChristopherNeural"
+DEFAULT_TTS_RATE = "2"
+
+
+class AudioCache:
+    def __init__(self, cache_dir, max_bytes, synthesizer, max_registered=256, background_synthesizer=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.synthesizer = synthesizer
+        self.background_synthesizer = background_synthesizer or synthesizer
+        self.max_registered = max_registered
+        self.lock = threading.Lock()
+        # key -> [lock, number of threads holding or waiting for it]
+        self._key_locks = {}
+        # key -> (text, voice, rate) for audio that has been requested but may not be cached yet
+        self._registered = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def cache_key(text, voice=DEFAULT_TTS_VOICE, rate=DEFAULT_TTS_RATE):
+        payload = "\x1f".join([voice, str(rate), text])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key + ".wav")
+
+    def get(self, key):
+        """
+        Return the cached file path for a key (marking it recently used), or None.
+        """
+        path = self.path_for(key)
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            return None
+        return path
+
+    @contextmanager
+    def _key_lock(self, key):
+        # One synthesis per key at a time; the lock is dropped only once nobody holds or waits for it,
+        # so a request arriving meanwhile cannot get a second lock for the same key.
+        with self.lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._key_locks[key]
+
+    def register(self, text, voice=DEFAULT_TTS_VOICE, rate=DEFAULT_TTS_RATE):
+        """
+        Remember the text behind a key so a later stream(key) can synthesize it.
+        """
+        key = self.cache_key(text, voice, rate)
+        with self.lock:
+            self._registered[key] = (text, voice, str(rate))
+            self._registered.move_to_end(key)
+            while len(self._registered) > self.max_registered:
+                self._registered.popitem(last=False)
+        return key
+
+    def is_known(self, key):
+        with self.lock:
+            return key in self._registered or os.path.exists(self.path_for(key))
+
+    def stream(self, key, chunk_size=64 * 1024, background=False):
+        """
+        Yield WAV bytes for a key: from disk when cached, otherwise straight from
+        the synthesizer (the background one with background=True) while the
+        audio is also written to the cache.
+        Raises KeyError for unknown keys and TTSWorkerError if synthesis fails.
+        """
+        path = self.get(key)
+        if path is None:
+            with self.lock:
+                job = self._registered.get(key)
+            if job is None:
+                raise KeyError(key)
+            with self._key_lock(key):
+                # Another request may have cached it while this one waited
+                path = self.get(key)
+                if path is None:
+                    synthesizer = self.background_synthesizer if background else self.synthesizer
+                    yield from self._synthesize_streaming(synthesizer, key, *job)
+                    return
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _synthesize_streaming(self, synthesizer, key, text, voice, rate):
+        # Write to a private file, then publish it atomically with the final sizes in its header.
+        tmp_path = self.path_for(key) + f".{threading.get_ident()}.tmp"
+        data_size = 0
+        completed = False
+        try:
+            audio = synthesizer.stream(text, voice, rate)
+            # Wait for the first audio so a failed or empty synthesis raises before any bytes are sent.
+            first_chunk = next(audio, None)
+            if not first_chunk:
+                raise NoAudioError("The synthesizer returned no audio")
+            with open(tmp_path, "wb") as f:
+                f.write(wav_header(0))
+                yield wav_header() + first_chunk
+                f.write(first_chunk)
+                data_size += len(first_chunk)
+                for chunk in audio:
+                    f.write(chunk)
+                    data_size += len(chunk)
+                    yield chunk
+                f.seek(0)
+                f.write(wav_header(data_size))
+            os.replace(tmp_path, self.path_for(key))
+            completed = True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if completed:
+            self.evict(keep=key)
+
+    def synthesize(self, text, voice=DEFAULT_TTS_VOICE, rate=DEFAULT_TTS_RATE, background=False):
+        """
+        Return the cache key for the text, synthesizing it first if it is not cached.
+        Concurrent requests for the same key wait for a single synthesis.
+        Raises TTSWorkerError if synthesis fails.
+        """
+        key = self.register(text, voice, rate)
+        for _ in self.stream(key, background=background):
+            pass
+        return key
+
+    def evict(self, keep=None):
+        with self.lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".wav"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if keep and os.path.basename(path) == keep + ".wav":
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+
+########################################
+# Background pre-synthesis of upcoming records
+########################################
+class PrefetchWorker:
+    def __init__(self, cache, max_pending=50):
+        self.cache = cache
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def enqueue(self, text, voice=DEFAULT_TTS_VOICE, rate=DEFAULT_TTS_RATE):
+        """
+        Queue a text for synthesis unless it is cached or already queued.
+        Returns True if a job was queued.
+        """
+        if not text:
+            return False
+        key = self.cache.cache_key(text, voice, rate)
+        with self.lock:
+            if key in self.pending or self.cache.get(key):
+                return False
+            try:
+                self.jobs.put_nowait((key, text, voice, rate))
+            except queue.Full:
+                return False
+            self.pending.add(key)
+        self.start()
+        return True
+
+    def _run(self):
+        while True:
+            key, text, voice, rate = self.jobs.get()
+            try:
+                self.cache.synthesize(text, voice, rate, background=True)
+            except (TTSWorkerError, OSError) as e:
+                print(f"Prefetch synthesis failed: {e}")
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                self.jobs.task_done()
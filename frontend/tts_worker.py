@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import queue
+import base64
+import struct
+import threading
+import itertools
+from subprocess import Popen, PIPE
+
+########################################
+# Client for the long-lived TTS worker (tts-worker.js)
+#
+# The worker process is started once and kept warm. Jobs are written to its
+# stdin as JSON lines tagged with a request id; a reader thread routes the
+# audio chunks it writes back on stdout to the waiting request, so callers
+# can stream audio while synthesis is still running.
+#
+# Set TTS_WORKER=fake to use fake_tts_worker.py, which speaks the same
+# protocol and generates a tone locally without Azure credentials.
+########################################
+SAMPLE_RATE = 24000
+BITS_PER_SAMPLE = 16
+CHANNELS = 1
+
+
+class TTSWorkerError(Exception):
+    pass
+
+
+class NoAudioError(TTSWorkerError):
+    """
+    Synthesis finished without producing any audio.
+    """
+
+
+def wav_header(data_size=None):
+    """
+    Build a 44-byte PCM WAV header. With data_size=None the sizes are set to the
+    maximum, which players treat as "stream until the connection closes".
+    """
+    if data_size is None:
+        data_size = 0xFFFFFFFF - 36
+    byte_rate = SAMPLE_RATE * CHANNELS * BITS_PER_SAMPLE // 8
+    block_align = CHANNELS * BITS_PER_SAMPLE // 8
+    return (
+        b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, CHANNELS, SAMPLE_RATE, byte_rate, block_align, BITS_PER_SAMPLE)
+        + b"data" + struct.pack("<I", data_size)
+    )
+
+
+def default_worker_command(script_dir):
+    if os.getenv("TTS_WORKER", "").lower() == "fake":
+        return [sys.executable, os.path.join(script_dir, "fake_tts_worker.py")]
+    return ["node", "tts-worker.js"]
+
+
+class TTSWorkerClient:
+    def __init__(self, command, cwd, job_timeout=120):
+        self.command = command
+        self.cwd = cwd
+        self.job_timeout = job_timeout
+        self.lock = threading.Lock()
+        self.process = None
+        self.responses = {}
+        self._ids = itertools.count(1)
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+            self.process = Popen(self.command, cwd=self.cwd, stdin=PIPE, stdout=PIPE,
+                                 text=True, encoding="utf-8", bufsize=1)
+            threading.Thread(target=self._read_loop, args=(self.process,), daemon=True).start()
+
+    def _read_loop(self, process):
+        for line in process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"TTS worker: {line}")
+                continue
+            responses = self.responses.get(message.get("id"))
+            if responses is not None:
+                responses.put(message)
+        # The worker exited: fail every request still waiting on it.
+        for responses in list(self.responses.values()):
+            responses.put({"error": "TTS worker exited"})
+
+    def stream(self, text, voice, rate):
+        """
+        Yield raw PCM chunks for the text as the worker produces them.
+        Raises TTSWorkerError if synthesis fails or times out.
+        """
+        self._ensure_started()
+        job_id = str(next(self._ids))
+        responses = queue.Queue()
+        self.responses[job_id] = responses
+        try:
+            job = {"id": job_id, "text": text, "voice": voice, "rate": str(rate)}
+            with self.lock:
+                self.process.stdin.write(json.dumps(job) + "\n")
+                self.process.stdin.flush()
+            while True:
+                try:
+                    message = responses.get(timeout=self.job_timeout)
+                except queue.Empty:
+                    raise TTSWorkerError("Timed out waiting for speech synthesis")
+                if "error" in message:
+                    raise TTSWorkerError(message["error"])
+                if message.get("done"):
+                    return
+                yield base64.b64decode(message["chunk"])
+        except (BrokenPipeError, OSError) as e:
+            raise TTSWorkerError(f"TTS worker unavailable: {e}")
+        finally:
+            self.responses.pop(job_id, None)
+
+    def close(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
@@ -5,30 +5,28 @@ import json
 import os
 import re
 import requests
+import llm_client
+import token_budget
+from engagements import ENGAGEMENT_SECTIONS_FIELD, sections_field
+import prospect_kb
+import scheduler
 from dotenv import load_dotenv
+from sharding import add_shard_argument, in_shard, shard_path
+import profiling
 
 # Load environment variables from .env file.
 load_dotenv()
 
-# API endpoint and key configuration.
-API_URL = "https://api.perplexity.ai/chat/completions"
+# The endpoint (PERPLEXITY_API_URL), key and pooled session live in llm_client.py.
 DEFAULT_MODEL = "sonar-reasoning-pro"
-API_KEY = os.getenv("PERPLEXITY_API_KEY")
-HEADERS = {
-    "Authorization": f"Bearer {API_KEY}",
-    "Content-Type": "application/json"
-}
 
-# Pricing details (in dollars):
+STAGE_NAME = "1perplexity"
+
+# Pricing details (in dollars) are kept with the token budget in token_budget.py:
 #   - Input tokens: cost per 1,000,000 tokens
 #   - Output tokens: cost per 1,000,000 tokens
 #   - Searches: cost per 1,000 searches
-PRICING = {
-    "sonar-reasoning-pro": {"input": 2, "output": 8, "search": 5},
-    "sonar-reasoning":     {"input": 1, "output": 5, "search": 5},
-    "sonar-pro":           {"input": 3, "output": 15, "search": 5},
-    "sonar":               {"input": 1, "output": 1, "search": 5},
-}
+PRICING = token_budget.MODEL_PRICING
 
 def extract_final_answer(text):
     """
@@ -50,14 +48,15 @@ def map_citations(final_text, citations):
         mapping_lines = [f"[{i+1}]: {citation}" for i, citation in enumerate(citations)]
     return "\n".join(mapping_lines)
 
-def perform_query(template, first_name, last_name, title, company, max_tokens, model=DEFAULT_MODEL):
+def perform_query(template, first_name, last_name, title, company, max_tokens, model=DEFAULT_MODEL, email=""):
     """
     Build the prompt from the provided template and contact details,
     call the API, and return a tuple:
        (query_text, final_response, citations, citation_mapping, cost)
     
-    Cost is estimated using a word-count approximation for tokens and a default
-    number of searches (3 for Pro models; 1 for others).
+    Cost uses the token counts and searches reported in the response's usage,
+    falling back to a local tokenizer count and the default number of searches
+    (3 for Pro models; 1 for others). The call is recorded in the token budget.
     """
     query_text = template.format(
         first_name=first_name, last_name=last_name, title=title, company=company
@@ -74,7 +73,7 @@ def perform_query(template, first_name, last_name, title, company, max_tokens, m
         "frequency_penalty": 1,
     }
     try:
-        response = requests.post(API_URL, json=payload, headers=HEADERS)
+        response = llm_client.post_perplexity(payload)
         response.raise_for_status()
         data = response.json()
 
@@ -84,22 +83,19 @@ def perform_query(template, first_name, last_name, title, company, max_tokens, m
         citations = data.get("citations", [])
         usage = data.get("usage", {})
 
-        # Estimate tokens via word count (rough approximation)
-        prompt_tokens = len(query_text.split())
-        completion_tokens = len(final_text.split())
+        # Token counts as billed; a local count if the response has no usage
+        estimated_prompt_tokens = token_budget.count_tokens(query_text, model)
+        prompt_tokens = usage.get("prompt_tokens", estimated_prompt_tokens)
+        completion_tokens = usage.get("completion_tokens", token_budget.count_tokens(raw_text, model))
 
         # Default number of searches:
         # For Pro models (sonar-reasoning-pro, sonar-pro) default to 3; otherwise, default to 1.
-        if model in {"sonar-reasoning-pro", "sonar-pro"}:
-            searches = usage.get("searches", 3)
-        else:
-            searches = usage.get("searches", 1)
+        searches = usage.get("searches", token_budget.expected_searches(model))
 
-        pricing = PRICING.get(model, PRICING[DEFAULT_MODEL])
-        cost_input = (prompt_tokens / 1_000_000) * pricing["input"]
-        cost_output = (completion_tokens / 1_000_000) * pricing["output"]
-        cost_search = (searches / 1000) * pricing["search"]
-        total_cost = cost_input + cost_output + cost_search
+        pricing_model = model if model in PRICING else DEFAULT_MODEL
+        total_cost = token_budget.get_budget().record(
+            STAGE_NAME, email, pricing_model, prompt_tokens, completion_tokens, searches, estimated_prompt_tokens
+        )
 
         citation_mapping = map_citations(final_text, citations)
         return query_text, final_text, citations, citation_mapping, total_cost
@@ -118,6 +114,7 @@ def perform_query(template, first_name, last_name, title, company, max_tokens, m
 #   4. Podcast Engagements
 #   5. Peer-Reviewed Publications
 #   6. Webinar Engagements
+# The answer is also parsed into engagements_combined_sections (engagements.py).
 #
 # "roles_and_responsibilities" supports a custom model.
 #
@@ -177,46 +174,255 @@ QUERY_CONFIGS = {
     },
 }
 
-def search_query(query_type, first_name, last_name, title, company):
+# -------------------------------------------------------------------
+# Delta queries for prospects already in the knowledge base (prospect_kb.py):
+# only what is new since {since}, the date of the last snapshot. The answer
+# is merged into the snapshot. Query types without a delta query run in full.
+# -------------------------------------------------------------------
+DELTA_QUERY_CONFIGS = {
+    "engagements_combined": {
+        "template": (
+            "You are an expert SDR researcher and your job is to perform research.\n"
+            "###Target person###\n"
+            "{first_name} {last_name}, {title}, {company}\n"
+            "###Instructions###\n"
+            "Only report what is new since {since}: items published, held or announced after that date. "
+            "Use the following sections:\n\n"
+            "1. **Casual Publications**: New white papers, blogs, commentaries, news articles, book chapters, trade journals and theses, with a detailed abstract for each.\n\n"
+            "2. **Conference Engagements**: New conferences the person attended or spoke at, summarized in detail.\n\n"
+            "3. **Events Engagements**: New events the person attended or spoke at, summarized in detail.\n\n"
+            "4. **Podcast Engagements**: New podcasts the person participated in, summarized in detail.\n\n"
+            "5. **Peer-Reviewed Publications**: New peer-reviewed publications, with a detailed abstract for each.\n\n"
+            "6. **Webinar Engagements**: New webinars the person attended or spoke at, summarized in detail.\n\n"
+            "If a section has nothing new, output \"No information available\" for it. "
+            "If nothing at all is new, output only \"No new information\"."
+        ),
+        "max_tokens": 2000,
+        "model": "sonar-pro"
+    },
+    "background": {
+        "template": (
+            "You are an expert SDR researcher and your job is to perform research.\n"
+            "###Target person###\n"
+            "{first_name} {last_name}, {title}, {company}\n"
+            "###\n"
+            'Report only what is new since {since} about "{first_name} {last_name}": role changes, new professional contributions, '
+            "collaborations and achievements. Then report news about {company} since {since}: new products/services, "
+            "changes in target market, and recent events.\n"
+            "If nothing is new, output only \"No new information\"."
+        ),
+        "max_tokens": 3000,
+        "model": "sonar-pro"
+    },
+}
+
+def search_query(query_type, first_name, last_name, title, company, model=None, email="", config=None):
     """
     Dispatch the query request based on the query type and return:
        (query_text, response_text, citations, citation_mapping, cost)
+    model overrides the query type's configured model, and config its query config.
     """
-    config = QUERY_CONFIGS.get(query_type)
+    config = config or QUERY_CONFIGS.get(query_type)
     if not config:
         raise ValueError(f"Query type '{query_type}' is not defined.")
     template = config["template"]
     max_tokens = config["max_tokens"]
-    model = config.get("model", DEFAULT_MODEL)
-    return perform_query(template, first_name, last_name, title, company, max_tokens, model)
+    model = model or config.get("model", DEFAULT_MODEL)
+    return perform_query(template, first_name, last_name, title, company, max_tokens, model, email)
+
+def query_plan(contact_info, query_types, delta=True):
+    """
+    (query type, query config, knowledge base snapshot) for each query type:
+    the delta query and the snapshot it builds on when the prospect has
+    recent enough research, otherwise the full query and None. A snapshot
+    from today (e.g. a resumed run) is reused as it is, with config None.
+    """
+    kb = prospect_kb.get_kb()
+    plan = []
+    for qt in query_types:
+        snapshot = None
+        if delta:
+            latest = kb.latest(contact_info["Email"], contact_info.get("Person Linkedin Url"), qt)
+            if latest and latest["researched_at"] == prospect_kb.today():
+                plan.append((qt, None, latest))
+                continue
+        if delta and qt in DELTA_QUERY_CONFIGS:
+            snapshot = kb.delta_base(contact_info["Email"], contact_info.get("Person Linkedin Url"), qt)
+        if snapshot is None:
+            plan.append((qt, QUERY_CONFIGS[qt], None))
+            continue
+        config = dict(DELTA_QUERY_CONFIGS[qt])
+        config["template"] = config["template"].replace("{since}", snapshot["researched_at"])
+        plan.append((qt, config, snapshot))
+    return plan
+
+def planned_calls(configs, first_name, last_name, title, company):
+    """
+    (model, prompt tokens, max tokens) of each query config for the token budget.
+    """
+    calls = []
+    for config in configs:
+        if config is None:
+            continue
+        model = config.get("model", DEFAULT_MODEL)
+        query_text = config["template"].format(
+            first_name=first_name, last_name=last_name, title=title, company=company
+        )
+        calls.append((model, token_budget.count_tokens(query_text, model), config["max_tokens"]))
+    return calls
+
+CONTACT_FIELDS = ["Email", "Person Linkedin Url", "First Name", "Last Name", "Title", "Company", "Website", "Company Linkedin Url", "Facebook Url"]
+
+def get_output_fields(query_types, output_fields=""):
+    """
+    The output columns: the given comma-separated list, or the contact fields
+    followed by the response, citations, mapping and cost of each query type.
+    """
+    if output_fields:
+        return [field.strip() for field in output_fields.split(",")]
+    additional_fields = []
+    for qt in query_types:
+        additional_fields.extend([qt, f"{qt}_citations", f"{qt}_citation_mapping", f"{qt}_cost"])
+        if qt == "engagements_combined":
+            additional_fields.append(ENGAGEMENT_SECTIONS_FIELD)
+    additional_fields.append("Total_Cost")
+    return CONTACT_FIELDS + additional_fields
 
-def process_contacts(input_csv, output_csv, output_fields, query_types, skip, limit):
+def contact_from_row(row):
+    """
+    The contact fields of an input CSV row, stripped.
+    """
+    return {field: (row.get(field) or "").strip() for field in CONTACT_FIELDS}
+
+def research_query(contact_info, qt, config, snapshot, model):
+    """
+    Run one query for a contact and return (response_text, citations, cost).
+    With a snapshot, the delta answer is merged into the snapshot's research.
+    The research is stored in the knowledge base.
+    """
+    email = contact_info["Email"]
+    linkedin_url = contact_info.get("Person Linkedin Url", "")
+    first_name = contact_info["First Name"]
+    last_name = contact_info["Last Name"]
+    title = contact_info["Title"]
+    company = contact_info["Company"]
+    if snapshot:
+        print(f"Searching for '{qt}' since {snapshot['researched_at']} for {first_name} {last_name} | {title} at {company}")
+    else:
+        print(f"Searching for '{qt}' for {first_name} {last_name} | {title} at {company}")
+    # We no longer store the raw query text.
+    _, response_text, citations, _, cost = search_query(
+        qt, first_name, last_name, title, company, model, email, config
+    )
+    kb = prospect_kb.get_kb()
+    if snapshot is None:
+        if response_text:
+            kb.store(email, linkedin_url, qt, response_text, citations, prospect_kb.FULL)
+        return response_text, citations, cost
+    if not response_text:
+        # The delta query failed: keep the snapshot's research
+        return snapshot["text"], snapshot["citations"], cost
+    response_text, citations = prospect_kb.merge_research(
+        qt, snapshot["text"], snapshot["citations"], response_text, citations, snapshot["researched_at"])
+    kb.store(email, linkedin_url, qt, response_text, citations, prospect_kb.DELTA,
+             full_research_at=snapshot["full_research_at"])
+    return response_text, citations, cost
+
+def research_contact(contact_info, query_types, delta=True):
+    """
+    Run each query type for one contact and return the output record:
+    the contact fields plus every query's results and the summed cost.
+    Prospects with research in the knowledge base get delta queries merged
+    into it (with delta=False every query runs in full); every answer is
+    stored as a new snapshot. Research already done today is reused.
+
+    Raises token_budget.BudgetExceeded if the queries do not fit the budget,
+    even with cheaper models.
+    """
+    contact_info = dict(contact_info)
+    email = contact_info["Email"]
+    first_name = contact_info["First Name"]
+    last_name = contact_info["Last Name"]
+    title = contact_info["Title"]
+    company = contact_info["Company"]
+    plan = query_plan(contact_info, query_types, delta)
+    substitutions = token_budget.get_budget().admit_or_raise(
+        STAGE_NAME, email, planned_calls([config for _, config, _ in plan], first_name, last_name, title, company)
+    )
+    total_cost = 0.0
+    for qt, config, snapshot in plan:
+        if config is None:
+            print(f"Reusing today's '{qt}' research for {first_name} {last_name} | {title} at {company}")
+            response_text, citations, cost = snapshot["text"], snapshot["citations"], 0.0
+        else:
+            model = config.get("model", DEFAULT_MODEL)
+            response_text, citations, cost = research_query(
+                contact_info, qt, config, snapshot, substitutions.get(model, model))
+        contact_info[qt] = response_text
+        contact_info[f"{qt}_citations"] = "; ".join(citations) if citations else ""
+        contact_info[f"{qt}_citation_mapping"] = map_citations(response_text, citations)
+        contact_info[f"{qt}_cost"] = f"${cost:.5f}"
+        if qt == "engagements_combined":
+            # The sections with content, each with its citations (engagements.py)
+            contact_info[ENGAGEMENT_SECTIONS_FIELD] = sections_field(response_text, citations)
+        total_cost += cost
+        print(f"Processed '{qt}' for {email} at an estimated cost of ${cost:.5f}")
+    contact_info["Total_Cost"] = f"${total_cost:.5f}"
+    return contact_info
+
+def read_rows(input_csvs):
+    # The rows of the input CSVs in file order, with the index of their CSV
+    for n, path in enumerate(input_csvs):
+        with open(path, newline="", encoding="utf-8") as infile:
+            for row in csv.DictReader(infile):
+                yield n, row
+
+def contact_rows(input_csvs, skip, priority=None, weights=None):
+    """
+    The rows of the input CSVs in the order they are worked through, after
+    the first `skip` of that order: streamed in file order, or with a
+    priority config, each list by priority and the lists interleaved by
+    their weights (scheduler.py). The order is the same on every run with
+    the same inputs, so a --priority run resumes with the same --skip as a
+    file-order one.
+    """
+    if priority is None:
+        return (row for i, (_, row) in enumerate(read_rows(input_csvs)) if i >= skip)
+    lists = [[] for _ in input_csvs]
+    for n, row in read_rows(input_csvs):
+        lists[n].append(row)
+    return scheduler.schedule(list(zip(weights or [1.0] * len(lists), lists)), priority)[skip:]
+
+def process_contacts(input_csv, output_csv, output_fields, query_types, skip, limit, shard=None, delta=True,
+                     priority=None, weights=None):
     """
     Read the input CSV of contacts, run each specified query for every contact,
     sum the cost for all queries per record, and write each record immediately
     to both a CSV file and a JSON Lines file.
     
-    Only process records after skipping the first `skip` rows and up to `limit` records.
+    Only process records after skipping the first `skip` rows (in the order
+    they are processed, see contact_rows) and up to `limit` records.
+    With a shard (i, N), contacts outside shard i are skipped. With
+    delta=False the knowledge base is not used for delta queries.
+    input_csv may be a list of CSVs; with a priority config they are worked
+    through by priority and weight (see contact_rows).
     """
+    input_csvs = [input_csv] if isinstance(input_csv, str) else list(input_csv)
     # Determine the JSON output filename (JSON Lines format).
     json_filename = output_csv[:-4] + ".jsonl" if output_csv.lower().endswith(".csv") else output_csv + ".jsonl"
 
     processed_count = 0
 
-    with open(input_csv, newline="", encoding="utf-8") as infile, \
-         open(output_csv, mode="a", newline="", encoding="utf-8") as csvfile, \
+    with open(output_csv, mode="a", newline="", encoding="utf-8") as csvfile, \
          open(json_filename, mode="a", encoding="utf-8") as jsonfile:
         
-        reader = csv.DictReader(infile)
         writer = csv.DictWriter(csvfile, fieldnames=output_fields)
 
         # Write header only if file is empty.
         if csvfile.tell() == 0:
             writer.writeheader()
         
-        for i, row in enumerate(reader):
-            if i < skip:
-                continue
+        for row in contact_rows(input_csvs, skip, priority, weights):
             if limit is not None and processed_count >= limit:
                 print("Reached processing limit.")
                 break
@@ -225,41 +431,14 @@ def process_contacts(input_csv, output_csv, output_fields, query_types, skip, li
             if not email:
                 print("Skipping row with missing Email")
                 continue
+            if not in_shard({"Email": email}, shard):
+                continue
 
-            first_name = row.get("First Name", "").strip()
-            last_name = row.get("Last Name", "").strip()
-            title = row.get("Title", "").strip()
-            company = row.get("Company", "").strip()
-            linkedin_url = row.get("Person Linkedin Url", "").strip()
-            website = row.get("Website", "").strip()
-            company_linkedin_url = row.get("Company Linkedin Url", "").strip()
-            facebook_url = row.get("Facebook Url", "").strip()
-
-            contact_info = {
-                "Email": email,
-                "Person Linkedin Url": linkedin_url,
-                "First Name": first_name,
-                "Last Name": last_name,
-                "Title": title,
-                "Company": company,
-                "Website": website,
-                "Company Linkedin Url": company_linkedin_url,
-                "Facebook Url": facebook_url,
-            }
-            total_cost = 0.0
-            for qt in query_types:
-                print(f"Searching for '{qt}' for {first_name} {last_name} | {title} at {company}")
-                # We no longer store the raw query text.
-                _, response_text, citations, citation_mapping, cost = search_query(
-                    qt, first_name, last_name, title, company
-                )
-                contact_info[qt] = response_text
-                contact_info[f"{qt}_citations"] = "; ".join(citations) if citations else ""
-                contact_info[f"{qt}_citation_mapping"] = citation_mapping
-                contact_info[f"{qt}_cost"] = f"${cost:.5f}"
-                total_cost += cost
-                print(f"Processed '{qt}' for {email} at an estimated cost of ${cost:.5f}")
-            contact_info["Total_Cost"] = f"${total_cost:.5f}"
+            try:
+                contact_info = research_contact(contact_from_row(row), query_types, delta)
+            except token_budget.BudgetExceeded as e:
+                print(f"Budget reached, not admitting more contacts: {e}")
+                break
             
             # Write record immediately to CSV and JSON Lines file.
             writer.writerow(contact_info)
@@ -281,8 +460,10 @@ def parse_args():
     parser.add_argument(
         "--input-csv",
         type=str,
-        default=os.path.join(os.path.dirname(__file__), "../../input/apollo-contacts-export.csv"),
-        help="Path to the input CSV file containing contact data.",
+        nargs="+",
+        default=[os.path.join(os.path.dirname(__file__), "../../input/apollo-contacts-export.csv")],
+        help="Path to the input CSV file containing contact data (several lists are processed one after "
+             "another, or together with --priority).",
     )
     parser.add_argument(
         "--output-csv",
@@ -307,7 +488,8 @@ def parse_args():
         "--skip",
         type=int,
         default=0,
-        help="Number of records to skip from the beginning (for resuming processing).",
+        help="Number of records to skip from the beginning (for resuming processing). With --priority "
+             "they are counted in priority order, so resume with the same inputs and options.",
     )
     parser.add_argument(
         "--limit",
@@ -315,6 +497,19 @@ def parse_args():
         default=None,
         help="Maximum number of records to process in this run.",
     )
+    parser.add_argument(
+        "--full-research",
+        action="store_true",
+        help="Run the full queries even for prospects in the knowledge base (the results are still stored).",
+    )
+    scheduler.add_priority_arguments(parser)
+    parser.add_argument(
+        "--weights",
+        type=str,
+        default="",
+        help="With --priority and several input CSVs: comma-separated share of the work per list (default: equal).",
+    )
+    add_shard_argument(parser)
     return parser.parse_args()
 
 def main():
@@ -325,17 +520,13 @@ def main():
         print("No valid query types provided. Exiting.")
         return
 
-    if args.output_fields:
-        output_fields = [field.strip() for field in args.output_fields.split(",")]
-    else:
-        base_fields = ["Email", "Person Linkedin Url", "First Name", "Last Name", "Title", "Company", "Website", "Company Linkedin Url", "Facebook Url"]
-        additional_fields = []
-        for qt in query_types:
-            additional_fields.extend([qt, f"{qt}_citations", f"{qt}_citation_mapping", f"{qt}_cost"])
-        additional_fields.append("Total_Cost")
-        output_fields = base_fields + additional_fields
+    output_fields = get_output_fields(query_types, args.output_fields)
 
-    process_contacts(args.input_csv, args.output_csv, output_fields, query_types, args.skip, args.limit)
+    output_csv = shard_path(args.output_csv, args.shard)
+    priority = scheduler.priority_from_args(args)
+    weights = scheduler.parse_weights(args.weights, len(args.input_csv))
+    process_contacts(args.input_csv, output_csv, output_fields, query_types, args.skip, args.limit, args.shard,
+                     delta=not args.full_research, priority=priority, weights=weights)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    profiling.run("1perplexity", main)
\ No newline at end of file
@@ -5,9 +5,17 @@ import pandas as pd
 import csv
 from glob import glob
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+import llm_client
+import token_budget
+import fused_prompts
+import engagements
+import passage_index
+import scheduler
 import time
 import json
+from fingerprints import compute_fingerprint, fingerprint_key, is_stale
+from sharding import add_shard_argument, in_shard, shard_path
+import profiling
 
 # Load .env variables
 load_dotenv()
@@ -40,6 +48,10 @@ output_name = os.path.join(script_dir, "../../output/2final_combined_research_re
 ########################################
 # Prompt Config 
 ########################################
+# Steps with a "retrieval" entry get only the research passages that match
+# the listed query variables, under max_tokens (passage_index.py)
+RESEARCH_FIELDS = ["engagements_combined", "background", "roles_and_responsibilities"]
+
 PROMPT_CONFIGS = [
     {
         "name": "company_background",
@@ -53,7 +65,8 @@ PROMPT_CONFIGS = [
         "prompt_path": os.path.join(script_dir, "../../src/prompts/most_relevant_topic.txt"),
         "model_name": "o3-mini",
         "output_key": "most_relevant_topic",
-        "max_completion_tokens": 10000 
+        "max_completion_tokens": 10000 ,
+        "retrieval": {"fields": RESEARCH_FIELDS, "query": ["offering", "current_focus"], "top_k": 8, "max_tokens": 1500}
     },
     {
         "name": "researching_topic",
@@ -67,14 +80,16 @@ PROMPT_CONFIGS = [
         "prompt_path": os.path.join(script_dir, "../../src/prompts/relevant_painpoint.txt"),
         "model_name": "o3-mini",
         "output_key": "relevant_painpoint",
-        "max_completion_tokens": 10000 
+        "max_completion_tokens": 10000 ,
+        "retrieval": {"fields": RESEARCH_FIELDS, "query": ["current_focus", "researching_topic", "most_relevant_topic"], "top_k": 8, "max_tokens": 1500}
     },
     {
         "name": "why_them",
         "prompt_path": os.path.join(script_dir, "../../src/prompts/why_them.txt"),
         "model_name": "o1",
         "output_key": "why_them",
-        "max_completion_tokens": 10000 
+        "max_completion_tokens": 10000 ,
+        "retrieval": {"fields": RESEARCH_FIELDS, "query": ["current_focus", "most_relevant_topic", "relevant_painpoint"], "top_k": 8, "max_tokens": 1500}
     },
     {
         "name": "email_body",
@@ -106,23 +121,27 @@ PROMPT_CONFIGS = [
     }
 ]
 
-########################################
-# Pricing details (per 1,000,000 tokens)
-########################################
-PRICING = {
-    "o1": {
-        "input": 5.00,
-        "output": 20.00,
-    },
-    "o3-mini": {
-        "input": 1.10,
-        "output": 4.40,
+# Steps that --fused runs as one structured-output request (see fused_prompts.py)
+FUSED_GROUPS = [
+    {
+        "name": "email_fused",
+        "steps": ["email_body", "email_output_final"],
+        "model_name": "o1",
+        "max_completion_tokens": 10000
     },
-    "gpt-4o": {
-        "input": 2.50,
-        "output": 10.00,
+    {
+        "name": "email_subject_fused",
+        "steps": ["email_subject", "email_subject_extract"],
+        "model_name": "o3-mini",
+        "max_completion_tokens": 4000
     }
-}
+]
+
+########################################
+# Pricing details (per 1,000,000 tokens), shared with the token budget
+########################################
+PRICING = token_budget.MODEL_PRICING
+STAGE_NAME = "3email_generation"
 
 # Rate limit delays (in seconds) computed from requests per minute limits.
 RATE_LIMIT_DELAYS = {
@@ -146,85 +165,16 @@ def get_prompt(template: str, variables: dict) -> str:
     return prompt
 
 ########################################
-# Helper: Call Azure OpenAI with token usage tracking
+# Helper: Call Azure OpenAI with token usage tracking (shared pooled client, llm_client.py)
 ########################################
-API_KEY     = os.getenv("OPENAI_API_KEY")
-API_BASE    = os.getenv("AZURE_ENDPOINT")
-API_VERSION = "2024-12-01-preview"
-
-
-def call_azure(model_name: str, prompt_text: str, max_tokens: int,
-               reasoning_effort_o1: str = "high", reasoning_effort_o3mini: str = "medium",
-               request_timeout_o1: int = 600, request_timeout_o3mini: int = 6000, request_timeout_gpt4o: int = 600) -> (str, dict):
-    client = AzureOpenAI(
-        azure_endpoint=API_BASE,
-        api_key=API_KEY,
-        api_version=API_VERSION
-    )
-
-    extra_params = {}  # default extra parameters
-    req_timeout = None
-
-    if model_name.startswith("o1"):
-        extra_params["reasoning_effort"] = reasoning_effort_o1
-        req_timeout = request_timeout_o1
-    elif model_name.startswith("o3-mini"):
-        extra_params["reasoning_effort"] = reasoning_effort_o3mini
-        req_timeout = request_timeout_o3mini
-    elif model_name.startswith("gpt-4o"):
-        req_timeout = request_timeout_gpt4o
-    else:
-        req_timeout = 60
-
-    messages = [
-        {
-            "role": "system",
-            "content": "You are an early stage entrepreneur reaching out to people to conduct needs assessment."
-        },
-        {"role": "user", "content": prompt_text},
-    ]
+REASONING_EFFORT = {"o1": "high", "o3-mini": "medium"}
 
-    try:
-        if model_name.startswith("gpt-4o"):
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                timeout=req_timeout,
-                **extra_params
-            )
-        else:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                max_completion_tokens=max_tokens,
-                timeout=req_timeout,
-                **extra_params
-            )
-    except TypeError as e:
-        if "reasoning_effort" in str(e):
-            extra_params.pop("reasoning_effort", None)
-            if model_name.startswith("gpt-4o"):
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    timeout=req_timeout
-                )
-            else:
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    max_completion_tokens=max_tokens,
-                    timeout=req_timeout,
-                    **extra_params
-                )
-        else:
-            raise e
-
-    content = response.choices[0].message.content.strip()
-    usage = response.usage if hasattr(response, "usage") else {}
-    if hasattr(usage, "dict"):
-        usage = usage.dict()
-    return content, usage
+def call_azure(model_name: str, prompt_text: str, max_tokens: int, response_format: dict = None) -> (str, dict):
+    # gpt-4o steps run without a token limit
+    if model_name.startswith("gpt-4o"):
+        max_tokens = None
+    return llm_client.call_azure(model_name, prompt_text, max_tokens, reasoning_effort=REASONING_EFFORT,
+                                 response_format=response_format)
 
 
 ########################################
@@ -233,7 +183,8 @@ def call_azure(model_name: str, prompt_text: str, max_tokens: int,
 def calculate_cost(record):
     total_cost = 0.0
     for cfg in PROMPT_CONFIGS:
-        model = cfg["model_name"]
+        # A step run on a cheaper model to stay within budget records it in <key>_model
+        model = record.get(f"{cfg['output_key']}_model") or cfg["model_name"]
         pricing = PRICING.get(model)
         if not pricing:
             continue
@@ -253,7 +204,16 @@ def parse_args():
     parser.add_argument("--input-csv", type=str, default=input_name)
     parser.add_argument("--output-csv", type=str, default=f"{output_name}.csv")
     parser.add_argument("--output-json", type=str, default=f"{output_name}.json")
-    return parser.parse_args()
+    parser.add_argument("--fused", action="store_true",
+                        help="Run the FUSED_GROUPS steps as one structured-output request each.")
+    parser.add_argument("--no-retrieval", dest="retrieval", action="store_false",
+                        help="Give every step the full research fields instead of the retrieved passages.")
+    scheduler.add_priority_arguments(parser)
+    add_shard_argument(parser)
+    args = parser.parse_args()
+    args.output_csv = shard_path(args.output_csv, args.shard)
+    args.output_json = shard_path(args.output_json, args.shard)
+    return args
 
 ########################################
 # Append a record to CSV (filtered to desired columns)
@@ -286,6 +246,226 @@ def get_desired_columns(df):
     ]
     return desired_cols
 
+########################################
+# Helpers: Load variables and prompt templates
+########################################
+def load_global_vars() -> dict:
+    vars_paths = glob(os.path.join(script_dir, "../../src/variables/*"))
+    global_vars = {}
+    for v in vars_paths:
+        with open(v, "r", encoding="utf-8") as f:
+            key = os.path.basename(v).split(".")[0].strip()
+            global_vars[key] = f.read().strip()
+    return global_vars
+
+def prompt_variables(record: dict, global_vars: dict) -> dict:
+    """
+    The variables the prompts are formatted with: the record's fields and the
+    global variables, with {engagements_combined} reduced to the engagement
+    sections that have content (engagements.py).
+    """
+    prompt_vars = dict(record)
+    prompt_vars.update(global_vars)
+    prompt_vars["engagements_combined"] = engagements.prompt_text(record)
+    return prompt_vars
+
+def load_prompt_templates(prompt_configs: list) -> dict:
+    prompt_templates = {}
+    for cfg in prompt_configs:
+        with open(cfg["prompt_path"], "r", encoding="utf-8") as f:
+            prompt_templates[cfg["name"]] = f.read()
+    return prompt_templates
+
+########################################
+# Helper: Run the prompt chain for a single record
+#
+# Each generated field is stored with a fingerprint of its template, model,
+# parameters and inputs. With only_stale=True, steps whose stored fingerprint
+# still matches are skipped, so only changed nodes and their dependents rerun.
+#
+# With fused=True the FUSED_GROUPS run as one structured-output request each
+# (fused_prompts.py); outputs that fail validation fall back to running
+# their steps one by one. Fused outputs carry the group's fingerprint, so a
+# run without --fused sees them as stale, and the other way round.
+#
+# Steps with a "retrieval" config are formatted and fingerprinted with the
+# retrieved passages in place of the research fields (passage_index.py), so
+# a run with --no-retrieval sees them as stale, and the other way round.
+# Fused groups do not use retrieval.
+########################################
+def step_params(cfg: dict) -> dict:
+    return {"max_completion_tokens": cfg.get("max_completion_tokens", 4000)}
+
+def step_variables(cfg: dict, prompt_vars: dict, retrieval: bool = True) -> dict:
+    if not retrieval or not cfg.get("retrieval"):
+        return prompt_vars
+    return passage_index.apply_retrieval(prompt_vars, cfg["retrieval"], cfg["model_name"])
+
+def step_fingerprint(cfg: dict, template: str, prompt_vars: dict, model_name: str = None,
+                     retrieval: bool = True) -> str:
+    return compute_fingerprint(template, model_name or cfg["model_name"], step_params(cfg),
+                               step_variables(cfg, prompt_vars, retrieval))
+
+def execution_units(fused: bool = False) -> list:
+    return fused_prompts.execution_units(PROMPT_CONFIGS, FUSED_GROUPS if fused else [])
+
+def unit_template(unit: dict, prompt_templates: dict) -> str:
+    if unit["fused"]:
+        return fused_prompts.fused_template(unit["configs"], prompt_templates)
+    return prompt_templates[unit["name"]]
+
+def unit_variables(unit: dict, prompt_vars: dict, retrieval: bool = True) -> dict:
+    if unit["fused"]:
+        return prompt_vars
+    return step_variables(unit["configs"][0], prompt_vars, retrieval)
+
+def unit_fingerprint(unit: dict, template: str, prompt_vars: dict, model_name: str = None,
+                     retrieval: bool = True) -> str:
+    if not unit["fused"]:
+        return step_fingerprint(unit["configs"][0], template, prompt_vars, model_name, retrieval)
+    params = {"max_completion_tokens": unit["max_completion_tokens"],
+              "outputs": [cfg["output_key"] for cfg in unit["configs"]]}
+    return compute_fingerprint(template, model_name or unit["model_name"], params, prompt_vars)
+
+def unit_is_stale(record: dict, unit: dict, fingerprint: str) -> bool:
+    return any(is_stale(record, cfg["output_key"], fingerprint) for cfg in unit["configs"])
+
+def plan_steps(record: dict, prompt_templates: dict, prompt_vars: dict, only_stale: bool, units: list,
+               retrieval: bool = True) -> list:
+    """
+    (model, estimated prompt tokens, max tokens) of the requests expected to
+    run, for the token budget. Outputs of planned requests that later prompts
+    use are counted at their expected length; with only_stale, a request is
+    planned when it is stale or uses the output of a planned request.
+    """
+    budget = token_budget.get_budget()
+    pending = {}
+    calls = []
+    for unit in units:
+        template = unit_template(unit, prompt_templates)
+        model_name = unit["model_name"]
+        uses_pending = any("{" + name + "}" in template for name in pending)
+        if only_stale and not uses_pending and not unit_is_stale(
+                record, unit, unit_fingerprint(unit, template, prompt_vars, retrieval=retrieval)):
+            continue
+        max_tokens = None if model_name.startswith("gpt-4o") else unit["max_completion_tokens"]
+        unit_vars = unit_variables(unit, prompt_vars, retrieval)
+        calls.append((model_name, token_budget.estimate_prompt_tokens(template, unit_vars, model_name, pending), max_tokens))
+        for cfg in unit["configs"]:
+            pending[cfg["output_key"]] = budget.expected_output_tokens(STAGE_NAME, model_name, max_tokens)
+    return calls
+
+def store_output(record: dict, cfg: dict, result: str, usage: dict, model_name: str, fingerprint: str):
+    key = cfg["output_key"]
+    record[key] = result
+    record[f"{key}_prompt_tokens"] = usage.get("prompt_tokens", 0)
+    record[f"{key}_completion_tokens"] = usage.get("completion_tokens", 0)
+    record[f"{key}_total_tokens"] = usage.get("total_tokens", 0)
+    if model_name != cfg["model_name"]:
+        record[f"{key}_model"] = model_name
+    else:
+        record.pop(f"{key}_model", None)
+    record[fingerprint_key(key)] = fingerprint
+
+def run_step(record: dict, cfg: dict, template: str, prompt_vars: dict, substitutions: dict, retrieval: bool = True):
+    email = record.get("Email")
+    prompt_text = get_prompt(template, step_variables(cfg, prompt_vars, retrieval))
+    model_name = substitutions.get(cfg["model_name"], cfg["model_name"])
+    max_tokens = step_params(cfg)["max_completion_tokens"]
+
+    print(f"Running prompt {cfg['name']} for record {email}")
+    result, usage = call_azure(model_name, prompt_text, max_tokens)
+    print(f"Done running prompt {cfg['name']} for record {email}")
+
+    token_budget.get_budget().record(STAGE_NAME, email, model_name, usage.get("prompt_tokens", 0),
+                                     usage.get("completion_tokens", 0),
+                                     estimated_prompt_tokens=token_budget.count_tokens(prompt_text, model_name))
+    # Fingerprinted with the model actually used, so a downgraded step is stale against the configured model
+    store_output(record, cfg, result, usage, model_name,
+                 step_fingerprint(cfg, template, prompt_vars, model_name, retrieval))
+    prompt_vars[cfg["output_key"]] = result
+
+    delay = RATE_LIMIT_DELAYS.get(model_name, 0)
+    time.sleep(delay)
+
+def run_fused(record: dict, unit: dict, template: str, prompt_vars: dict, substitutions: dict) -> dict:
+    """
+    Run a fused group as one structured-output request and store the outputs
+    that validate; returns them by output key.
+    """
+    email = record.get("Email")
+    configs = unit["configs"]
+    prompt_text = get_prompt(template, prompt_vars)
+    model_name = substitutions.get(unit["model_name"], unit["model_name"])
+    fingerprint = unit_fingerprint(unit, template, prompt_vars, model_name)
+
+    print(f"Running fused prompt {unit['name']} for record {email}")
+    content, usage = call_azure(model_name, prompt_text, unit["max_completion_tokens"],
+                                response_format=fused_prompts.response_format(unit["name"], configs))
+    print(f"Done running fused prompt {unit['name']} for record {email}")
+
+    token_budget.get_budget().record(STAGE_NAME, email, model_name, usage.get("prompt_tokens", 0),
+                                     usage.get("completion_tokens", 0),
+                                     estimated_prompt_tokens=token_budget.count_tokens(prompt_text, model_name))
+    outputs = fused_prompts.parse_outputs(content, configs)
+    for i, cfg in enumerate(configs):
+        if cfg["output_key"] not in outputs:
+            break
+        # The request's tokens are counted once, on the group's first step
+        store_output(record, cfg, outputs[cfg["output_key"]], usage if i == 0 else {}, model_name, fingerprint)
+        prompt_vars[cfg["output_key"]] = outputs[cfg["output_key"]]
+
+    delay = RATE_LIMIT_DELAYS.get(model_name, 0)
+    time.sleep(delay)
+    return outputs
+
+def process_record(record: dict, prompt_templates: dict, global_vars: dict, only_stale: bool = False,
+                   fused: bool = False, retrieval: bool = True) -> list:
+    """
+    Run the prompt chain for one record and return the names of the steps
+    (and fused groups) run. Raises token_budget.BudgetExceeded if the steps
+    do not fit the budget, even with cheaper models. With retrieval=False
+    every step gets the full research fields.
+    """
+    prompt_vars = prompt_variables(record, global_vars)
+    units = execution_units(fused)
+    substitutions = token_budget.get_budget().admit_or_raise(
+        STAGE_NAME, record.get("Email"), plan_steps(record, prompt_templates, prompt_vars, only_stale, units, retrieval))
+    ran_steps = []
+    for unit in units:
+        template = unit_template(unit, prompt_templates)
+        if only_stale and not unit_is_stale(record, unit, unit_fingerprint(unit, template, prompt_vars, retrieval=retrieval)):
+            for cfg in unit["configs"]:
+                prompt_vars[cfg["output_key"]] = record[cfg["output_key"]]
+            continue
+
+        remaining = unit["configs"]
+        if unit["fused"]:
+            outputs = run_fused(record, unit, template, prompt_vars, substitutions)
+            ran_steps.append(unit["name"])
+            remaining = [cfg for cfg in unit["configs"] if cfg["output_key"] not in outputs]
+            if remaining:
+                print(f"Fused prompt {unit['name']} gave no valid {', '.join(cfg['output_key'] for cfg in remaining)}; "
+                      f"running those steps one by one")
+        for cfg in remaining:
+            run_step(record, cfg, prompt_templates[cfg["name"]], prompt_vars, substitutions, retrieval)
+            ran_steps.append(cfg["name"])
+
+    record["total_cost"] = calculate_cost(record)
+    return ran_steps
+
+########################################
+# Helper: Load the stage 1 research records
+########################################
+def load_input_records(input_path: str) -> list:
+    # Check file extension and read accordingly
+    ext = os.path.splitext(input_path)[1].lower()
+    if ext == ".json":
+        df = pd.read_json(input_path)
+    else:
+        df = pd.read_csv(input_path)
+    return df.to_dict("records")
+
 ########################################
 # Main
 ########################################
@@ -293,63 +473,34 @@ def main():
     args = parse_args()
     limit = records_limit_value
 
-    # Check file extension and read accordingly
-    ext = os.path.splitext(args.input_csv)[1].lower()
-    if ext == ".json":
-        df = pd.read_json(args.input_csv)
-    else:
-        df = pd.read_csv(args.input_csv)
-    
-    all_records = df.to_dict("records")
+    all_records = load_input_records(args.input_csv)
 
     processed_emails = set()
     if os.path.exists(args.output_csv):
         processed_df = pd.read_csv(args.output_csv)
         processed_emails = set(processed_df["Email"])
-    records = [r for r in all_records if r.get("Email") not in processed_emails]
+    records = [r for r in all_records if r.get("Email") not in processed_emails and in_shard(r, args.shard)]
+    priority = scheduler.priority_from_args(args)
+    if priority is not None:
+        # Highest-priority contacts first (scheduler.py); the output keeps the order records finish in
+        records = scheduler.order_by_priority(records, priority)
     
     if limit is not None:
         records = records[:limit]
 
-    vars_paths = glob(os.path.join(script_dir, "../../src/variables/*"))
-    global_vars = {}
-    for v in vars_paths:
-        with open(v, "r", encoding="utf-8") as f:
-            key = os.path.basename(v).split(".")[0].strip()
-            global_vars[key] = f.read().strip()
-
-    prompt_templates = {}
-    for cfg in PROMPT_CONFIGS:
-        with open(cfg["prompt_path"], "r", encoding="utf-8") as f:
-            prompt_templates[cfg["name"]] = f.read()
+    global_vars = load_global_vars()
+    prompt_templates = load_prompt_templates(PROMPT_CONFIGS)
 
     for record in records:
-        prompt_vars = dict(record)
-        prompt_vars.update(global_vars)
-        for cfg in PROMPT_CONFIGS:
-            template = prompt_templates[cfg["name"]]
-            prompt_text = get_prompt(template, prompt_vars)
-            model_name = cfg["model_name"]
-            max_tokens = cfg.get("max_completion_tokens", 4000)
-            
-            print(f"Running prompt {cfg['name']} for record {record.get('Email')}")
-            result, usage = call_azure(model_name, prompt_text, max_tokens)
-            print(f"Done running prompt {cfg['name']} for record {record.get('Email')}")
-            
-            key = cfg["output_key"]
-            record[key] = result
-            record[f"{key}_prompt_tokens"] = usage.get("prompt_tokens", 0)
-            record[f"{key}_completion_tokens"] = usage.get("completion_tokens", 0)
-            record[f"{key}_total_tokens"] = usage.get("total_tokens", 0)
-            prompt_vars[key] = result
-            
-            delay = RATE_LIMIT_DELAYS.get(model_name, 0)
-            time.sleep(delay)
-
-        record["total_cost"] = calculate_cost(record)
+        try:
+            process_record(record, prompt_templates, global_vars, fused=args.fused, retrieval=args.retrieval)
+        except token_budget.BudgetExceeded as e:
+            # Not an error to retry: stop admitting records until the budget is raised
+            print(f"Budget reached, not admitting more records: {e}")
+            break
         
         # Append the processed record to CSV and JSON
-        append_record(record, args.output_csv, get_desired_columns(df))
+        append_record(record, args.output_csv, get_desired_columns(None))
         append_record_to_json(record, args.output_json)
         
         print(f"Processed record for Email: {record.get('Email')}, Total Cost: ${record['total_cost']:.6f}")
@@ -359,7 +510,7 @@ if __name__ == "__main__":
     delay_index = 0
     while True:
         try:
-            main()  # process all records
+            profiling.run("3email_generation", main)  # process all records
             break  # If main() completes successfully, exit the loop
         except Exception as e:
             print(f"An error occurred: {e}")
@@ -1,6 +1,7 @@
 import re
-import json
 import os
+import profiling
+from jsonstream import iter_records, ArrayWriter
 
 def parse_citation_mapping(mapping_str):
     """
@@ -74,42 +75,38 @@ def main():
         print(f"Error: Input file {input_json} not found.")
         return
 
-    with open(input_json, "r", encoding="utf-8") as f:
-        all_records = json.load(f)
-
-    updated_records = []
-    for record in all_records:
-        # Process the record to update inline citations for the three key pairs
-        record = process_record(record)
-        # Build a new record that retains only the desired keys including the new ones
-        new_record = {
-            "Email": record.get("Email", ""),
-            "Person Linkedin Url": record.get("Person Linkedin Url", ""),
-            "First Name": record.get("First Name", ""),
-            "Last Name": record.get("Last Name", ""),
-            "Title": record.get("Title", ""),
-            "Company": record.get("Company", ""),
-            "Website": record.get("Website", ""),
-            "Company Linkedin Url": record.get("Company Linkedin Url", ""),
-            "Facebook Url": record.get("Facebook Url", ""),
-            "company_background": record.get("company_background", ""),
-            "engagements_combined": record.get("engagements_combined", ""),
-            "roles_and_responsibilities": record.get("roles_and_responsibilities", ""),
-            "background": record.get("background", ""),
-            "most_relevant_topic": record.get("most_relevant_topic", ""),
-            "researching_topic": record.get("researching_topic", ""),
-            "relevant_painpoint": record.get("relevant_painpoint", ""),
-            "email_body": record.get("email_body", ""),
-            "email_output_final": record.get("email_output_final", ""),
-            "email_subject": record.get("email_subject", ""),
-            "email_subject_extract": record.get("email_subject_extract", "")
-        }
-        updated_records.append(new_record)
-
-    with open(output_json, "w", encoding="utf-8") as f:
-        json.dump(updated_records, f, indent=2)
+    # Records are read, updated and written one at a time
+    with ArrayWriter(output_json) as writer:
+        for record in iter_records(input_json):
+            # Process the record to update inline citations for the three key pairs
+            record = process_record(record)
+            # Build a new record that retains only the desired keys including the new ones
+            new_record = {
+                "Email": record.get("Email", ""),
+                "Person Linkedin Url": record.get("Person Linkedin Url", ""),
+                "First Name": record.get("First Name", ""),
+                "Last Name": record.get("Last Name", ""),
+                "Title": record.get("Title", ""),
+                "Company": record.get("Company", ""),
+                "Website": record.get("Website", ""),
+                "Company Linkedin Url": record.get("Company Linkedin Url", ""),
+                "Facebook Url": record.get("Facebook Url", ""),
+                "company_background": record.get("company_background", ""),
+                "engagements_combined": record.get("engagements_combined", ""),
+                "engagements_combined_sections": record.get("engagements_combined_sections", ""),
+                "roles_and_responsibilities": record.get("roles_and_responsibilities", ""),
+                "background": record.get("background", ""),
+                "most_relevant_topic": record.get("most_relevant_topic", ""),
+                "researching_topic": record.get("researching_topic", ""),
+                "relevant_painpoint": record.get("relevant_painpoint", ""),
+                "email_body": record.get("email_body", ""),
+                "email_output_final": record.get("email_output_final", ""),
+                "email_subject": record.get("email_subject", ""),
+                "email_subject_extract": record.get("email_subject_extract", "")
+            }
+            writer.write(new_record)
 
     print(f"Updated records written to {output_json}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    profiling.run("4add_citations", main)
\ No newline at end of file
@@ -1,5 +1,6 @@
-import json
 import os
+import profiling
+from jsonstream import iter_records, ArrayWriter
 
 # Define relative paths
 script_dir = os.path.dirname(__file__)
@@ -12,20 +13,19 @@ output_json = os.path.join(script_dir, "../../output/3final_combined_research_ci
 
 
 
-with open(input_json, "r", encoding="utf-8") as f:
-    all_records = json.load(f)
+def main():
+    # Stream the records through a temporary file, so input and output may be the same file
+    with ArrayWriter(output_json) as writer:
+        for record in iter_records(input_json):
+            # Add the 'exclude' key to each record
+            record["exclude"] = False
+            record["email_feedback"] = ""
+            record["flag"] = False
+            record["viewed"] = False
+            record["exported"] = False
+            writer.write(record)
 
-filtered_records = []
-for record in all_records:
-    # Add the 'exclude' key to each record
-    record["exclude"] = False
-    record["email_feedback"] = ""
-    record["flag"] = False
-    record["viewed"] = False
-    record["exported"] = False
-    filtered_records.append(record)
+    print(f"Filtered records written to {output_json}")
 
-with open(output_json, "w", encoding="utf-8") as f:
-    json.dump(filtered_records, f, indent=2)
-
-print(f"Filtered records written to {output_json}")
\ No newline at end of file
+if __name__ == "__main__":
+    profiling.run("5add_feedback_exclusion_keys", main)
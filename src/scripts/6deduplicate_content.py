@@ -1,81 +1,32 @@
 #!/usr/bin/env python3
 import os
+import sys
 import argparse
-import json
 import time
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+import llm_client
+import token_budget
+from sharding import add_shard_argument, in_shard, shard_path
+import profiling
+from jsonstream import iter_records, ArrayWriter
+from engagements import prompt_text as engagements_prompt_text
 
 # Load environment variables from .env
 load_dotenv()
 
 ########################################
-# Azure OpenAI configuration
+# Helper: Call Azure OpenAI with token usage tracking (shared pooled client, llm_client.py)
 ########################################
-API_KEY     = os.getenv("OPENAI_API_KEY")
-API_BASE    = os.getenv("AZURE_ENDPOINT")
-API_VERSION = "2024-12-01-preview"
-
-########################################
-# Helper: Call Azure OpenAI with token usage tracking
-########################################
-def call_azure(model_name: str, prompt_text: str, max_tokens: int,
-               reasoning_effort_o1: str = "high", reasoning_effort_o3mini: str = "low",
-               request_timeout_o1: int = 600, request_timeout_o3mini: int = 6000, request_timeout_gpt4o: int = 600) -> (str, dict):
-    client = AzureOpenAI(
-        azure_endpoint=API_BASE,
-        api_key=API_KEY,
-        api_version=API_VERSION
-    )
-    extra_params = {}
-    req_timeout = None
-
-    if model_name.startswith("o1"):
-        extra_params["reasoning_effort"] = reasoning_effort_o1
-        req_timeout = request_timeout_o1
-    elif model_name.startswith("o3-mini"):
-        extra_params["reasoning_effort"] = reasoning_effort_o3mini
-        req_timeout = request_timeout_o3mini
-    elif model_name.startswith("gpt-4o"):
-        req_timeout = request_timeout_gpt4o
-    else:
-        req_timeout = 60
-
-    messages = [
-        {
-            "role": "system",
-            "content": "You are an early stage entrepreneur reaching out to people to conduct needs assessment."
-        },
-        {"role": "user", "content": prompt_text},
-    ]
-
-    if model_name.startswith("gpt-4o"):
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            timeout=req_timeout,
-            max_tokens=max_tokens,
-            **extra_params
-        )
-    else:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            max_completion_tokens=max_tokens,
-            timeout=req_timeout
-        )
-
-    content = response.choices[0].message.content.strip()
-    usage = response.usage if hasattr(response, "usage") else {}
-    if hasattr(usage, "dict"):
-        usage = usage.dict()
-    return content, usage
+def call_azure(model_name: str, prompt_text: str, max_tokens: int) -> (str, dict):
+    return llm_client.call_azure(model_name, prompt_text, max_tokens)
 
 ########################################
 # Helper: Deduplicate and combine prospect information
 #
 # Combines the following keys from the record:
 #   - engagements_combined / engagements_combined_citation_mapping
+#     (only the sections with content when the record has
+#     engagements_combined_sections, see engagements.py)
 #   - roles_and_responsibilities / roles_and_responsibilities_citation_mapping
 #   - background / background_citation_mapping
 #
@@ -83,9 +34,16 @@ def call_azure(model_name: str, prompt_text: str, max_tokens: int,
 # inline citation markers with clickable HTML links.
 #
 # Expects a JSON response with one key "prospect_info" whose value is the deduplicated HTML.
+#
+# Each call is admitted against the token budget first (token_budget.py).
+# The output file is only written at the end of a run, so a record that does
+# not fit stops the run with BudgetExceeded and leaves the previous output
+# in place.
 ########################################
+STAGE_NAME = "6deduplicate_content"
+
 def deduplicate_prospect_info(rec: dict) -> str:
-    engagements   = rec.get("engagements_combined", "").strip()
+    engagements   = engagements_prompt_text(rec, links=True).strip()
     roles         = rec.get("roles_and_responsibilities", "").strip()
     background    = rec.get("background", "").strip()
 
@@ -109,8 +67,14 @@ Your tasks:
 3. Retain every citation marker present in the content (e.g., [1]), replace it with an inline clickable HTML anchor tag using the provided citation mapping. For example, if the citation mapping for "1" gives a URL, then the marker should become: [1](http://www.website-name.com).
 4. **Output ONLY one valid markdown object with one key "prospect_info". Do not include any additional text or explanation.**
 """
+    budget = token_budget.get_budget()
+    email = rec.get("Email")
+    estimated_prompt_tokens = token_budget.count_tokens(prompt, MODEL_NAME)
+    budget.admit_or_raise(STAGE_NAME, email, [(MODEL_NAME, estimated_prompt_tokens, 10000)])
     print("Deduplicating prospect info for a record...")
     response_text, usage = call_azure(MODEL_NAME, prompt, max_tokens=10000)
+    budget.record(STAGE_NAME, email, MODEL_NAME, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                  estimated_prompt_tokens=estimated_prompt_tokens)
     
     # Directly assign the raw markdown response to prospect_info
     prospect_info = response_text
@@ -132,36 +96,42 @@ def main():
                         help="Input JSON file containing the records (default: 3final_combined_research_cited.json)")
     parser.add_argument("--output-json", type=str, default=os.path.join(script_dir, "../../output/4cited_deduplicated_content.json"),
                         help="Output JSON file to store records with 'prospect_info'")
+    add_shard_argument(parser)
     args = parser.parse_args()
+    args.output_json = shard_path(args.output_json, args.shard)
 
-    # Load JSON records (expected to be an array of objects)
-    with open(args.input_json, "r", encoding="utf-8") as f:
-        records = json.load(f)
-    print(f"Loaded {len(records)} records from {args.input_json}")
+    # Records are streamed from the input and written as they are processed
+    total = sum(1 for r in iter_records(args.input_json) if in_shard(r, args.shard))
+    print(f"Loaded {total} records from {args.input_json}")
+    records = (r for r in iter_records(args.input_json) if in_shard(r, args.shard))
 
     # Process each record: generate deduplicated prospect_info
-    for idx, rec in enumerate(records):
-        prospect_info = deduplicate_prospect_info(rec)
-        rec["prospect_info"] = prospect_info
-        # Exclude specified keys from the output
-        exclusion_keys = [
-            "email_subject_prompt_tokens", "email_subject_completion_tokens", "email_subject_total_tokens",
-            "most_relevant_topic_prompt_tokens", "most_relevant_topic_completion_tokens", "most_relevant_topic_total_tokens",
-            "researching_topic_prompt_tokens", "researching_topic_completion_tokens", "researching_topic_total_tokens",
-            "relevant_painpoint_prompt_tokens", "relevant_painpoint_completion_tokens", "relevant_painpoint_total_tokens",
-            "email_body_prompt_tokens", "email_body_completion_tokens", "email_body_total_tokens",
-            "total_cost"
-        ]
-        for key in exclusion_keys:
-            rec.pop(key, None)
-        print(f"Processed record {idx + 1}/{len(records)}.")
-
-    # Write the updated records to the output JSON file
-    with open(args.output_json, "w", encoding="utf-8") as f:
-        json.dump(records, f, indent=2)
+    with ArrayWriter(args.output_json) as writer:
+        for idx, rec in enumerate(records):
+            prospect_info = deduplicate_prospect_info(rec)
+            rec["prospect_info"] = prospect_info
+            # Exclude specified keys from the output
+            exclusion_keys = [
+                "email_subject_prompt_tokens", "email_subject_completion_tokens", "email_subject_total_tokens",
+                "most_relevant_topic_prompt_tokens", "most_relevant_topic_completion_tokens", "most_relevant_topic_total_tokens",
+                "researching_topic_prompt_tokens", "researching_topic_completion_tokens", "researching_topic_total_tokens",
+                "relevant_painpoint_prompt_tokens", "relevant_painpoint_completion_tokens", "relevant_painpoint_total_tokens",
+                "email_body_prompt_tokens", "email_body_completion_tokens", "email_body_total_tokens",
+                "total_cost"
+            ]
+            for key in exclusion_keys:
+                rec.pop(key, None)
+            writer.write(rec)
+            print(f"Processed record {idx + 1}/{total}.")
+
     print(f"Deduplicated JSON output saved to {args.output_json}")
 
 if __name__ == "__main__":
     # Define your deployment name 
     MODEL_NAME = "o3-mini"
-    main()
\ No newline at end of file
+    try:
+        profiling.run("6deduplicate_content", main)
+    except token_budget.BudgetExceeded as e:
+        # The output is only written at the end of a run, so it is left as it was
+        print(f"Budget reached, stopping without writing the output: {e}")
+        sys.exit(1)
\ No newline at end of file
@@ -1,95 +1,63 @@
 ########################################
-# To write each record as it processes it, you can modify the main function to append each processed record to the output JSON file immediately after conversion.
+# Records are streamed from the input one at a time. Each record is
+# appended to "<output>.partial" as soon as it is converted and
+# published to the event log (events.py), so the review frontend can show it
+# while the rest of the list is still running. When the run finishes, the
+# output file is replaced atomically under its lock, keeping reviewer edits
+# already made to records with the same Email (record_files.py).
+#
+# Each record's conversions are admitted against the token budget first
+# (token_budget.py); a record that does not fit stops the run with
+# BudgetExceeded before the output file is replaced.
 ########################################
 
 #!/usr/bin/env python3
 import os
+import sys
 import argparse
-import json
 import time
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+import llm_client
+import token_budget
+from events import EventLog
+from record_files import replace_records
+from jsonstream import iter_records, ArrayWriter
+from sharding import add_shard_argument, in_shard, shard_path
+import profiling
 
 # Load environment variables from .env
 load_dotenv()
 
 ########################################
-# Azure OpenAI configuration
+# Helper: Call Azure OpenAI with token usage tracking (shared pooled client, llm_client.py)
 ########################################
-API_KEY     = os.getenv("OPENAI_API_KEY")
-API_BASE    = os.getenv("AZURE_ENDPOINT")
-API_VERSION = "2024-12-01-preview"
+SYSTEM_PROMPT = "You are a converter that converts markdown to clean HTML while preserving inline citation links."
+STAGE_NAME = "7convert_to_html"
+MAX_TOKENS = 10000
 
-########################################
-# Helper: Call Azure OpenAI with token usage tracking
-########################################
-def call_azure(model_name: str, prompt_text: str, max_tokens: int,
-               reasoning_effort_o1: str = "high", reasoning_effort_o3mini: str = "low",
-               request_timeout_o1: int = 600, request_timeout_o3mini: int = 6000, request_timeout_gpt4o: int = 600) -> (str, dict):
-    client = AzureOpenAI(
-        azure_endpoint=API_BASE,
-        api_key=API_KEY,
-        api_version=API_VERSION
-    )
-    extra_params = {}
-    req_timeout = None
-
-    if model_name.startswith("o1"):
-        extra_params["reasoning_effort"] = reasoning_effort_o1
-        req_timeout = request_timeout_o1
-    elif model_name.startswith("o3-mini"):
-        extra_params["reasoning_effort"] = reasoning_effort_o3mini
-        req_timeout = request_timeout_o3mini
-    elif model_name.startswith("gpt-4o"):
-        req_timeout = request_timeout_gpt4o
-    else:
-        req_timeout = 60
-
-    messages = [
-        {
-            "role": "system",
-            "content": "You are a converter that converts markdown to clean HTML while preserving inline citation links."
-        },
-        {"role": "user", "content": prompt_text},
-    ]
-
-    # For gpt-4o, pass max_tokens normally; otherwise, use max_completion_tokens.
-    if model_name.startswith("gpt-4o"):
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            timeout=req_timeout,
-            max_tokens=max_tokens,
-            **extra_params
-        )
-    else:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            max_completion_tokens=max_tokens,
-            timeout=req_timeout
-        )
-
-    content = response.choices[0].message.content.strip()
-    usage = response.usage if hasattr(response, "usage") else {}
-    if hasattr(usage, "dict"):
-        usage = usage.dict()
-    return content, usage
+def call_azure(model_name: str, prompt_text: str, max_tokens: int) -> (str, dict):
+    return llm_client.call_azure(model_name, prompt_text, max_tokens, system_prompt=SYSTEM_PROMPT)
 
 ########################################
 # Helper: Convert Markdown to HTML
 ########################################
-def convert_markdown_to_html(markdown_content: str, model_name: str = "o3-mini") -> str:
+def conversion_prompt(markdown_content: str) -> str:
     # The prompt instructs the model to convert markdown to HTML,
     # preserving clickable inline citation links.
-    prompt = f"""
+    return f"""
 Convert the following markdown content into valid HTML.
 Ensure that inline citations (e.g. [1](https://www.example.com)) are retained as clickable hyperlinks (e.g. <a href=\"https://www.example.com" target=\"_blank\">[1]</a>).
 Do not include any extra explanation; output only valid HTML code.
     
 {markdown_content}
 """
-    html_content, _ = call_azure(model_name, prompt, max_tokens=10000)
+
+def convert_markdown_to_html(markdown_content: str, model_name: str = "o3-mini", email: str = "") -> str:
+    prompt = conversion_prompt(markdown_content)
+    html_content, usage = call_azure(model_name, prompt, max_tokens=MAX_TOKENS)
+    token_budget.get_budget().record(STAGE_NAME, email, model_name, usage.get("prompt_tokens", 0),
+                                     usage.get("completion_tokens", 0),
+                                     estimated_prompt_tokens=token_budget.count_tokens(prompt, model_name))
     return html_content
 
 ########################################
@@ -105,12 +73,14 @@ def main():
     parser.add_argument("--output-json", type=str, default=os.path.join(script_dir, "../../output/5html_converted_content.json"),
                         help="Output JSON file with HTML-converted content")
     parser.add_argument("--model-name", type=str, default="o3-mini", help="Model to use for conversion")
+    add_shard_argument(parser)
     args = parser.parse_args()
+    args.output_json = shard_path(args.output_json, args.shard)
 
-    # Load JSON records (expected to be an array of objects following the schema)
-    with open(args.input_json, "r", encoding="utf-8") as f:
-        records = json.load(f)
-    print(f"Loaded {len(records)} records from {args.input_json}")
+    # Records are streamed from the input one at a time (expected to be an array of objects following the schema)
+    total = sum(1 for r in iter_records(args.input_json) if in_shard(r, args.shard))
+    records = (r for r in iter_records(args.input_json) if in_shard(r, args.shard))
+    print(f"Loaded {total} records from {args.input_json}")
 
     # Define the fields that need markdown-to-HTML conversion.
     # Other fields (e.g., Email, Person Linkedin Url, etc.) will remain unchanged.
@@ -122,26 +92,43 @@ def main():
         "prospect_info"
     ]
 
-    # Open the output JSON file in append mode
-    with open(args.output_json, "w", encoding="utf-8") as f:
-        f.write("[\n")  # Start the JSON array
+    events = EventLog()
+    output_name = os.path.basename(args.output_json)
+    partial_json = args.output_json + ".partial"
+    events.publish("run_started", stage="7convert_to_html", file=output_name, total=total)
+    budget = token_budget.get_budget()
 
+    # Write progress to the partial file; the real output is only replaced at the end
+    with ArrayWriter(partial_json, ensure_ascii=False, atomic=False) as writer:
         # Process each record: convert specified fields from markdown to HTML.
         for idx, rec in enumerate(records):
-            for field in fields_to_convert:
-                if field in rec and rec[field]:
-                    markdown_text = rec[field]
-                    html_text = convert_markdown_to_html(markdown_text, model_name=args.model_name)
-                    rec[field] = html_text
-            print(f"Converted record {idx + 1}/{len(records)}.")
-
-            # Write the updated record to the output JSON file.
-            json.dump(rec, f, indent=2, ensure_ascii=False)
-            if idx < len(records) - 1:
-                f.write(",\n")  # Add a comma between records
-
-        f.write("\n]")  # End the JSON array
+            fields = [field for field in fields_to_convert if field in rec and rec[field]]
+            budget.admit_or_raise(STAGE_NAME, rec.get("Email"), [
+                (args.model_name, token_budget.count_tokens(conversion_prompt(rec[field]), args.model_name), MAX_TOKENS)
+                for field in fields
+            ])
+            for field in fields:
+                markdown_text = rec[field]
+                html_text = convert_markdown_to_html(markdown_text, model_name=args.model_name, email=rec.get("Email"))
+                rec[field] = html_text
+            print(f"Converted record {idx + 1}/{total}.")
+
+            # Write the updated record to the partial JSON file.
+            writer.write(rec)
+            events.publish("record_completed", stage="7convert_to_html", file=output_name,
+                           email=rec.get("Email"), record=rec)
+
+    merged = replace_records(args.output_json, iter_records(partial_json))
+    os.remove(partial_json)
+    events.publish("records_replaced", stage="7convert_to_html", file=output_name, total=total)
+    events.publish("run_finished", stage="7convert_to_html", file=output_name)
+    print(f"Kept reviewer edits for {merged} existing record(s).")
     print(f"HTML-converted JSON output saved to {args.output_json}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        profiling.run("7convert_to_html", main)
+    except token_budget.BudgetExceeded as e:
+        # The output is only written at the end of a run, so it is left as it was
+        print(f"Budget reached, stopping without writing the output: {e}")
+        sys.exit(1)
\ No newline at end of file
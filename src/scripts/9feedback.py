@@ -5,32 +5,43 @@ import pandas as pd
 import csv
 from glob import glob
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+import llm_client
+import token_budget
+import fused_prompts
+import engagements
 import time
-import json
+from record_files import journal_upsert, fold_journal, iter_records_with_journal, VERSION_FIELD, FIELD_VERSIONS_FIELD
+from fingerprints import hash_text, FINGERPRINT_VERSION
+from sharding import add_shard_argument, in_shard, shard_path
+import profiling
 
 # Load .env variables
 load_dotenv()
 
-def append_record_to_json(record: dict, output_json: str):
-    # If the file already exists, load its JSON content;
-    # otherwise initialize an empty list.
-    if os.path.exists(output_json):
-        with open(output_json, "r", encoding="utf-8") as f:
-            try:
-                records = json.load(f)
-            except json.JSONDecodeError:
-                records = []
-    else:
-        records = []
-    records.append(record)
-    with open(output_json, "w", encoding="utf-8") as f:
-        json.dump(records, f, indent=2)
+def generated_fields(record: dict) -> list:
+    """
+    The fields written by the feedback chain (outputs, token counts and cost),
+    plus the feedback they were generated from.
+    """
+    fields = ["email_feedback", FEEDBACK_FINGERPRINT_KEY, "total_cost"]
+    for cfg in PROMPT_CONFIGS:
+        key = cfg["output_key"]
+        fields += [key, f"{key}_prompt_tokens", f"{key}_completion_tokens", f"{key}_total_tokens", f"{key}_model"]
+    return [f for f in fields if f in record]
+
+def upsert_record_to_json(record: dict, output_json: str, existing: dict = None) -> dict:
+    # Replace the record with the same Email (existing, keeping QA review flags), or append it.
+    # Written as a patch to the file's journal under the review frontend's lock, so it is
+    # safe while QA mode is open and costs the same however large the file is.
+    # Returns the record as merged.
+    record = {k: v for k, v in record.items() if k not in (VERSION_FIELD, FIELD_VERSIONS_FIELD)}
+    return journal_upsert(output_json, record, existing, overwrite_fields=generated_fields(record))
 
 ########################################
 # Prompt Config 
 ########################################
 script_dir = os.path.dirname(__file__)
+FEEDBACK_FINGERPRINT_KEY = "feedback_fingerprint"
 records_limit_value = None
 input_name = os.path.join(script_dir, "../../output/5html_converted_content.json")
 output_name = os.path.join(script_dir, "../../output/6email_feedback")    # don't include the .csv extension
@@ -69,23 +80,27 @@ PROMPT_CONFIGS = [
     }
 ]
 
-########################################
-# Pricing details (per 1,000,000 tokens)
-########################################
-PRICING = {
-    "o1": {
-        "input": 5.00,
-        "output": 20.00,
-    },
-    "o3-mini": {
-        "input": 1.10,
-        "output": 4.40,
+# Prompts that --fused runs as one structured-output request (see fused_prompts.py)
+FUSED_GROUPS = [
+    {
+        "name": "email_after_feedback_fused",
+        "steps": ["content_after_feedback", "email_after_feedback"],
+        "model_name": "o1",
+        "max_completion_tokens": 10000
     },
-    "gpt-4o": {
-        "input": 2.50,
-        "output": 10.00,
+    {
+        "name": "email_subject_after_feedback_fused",
+        "steps": ["email_subject_after_feedback", "email_subject_extract_after_feedback"],
+        "model_name": "o3-mini",
+        "max_completion_tokens": 4000
     }
-}
+]
+
+########################################
+# Pricing details (per 1,000,000 tokens), shared with the token budget
+########################################
+PRICING = token_budget.MODEL_PRICING
+STAGE_NAME = "9feedback"
 
 # Rate limit delays (in seconds) computed from requests per minute limits.
 RATE_LIMIT_DELAYS = {
@@ -109,85 +124,10 @@ def get_prompt(template: str, variables: dict) -> str:
     return prompt
 
 ########################################
-# Helper: Call Azure OpenAI with token usage tracking
+# Helper: Call Azure OpenAI with token usage tracking (shared pooled client, llm_client.py)
 ########################################
-API_KEY     = os.getenv("OPENAI_API_KEY")
-API_BASE    = os.getenv("AZURE_ENDPOINT")
-API_VERSION = "2024-12-01-preview"
-
-
-def call_azure(model_name: str, prompt_text: str, max_tokens: int,
-               reasoning_effort_o1: str = "high", reasoning_effort_o3mini: str = "medium",
-               request_timeout_o1: int = 600, request_timeout_o3mini: int = 6000, request_timeout_gpt4o: int = 600) -> (str, dict):
-    client = AzureOpenAI(
-        azure_endpoint=API_BASE,
-        api_key=API_KEY,
-        api_version=API_VERSION
-    )
-
-    extra_params = {}  # default extra parameters
-    req_timeout = None
-
-    if model_name.startswith("o1"):
-        req_timeout = request_timeout_o1
-    elif model_name.startswith("o3-mini"):
-        req_timeout = request_timeout_o3mini
-    elif model_name.startswith("gpt-4o"):
-        req_timeout = request_timeout_gpt4o
-    else:
-        req_timeout = 60
-
-    messages = [
-        {
-            "role": "system",
-            "content": "You are an early stage entrepreneur reaching out to people to conduct needs assessment."
-        },
-        {"role": "user", "content": prompt_text},
-    ]
-    
-    try:
-        if model_name.startswith("gpt-4o"):
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                timeout=req_timeout,
-                max_tokens=max_tokens,
-                **extra_params
-            )
-        else:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                max_completion_tokens=max_tokens,
-                timeout=req_timeout,
-                **extra_params
-            )
-    except TypeError as e:
-        if "reasoning_effort" in str(e):
-            extra_params.pop("reasoning_effort", None)
-            if model_name.startswith("gpt-4o"):
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    timeout=req_timeout,
-                    max_tokens=max_tokens
-                )
-            else:
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    max_completion_tokens=max_tokens,
-                    timeout=req_timeout,
-                    **extra_params
-                )
-        else:
-            raise e
-
-    content = response.choices[0].message.content.strip()
-    usage = response.usage if hasattr(response, "usage") else {}
-    if hasattr(usage, "dict"):
-        usage = usage.dict()
-    return content, usage
+def call_azure(model_name: str, prompt_text: str, max_tokens: int, response_format: dict = None) -> (str, dict):
+    return llm_client.call_azure(model_name, prompt_text, max_tokens, response_format=response_format)
 
 
 ########################################
@@ -196,7 +136,8 @@ def call_azure(model_name: str, prompt_text: str, max_tokens: int,
 def calculate_cost(record):
     total_cost = 0.0
     for cfg in PROMPT_CONFIGS:
-        model = cfg["model_name"]
+        # The model each step actually ran on (cheaper than configured when the budget required it)
+        model = record.get(f"{cfg['output_key']}_model") or cfg["model_name"]
         pricing = PRICING.get(model)
         if not pricing:
             continue
@@ -208,6 +149,148 @@ def calculate_cost(record):
         total_cost += input_cost + output_cost
     return total_cost
 
+########################################
+# Helpers: variables, templates and the per-record feedback chain
+########################################
+def load_global_vars() -> dict:
+    global_vars = {}
+    for v in glob(os.path.join(script_dir, "../../src/variables/*")):
+        with open(v, "r", encoding="utf-8") as f:
+            key = os.path.basename(v).split(".")[0].strip()
+            global_vars[key] = f.read().strip()
+    return global_vars
+
+def load_prompt_templates() -> dict:
+    prompt_templates = {}
+    for cfg in PROMPT_CONFIGS:
+        with open(cfg["prompt_path"], "r", encoding="utf-8") as f:
+            prompt_templates[cfg["name"]] = f.read()
+    return prompt_templates
+
+def feedback_fingerprint(record: dict, prompt_templates: dict, global_vars: dict, substitutions: dict = None,
+                         fused: bool = False) -> str:
+    """
+    Hash of everything the feedback chain depends on: the feedback, the email it
+    applies to, and each prompt's template, model and parameters (plus variables).
+    substitutions maps configured models to the cheaper ones actually used;
+    fused runs also hash the fused groups.
+    """
+    substitutions = substitutions or {}
+    prompts = {
+        cfg["name"]: {
+            "template": hash_text(prompt_templates[cfg["name"]]),
+            "model": substitutions.get(cfg["model_name"], cfg["model_name"]),
+            "max_completion_tokens": cfg.get("max_completion_tokens", 4000),
+        }
+        for cfg in PROMPT_CONFIGS
+    }
+    payload = {
+        "version": FINGERPRINT_VERSION,
+        "email_feedback": (record.get("email_feedback") or "").strip(),
+        "email_output_final": record.get("email_output_final") or "",
+        "prompts": prompts,
+        "variables": hash_text(global_vars),
+    }
+    if fused:
+        payload["fused"] = [dict(group, model_name=substitutions.get(group["model_name"], group["model_name"]))
+                            for group in FUSED_GROUPS]
+    return hash_text(payload)
+
+def is_feedback_current(record: dict, existing: dict, prompt_templates: dict, global_vars: dict,
+                        fused: bool = False) -> bool:
+    """
+    True if `existing` (the record's copy in 6email_feedback.json) was generated from the same inputs.
+    """
+    return bool(existing) and existing.get(FEEDBACK_FINGERPRINT_KEY) == feedback_fingerprint(
+        record, prompt_templates, global_vars, fused=fused)
+
+def unit_template(unit: dict, prompt_templates: dict) -> str:
+    if unit["fused"]:
+        return fused_prompts.fused_template(unit["configs"], prompt_templates)
+    return prompt_templates[unit["name"]]
+
+def store_output(record: dict, cfg: dict, result: str, usage: dict, model_name: str):
+    key = cfg["output_key"]
+    # Always set, so an upsert replaces the model of an earlier downgraded or fused run
+    record[f"{key}_model"] = model_name
+    record[key] = result
+    record[f"{key}_prompt_tokens"] = usage.get("prompt_tokens", 0)
+    record[f"{key}_completion_tokens"] = usage.get("completion_tokens", 0)
+    record[f"{key}_total_tokens"] = usage.get("total_tokens", 0)
+
+def run_prompt(record: dict, name: str, model_name: str, prompt_text: str, max_tokens: int,
+               response_format: dict = None) -> (str, dict):
+    email = record.get("Email")
+    print(f"Running prompt {name} for record {email}")
+    result, usage = call_azure(model_name, prompt_text, max_tokens, response_format=response_format)
+    print(f"Done running prompt {name} for record {email}")
+    token_budget.get_budget().record(STAGE_NAME, email, model_name, usage.get("prompt_tokens", 0),
+                                     usage.get("completion_tokens", 0),
+                                     estimated_prompt_tokens=token_budget.count_tokens(prompt_text, model_name))
+    delay = RATE_LIMIT_DELAYS.get(model_name, 0)
+    time.sleep(delay)
+    return result, usage
+
+def process_feedback_record(record: dict, prompt_templates: dict, global_vars: dict, fused: bool = False) -> dict:
+    """
+    Run content_after_feedback -> email_after_feedback -> subject prompts for one
+    record, storing each output and its token usage, then the total cost and
+    the feedback fingerprint. With fused=True the FUSED_GROUPS run as one
+    structured-output request each, falling back to the single prompts for
+    outputs that fail validation (fused_prompts.py).
+
+    Raises token_budget.BudgetExceeded if the prompts do not fit the budget,
+    even with cheaper models.
+    """
+    prompt_vars = dict(record)
+    prompt_vars.update(global_vars)
+    # Only the engagement sections with content, linked as in the stage 4 text
+    prompt_vars["engagements_combined"] = engagements.prompt_text(record, links=True)
+    budget = token_budget.get_budget()
+    units = fused_prompts.execution_units(PROMPT_CONFIGS, FUSED_GROUPS if fused else [])
+    pending = {}
+    calls = []
+    for unit in units:
+        model_name = unit["model_name"]
+        max_tokens = unit["max_completion_tokens"]
+        calls.append((model_name, token_budget.estimate_prompt_tokens(
+            unit_template(unit, prompt_templates), prompt_vars, model_name, pending), max_tokens))
+        for cfg in unit["configs"]:
+            pending[cfg["output_key"]] = budget.expected_output_tokens(STAGE_NAME, model_name, max_tokens)
+    substitutions = budget.admit_or_raise(STAGE_NAME, record.get("Email"), calls)
+
+    for unit in units:
+        remaining = unit["configs"]
+        if unit["fused"]:
+            model_name = substitutions.get(unit["model_name"], unit["model_name"])
+            content, usage = run_prompt(record, unit["name"], model_name,
+                                        get_prompt(unit_template(unit, prompt_templates), prompt_vars),
+                                        unit["max_completion_tokens"],
+                                        fused_prompts.response_format(unit["name"], unit["configs"]))
+            outputs = fused_prompts.parse_outputs(content, unit["configs"])
+            for i, cfg in enumerate(unit["configs"]):
+                if cfg["output_key"] not in outputs:
+                    break
+                # The request's tokens are counted once, on the group's first step
+                store_output(record, cfg, outputs[cfg["output_key"]], usage if i == 0 else {}, model_name)
+                prompt_vars[cfg["output_key"]] = outputs[cfg["output_key"]]
+            remaining = [cfg for cfg in unit["configs"] if cfg["output_key"] not in outputs]
+            if remaining:
+                print(f"Fused prompt {unit['name']} gave no valid {', '.join(cfg['output_key'] for cfg in remaining)}; "
+                      f"running those prompts one by one")
+        for cfg in remaining:
+            model_name = substitutions.get(cfg["model_name"], cfg["model_name"])
+            prompt_text = get_prompt(prompt_templates[cfg["name"]], prompt_vars)
+            result, usage = run_prompt(record, cfg["name"], model_name, prompt_text,
+                                       cfg.get("max_completion_tokens", 4000))
+            store_output(record, cfg, result, usage, model_name)
+            prompt_vars[cfg["output_key"]] = result
+
+    record["total_cost"] = calculate_cost(record)
+    # With a cheaper model the fingerprint differs from the configured chain's, so the record reruns later
+    record[FEEDBACK_FINGERPRINT_KEY] = feedback_fingerprint(record, prompt_templates, global_vars, substitutions, fused)
+    return record
+
 ########################################
 # CLI Argument Parsing
 ########################################
@@ -216,7 +299,14 @@ def parse_args():
     parser.add_argument("--input-csv", type=str, default=input_name)
     # parser.add_argument("--output-csv", type=str, default=f"{output_name}.csv")
     parser.add_argument("--output-json", type=str, default=f"{output_name}.json")
-    return parser.parse_args()
+    parser.add_argument("--force", action="store_true",
+                        help="Regenerate every record with feedback, even if its feedback fingerprint is unchanged.")
+    parser.add_argument("--fused", action="store_true",
+                        help="Run the FUSED_GROUPS prompts as one structured-output request each.")
+    add_shard_argument(parser)
+    args = parser.parse_args()
+    args.output_json = shard_path(args.output_json, args.shard)
+    return args
 
 ########################################
 # Append a record to CSV (filtered to desired columns)
@@ -257,77 +347,59 @@ def main():
     args = parse_args()
     limit = records_limit_value
 
-    # Check file extension and read accordingly
+    # Check file extension and read accordingly; JSON input is read as the review
+    # frontend sees it, with the feedback it has journaled but not yet flushed.
     ext = os.path.splitext(args.input_csv)[1].lower()
     if ext == ".json":
-        df = pd.read_json(args.input_csv)
+        all_records = iter_records_with_journal(args.input_csv)
     else:
-        df = pd.read_csv(args.input_csv)
-    
-    all_records = df.to_dict("records")
+        all_records = pd.read_csv(args.input_csv).to_dict("records")
 
-    processed_emails = set()
-    # if os.path.exists(args.output_csv):
-    #     processed_df = pd.read_csv(args.output_csv)
-    #     processed_emails = set(processed_df["Email"])
-    records = [r for r in all_records if r.get("Email") not in processed_emails]
+    # Records whose feedback, email and prompts are unchanged since their last run are skipped.
+    existing_by_email = {r.get("Email"): r for r in iter_records_with_journal(args.output_json)}
+    records = [r for r in all_records if in_shard(r, args.shard)]
     
     if limit is not None:
         records = records[:limit]
 
-    vars_paths = glob(os.path.join(script_dir, "../../src/variables/*"))
-    global_vars = {}
-    for v in vars_paths:
-        with open(v, "r", encoding="utf-8") as f:
-            key = os.path.basename(v).split(".")[0].strip()
-            global_vars[key] = f.read().strip()
+    global_vars = load_global_vars()
+    prompt_templates = load_prompt_templates()
 
-    prompt_templates = {}
-    for cfg in PROMPT_CONFIGS:
-        with open(cfg["prompt_path"], "r", encoding="utf-8") as f:
-            prompt_templates[cfg["name"]] = f.read()
+    skipped = 0
+    try:
+        for record in records:
+            email_feedback = (record.get("email_feedback") or "").strip()
+            if not email_feedback:
+                continue  # Skip records with empty or whitespace-only "email_feedback"
+            if not args.force and is_feedback_current(record, existing_by_email.get(record.get("Email")),
+                                                      prompt_templates, global_vars, args.fused):
+                skipped += 1
+                continue
+
+            try:
+                process_feedback_record(record, prompt_templates, global_vars, fused=args.fused)
+            except token_budget.BudgetExceeded as e:
+                # Not an error to retry: stop admitting records until the budget is raised
+                print(f"Budget reached, not admitting more records: {e}")
+                break
+
+            # Replace the record's previous result instead of appending a duplicate
+            # append_record(record, args.output_csv, get_desired_columns(df))
+            email = record.get("Email")
+            existing_by_email[email] = upsert_record_to_json(record, args.output_json, existing_by_email.get(email))
 
-    for record in records:
-        email_feedback = record.get("email_feedback", "").strip()
-        if not email_feedback:
-            continue  # Skip records with empty or whitespace-only "email_feedback"
-
-        prompt_vars = dict(record)
-        prompt_vars.update(global_vars)
-        for cfg in PROMPT_CONFIGS:
-            template = prompt_templates[cfg["name"]]
-            prompt_text = get_prompt(template, prompt_vars)
-            model_name = cfg["model_name"]
-            max_tokens = cfg.get("max_completion_tokens", 4000)
-            
-            print(f"Running prompt {cfg['name']} for record {record.get('Email')}")
-            result, usage = call_azure(model_name, prompt_text, max_tokens)
-            print(f"Done running prompt {cfg['name']} for record {record.get('Email')}")
-            
-            key = cfg["output_key"]
-            record[key] = result
-            record[f"{key}_prompt_tokens"] = usage.get("prompt_tokens", 0)
-            record[f"{key}_completion_tokens"] = usage.get("completion_tokens", 0)
-            record[f"{key}_total_tokens"] = usage.get("total_tokens", 0)
-            prompt_vars[key] = result
-            
-            delay = RATE_LIMIT_DELAYS.get(model_name, 0)
-            time.sleep(delay)
-
-        record["total_cost"] = calculate_cost(record)
-        
-        # Append the processed record to CSV and JSON
-        # append_record(record, args.output_csv, get_desired_columns(df))
-        append_record_to_json(record, args.output_json)
-        
-        print(f"Processed record for Email: {record.get('Email')}, Total Cost: ${record['total_cost']:.6f}")
+            print(f"Processed record for Email: {record.get('Email')}, Total Cost: ${record['total_cost']:.6f}")
+    finally:
+        # Results are journaled one record at a time; write them into the file once per run
+        fold_journal(args.output_json)
+    print(f"Skipped {skipped} record(s) with unchanged feedback.")
 
 if __name__ == "__main__":
     delays = [30, 120, 240, 480, 600]  # delays in seconds: 30s, 2min, 4min, 8min, 10min
     delay_index = 0
     while True:
         try:
-            main()  # process all records
+            profiling.run("9feedback", main)  # process all records
             break  # If main() completes successfully, exit the loop
         except Exception as e:
             print(f"An error occurred: {e}")
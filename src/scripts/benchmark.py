@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+from mock_api import start_server, add_mock_arguments, config_from_args
+
+########################################
+# Offline end-to-end benchmark
+#
+# Runs stages 1-9 on a synthetic contact list against the local mock APIs
+# (mock_api.py), in a throwaway copy of src/ so the real input/ and output/
+# folders are never touched and no real API keys are used:
+#
+#   python3 ./src/scripts/benchmark.py --contacts 100
+#   python3 ./src/scripts/benchmark.py --contacts 1000 --latency-scale 0.1 --rate-429 0.02 --report bench.json
+#
+# For every stage it reports records, wall time, records/min, the p50/p95
+# time per record (the gaps between the stage's per-record progress lines)
+# and the peak RSS of the stage process (os.wait4). Before stage 9 a
+# --feedback-fraction of the records get reviewer feedback, as a review
+# session would leave them.
+########################################
+script_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(script_dir, "..")
+
+# (stage, script, output file counted for records, regex of its per-record progress line)
+STAGES = [
+    ("1", "1perplexity.py", "output/1perplexity_results.jsonl", r"^Record for .* written to CSV and JSON"),
+    ("2", "2fix_perplexity_json.py", "output/1perplexity_results.json", None),
+    ("3", "3email_generation.py", "output/2final_combined_research_results.json", r"^Processed record for Email:"),
+    ("4", "4add_citations.py", "output/3final_combined_research_cited.json", None),
+    ("5", "5add_feedback_exclusion_keys.py", "output/3final_combined_research_cited.json", None),
+    ("6", "6deduplicate_content.py", "output/4cited_deduplicated_content.json", r"^Processed record \d+/"),
+    ("7", "7convert_to_html.py", "output/5html_converted_content.json", r"^Converted record \d+/"),
+    ("9", "9feedback.py", "output/6email_feedback.json", r"^Processed record for Email:"),
+]
+CONTACT_COLUMNS = ["First Name", "Last Name", "Title", "Company", "Company Name for Emails", "Email",
+                   "Person Linkedin Url", "Website", "Company Linkedin Url", "Facebook Url",
+                   "Twitter Url", "City", "State", "Country"]
+TITLES = ["Vice President, Clinical Operations", "Director of Pharmacy", "Chief Medical Officer",
+          "Head of Data Science", "Senior Manager, Market Access"]
+COMPANIES = ["Northwind Health", "Contoso Pharma", "Fabrikam Biotech", "Tailspin Clinics", "Adatum Labs"]
+
+
+########################################
+# Workdir setup
+########################################
+def make_workdir(contacts, seed):
+    workdir = tempfile.mkdtemp(prefix="emailpipe-bench-")
+    for name in ("scripts", "prompts", "variables"):
+        shutil.copytree(os.path.join(src_dir, name), os.path.join(workdir, "src", name),
+                        ignore=shutil.ignore_patterns("__pycache__", "*.pyc"))
+    os.makedirs(os.path.join(workdir, "input"))
+    os.makedirs(os.path.join(workdir, "output"))
+    write_contacts(os.path.join(workdir, "input", "apollo-contacts-export.csv"), contacts, seed)
+    return workdir
+
+
+def write_contacts(path, count, seed):
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=CONTACT_COLUMNS)
+        writer.writeheader()
+        for i in range(count):
+            company = rng.choice(COMPANIES)
+            domain = re.sub(r"[^a-z]", "", company.lower()) + ".com"
+            writer.writerow({
+                "First Name": f"First{i}", "Last Name": f"Last{i}", "Title": rng.choice(TITLES),
+                "Company": company, "Company Name for Emails": company, "Email": f"first{i}.last{i}@{domain}",
+                "Person Linkedin Url": f"http://www.linkedin.com/in/first{i}-last{i}",
+                "Website": f"http://www.{domain}", "Company Linkedin Url": "", "Facebook Url": "",
+                "Twitter Url": "", "City": "Boston", "State": "Massachusetts", "Country": "United States",
+            })
+
+
+def add_feedback(workdir, fraction, seed):
+    # Stand-in for a review session: feedback on a fraction of the converted records
+    path = os.path.join(workdir, "output", "5html_converted_content.json")
+    with open(path, "r", encoding="utf-8") as f:
+        records = json.load(f)
+    rng = random.Random(seed)
+    for record in rng.sample(records, int(len(records) * fraction)):
+        record["email_feedback"] = "Make the opening shorter and mention their recent webinar."
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(records, f, indent=2)
+
+
+def stage_env(workdir, base_url):
+    env = dict(os.environ)
+    env.update({
+        "PERPLEXITY_API_URL": f"{base_url}/chat/completions",
+        "PERPLEXITY_API_KEY": "benchmark",
+        "AZURE_ENDPOINT": base_url,
+        "OPENAI_API_KEY": "benchmark",
+        "EMAILPIPE_EVENTS_FILE": os.path.join(workdir, "output", "events.jsonl"),
+        "EMAILPIPE_QUEUE_DB": os.path.join(workdir, "output", "work_queue.db"),
+        "EMAILPIPE_BUDGET_DB": os.path.join(workdir, "output", "budget.db"),
+        "EMAILPIPE_KB_DB": os.path.join(workdir, "output", "prospect_kb.db"),
+        "PYTHONUNBUFFERED": "1",
+    })
+    return env
+
+
+########################################
+# Running and measuring a stage
+########################################
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def count_records(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            return sum(1 for line in f if line.strip())
+        return len(json.load(f))
+
+
+def run_stage(workdir, env, stage, script, output, progress, log):
+    pattern = re.compile(progress) if progress else None
+    start = time.perf_counter()
+    last = start
+    gaps = []
+    process = subprocess.Popen([sys.executable, os.path.join(workdir, "src", "scripts", script)],
+                               cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               text=True, encoding="utf-8", errors="replace")
+    for line in process.stdout:
+        log.write(line)
+        if pattern and pattern.search(line):
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+    process.stdout.close()
+    # wait4 instead of wait() to get the stage's own resource usage
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    records = len(gaps) if pattern else count_records(os.path.join(workdir, output))
+    return {
+        "stage": stage,
+        "script": script,
+        "exit_code": process.returncode,
+        "records": records,
+        "seconds": round(seconds, 3),
+        "records_per_min": round(records / seconds * 60, 1) if seconds else None,
+        "p50_seconds": round(percentile(gaps, 50), 3) if gaps else None,
+        "p95_seconds": round(percentile(gaps, 95), 3) if gaps else None,
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1),
+    }
+
+
+def print_report(report):
+    print(f"\n{report['contacts']} contacts, workdir {report['workdir']}")
+    print(f"{'stage':<34}{'records':>8}{'seconds':>10}{'rec/min':>10}{'p50 s':>8}{'p95 s':>8}{'RSS MB':>8}")
+    for row in report["stages"]:
+        fmt = lambda v: "-" if v is None else v
+        print(f"{row['script']:<34}{row['records']:>8}{row['seconds']:>10}{fmt(row['records_per_min']):>10}"
+              f"{fmt(row['p50_seconds']):>8}{fmt(row['p95_seconds']):>8}{row['peak_rss_mb']:>8}"
+              + ("" if row["exit_code"] == 0 else f"  exit {row['exit_code']}"))
+    print(f"total: {report['total_seconds']}s")
+    for model, statuses in sorted(report["api"].items()):
+        print(f"  {model}: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline end to end against local mock APIs.")
+    parser.add_argument("--contacts", type=int, default=100, help="Synthetic contacts to generate (e.g. 100, 1000, 10000).")
+    parser.add_argument("--stages", type=str, default=",".join(stage for stage, _, _, _ in STAGES),
+                        help="Comma-separated stages to run, in order (default: all).")
+    parser.add_argument("--feedback-fraction", type=float, default=0.2,
+                        help="Fraction of records given reviewer feedback before stage 9.")
+    parser.add_argument("--report", type=str, default=None, help="Also write the report as JSON to this path.")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the temporary copy for inspection.")
+    add_mock_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    selected = [s.strip() for s in args.stages.split(",") if s.strip()]
+    config = config_from_args(args)
+    server, base_url = start_server(config)
+    workdir = make_workdir(args.contacts, args.seed)
+    env = stage_env(workdir, base_url)
+    report = {"contacts": args.contacts, "workdir": workdir, "stages": [], "api": config.stats}
+
+    start = time.perf_counter()
+    try:
+        with open(os.path.join(workdir, "benchmark.log"), "w", encoding="utf-8") as log:
+            for stage, script, output, progress in STAGES:
+                if stage not in selected:
+                    continue
+                if stage == "9":
+                    add_feedback(workdir, args.feedback_fraction, args.seed)
+                print(f"Running stage {stage} ({script})...")
+                result = run_stage(workdir, env, stage, script, output, progress, log)
+                report["stages"].append(result)
+                if result["exit_code"] != 0:
+                    print(f"Stage {stage} exited with {result['exit_code']}; see {log.name}")
+                    break
+    finally:
+        server.shutdown()
+    report["total_seconds"] = round(time.perf_counter() - start, 3)
+
+    print_report(report)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
+    if not args.keep_workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,619 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import csv
+import json
+import datetime
+import importlib
+import multiprocessing
+
+########################################
+# emailpipe: maintenance commands for the pipeline outputs
+#
+# Usage (from the repository root):
+#   python3 ./src/scripts/emailpipe.py rebuild [--dry-run]
+#   python3 ./src/scripts/emailpipe.py export --list-name <name> [--lists reviewed feedback]
+#   python3 ./src/scripts/emailpipe.py merge --stage 3 --shards 4
+#   python3 ./src/scripts/emailpipe.py queue enqueue|work|status|collect|retry --stage 1
+#   python3 ./src/scripts/emailpipe.py kb import|status
+########################################
+script_dir = os.path.dirname(__file__)
+output_dir = os.path.join(script_dir, "../../output")
+input_dir = os.path.join(script_dir, "../../input")
+
+def load_stage(module_name: str):
+    """
+    Import a numbered stage script (e.g. "3email_generation") as a module.
+    """
+    return importlib.import_module(module_name)
+
+########################################
+# Helpers: JSON / CSV output
+########################################
+def load_json_records(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_json_atomic(records: list, path: str):
+    # Write to a temporary file first so an interrupted run never leaves a truncated output.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(records, f, indent=2)
+    os.replace(tmp_path, path)
+
+def write_csv(records: list, path: str, fieldnames: list):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for record in records:
+            writer.writerow({key: record.get(key, "") for key in fieldnames})
+    os.replace(tmp_path, path)
+
+########################################
+# rebuild: rerun only the prompt steps invalidated by a prompt, variable or research change
+########################################
+def generated_keys(prompt_configs: list) -> set:
+    keys = {"total_cost"}
+    for cfg in prompt_configs:
+        key = cfg["output_key"]
+        keys.update({key, f"{key}_prompt_tokens", f"{key}_completion_tokens",
+                     f"{key}_total_tokens", f"{key}_fingerprint"})
+    return keys
+
+def merge_research(records: list, research_records: list, skip_keys: set) -> int:
+    """
+    Copy the latest stage 1 research fields into the stage 3 records (matched by Email),
+    so that re-researched contacts invalidate the prompts that read their research.
+    """
+    research_by_email = {r.get("Email"): r for r in research_records if r.get("Email")}
+    updated = 0
+    for record in records:
+        research = research_by_email.get(record.get("Email"))
+        if not research:
+            continue
+        changes = {k: v for k, v in research.items() if k not in skip_keys and record.get(k) != v}
+        if changes:
+            record.update(changes)
+            updated += 1
+    return updated
+
+def rebuild(args):
+    generation = load_stage("3email_generation")
+    fingerprints = load_stage("fingerprints")
+
+    records = load_json_records(args.input_json)
+    if not records:
+        print(f"No records found in {args.input_json}")
+        return
+
+    skip_keys = generated_keys(generation.PROMPT_CONFIGS)
+    if args.research_json and os.path.exists(args.research_json):
+        updated = merge_research(records, load_json_records(args.research_json), skip_keys)
+        print(f"Merged updated research into {updated} record(s) from {args.research_json}")
+
+    global_vars = generation.load_global_vars()
+    prompt_templates = generation.load_prompt_templates(generation.PROMPT_CONFIGS)
+
+    total_stale = 0
+    records_rebuilt = 0
+    for idx, record in enumerate(records):
+        # Walk the chain without calling the model to find which steps are stale.
+        # Outputs of stale steps are unknown, so everything after the first stale step
+        # that reads it is reported as stale as well.
+        prompt_vars = generation.prompt_variables(record, global_vars)
+        stale_steps = []
+        for unit in generation.execution_units(args.fused):
+            keys = [cfg["output_key"] for cfg in unit["configs"]]
+            template = generation.unit_template(unit, prompt_templates)
+            fingerprint = generation.unit_fingerprint(unit, template, prompt_vars, retrieval=args.retrieval)
+            if generation.unit_is_stale(record, unit, fingerprint):
+                if args.adopt_missing and all(record.get(key) and not record.get(fingerprints.fingerprint_key(key))
+                                              for key in keys):
+                    for key in keys:
+                        record[fingerprints.fingerprint_key(key)] = fingerprint
+                else:
+                    stale_steps.append(unit["name"])
+                    for key in keys:
+                        prompt_vars[key] = f"<stale:{unit['name']}>"
+                    continue
+            for key in keys:
+                prompt_vars[key] = record.get(key, "")
+
+        if not stale_steps:
+            continue
+        total_stale += len(stale_steps)
+        print(f"[{idx + 1}/{len(records)}] {record.get('Email')}: stale -> {', '.join(stale_steps)}")
+        if args.dry_run:
+            continue
+
+        try:
+            ran_steps = generation.process_record(record, prompt_templates, global_vars, only_stale=True,
+                                                  fused=args.fused, retrieval=args.retrieval)
+        except load_stage("token_budget").BudgetExceeded as e:
+            print(f"Budget reached, stopping the rebuild: {e}")
+            break
+        records_rebuilt += 1
+        print(f"Rebuilt {record.get('Email')}: ran {', '.join(ran_steps) or 'nothing'}")
+        # Persist after every record so an interrupted rebuild keeps its progress.
+        write_json_atomic(records, args.input_json)
+
+    if args.dry_run:
+        print(f"Dry run: {total_stale} stale step(s) across {len(records)} record(s).")
+        return
+
+    if args.adopt_missing or records_rebuilt:
+        write_json_atomic(records, args.input_json)
+        write_csv(records, args.output_csv, generation.get_desired_columns(None))
+    print(f"Rebuild complete: {records_rebuilt} record(s) regenerated, "
+          f"{len(records) - records_rebuilt} unchanged.")
+
+########################################
+# merge: combine the outputs of "--shard i/N" runs (see sharding.py)
+#
+# Records are ordered like the stage's input (by Email), so the merged file
+# is the same no matter how many shards produced it or when they finished.
+# Files served by the review frontend are replaced under its lock, keeping
+# reviewer edits (record_files.replace_records).
+########################################
+MERGE_TARGETS = {
+    "1": {"outputs": ["1perplexity_results.csv", "1perplexity_results.jsonl"],
+          "order_from": os.path.join(input_dir, "apollo-contacts-export.csv")},
+    "3": {"outputs": ["2final_combined_research_results.json", "2final_combined_research_results.csv"],
+          "order_from": os.path.join(output_dir, "1perplexity_results.json")},
+    "6": {"outputs": ["4cited_deduplicated_content.json"],
+          "order_from": os.path.join(output_dir, "3final_combined_research_cited.json")},
+    "7": {"outputs": ["5html_converted_content.json"], "reviewed": True,
+          "order_from": os.path.join(output_dir, "4cited_deduplicated_content.json")},
+    "9": {"outputs": ["6email_feedback.json"], "reviewed": True,
+          "order_from": os.path.join(output_dir, "5html_converted_content.json")},
+}
+
+def read_any_records(path: str) -> tuple:
+    """
+    Return (records, fieldnames) from a .json array, .jsonl or .csv file.
+    fieldnames is the CSV header (None for JSON).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            return list(reader), reader.fieldnames or []
+    if ext == ".jsonl":
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()], None
+    return load_json_records(path), None
+
+def input_order(path: str) -> dict:
+    if not path or not os.path.exists(path):
+        return {}
+    records, _ = read_any_records(path)
+    order = {}
+    for record in records:
+        email = (record.get("Email") or "").strip()
+        if email and email not in order:
+            order[email] = len(order)
+    return order
+
+def merge_shard_records(shard_records: list, order: dict) -> list:
+    # Later rows of a shard win (resumed runs append), then sort by input position.
+    by_email = {}
+    for records in shard_records:
+        for record in records:
+            by_email[(record.get("Email") or "").strip()] = record
+    unknown = len(order)
+    return [by_email[email] for email in sorted(by_email, key=lambda e: (order.get(e, unknown), e))]
+
+def merge_output(path: str, count: int, order: dict, reviewed: bool, allow_missing: bool) -> int:
+    sharding = load_stage("sharding")
+    paths = sharding.shard_paths(path, count)
+    missing = [p for p in paths if not os.path.exists(p)]
+    if missing and not allow_missing:
+        raise SystemExit("Missing shard output(s):\n  " + "\n  ".join(missing))
+
+    shard_records, fieldnames = [], []
+    for shard_file in paths:
+        if shard_file in missing:
+            continue
+        records, header = read_any_records(shard_file)
+        shard_records.append(records)
+        for name in header or []:
+            if name not in fieldnames:
+                fieldnames.append(name)
+    merged = merge_shard_records(shard_records, order)
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        write_csv(merged, path, fieldnames)
+    elif ext == ".jsonl":
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in merged:
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, path)
+    elif reviewed:
+        record_files = load_stage("record_files")
+        events = load_stage("events")
+        record_files.replace_records(path, merged)
+        events.EventLog().publish("records_replaced", stage="merge", file=os.path.basename(path), total=len(merged))
+    else:
+        write_json_atomic(merged, path)
+    return len(merged)
+
+def merge(args):
+    if args.output:
+        targets = [(args.output, False)]
+        order_from = args.order_from
+    else:
+        target = MERGE_TARGETS[args.stage]
+        targets = [(os.path.join(output_dir, name), target.get("reviewed", False)) for name in target["outputs"]]
+        order_from = args.order_from or target["order_from"]
+    order = input_order(order_from)
+    if not order:
+        print(f"No input order found in {order_from}; merged records are sorted by Email.")
+    for path, reviewed in targets:
+        total = merge_output(path, args.shards, order, reviewed, args.allow_missing)
+        print(f"Merged {args.shards} shard(s) into {path}: {total} record(s)")
+
+########################################
+# queue: run stage 1 or 3 from a lease-based work queue (see work_queue.py)
+#
+#   enqueue  add the stage's pending contacts (those not in its output yet)
+#   work     lease and process tasks until none are left; start as many as
+#            you like, on any machine that can reach the database
+#   status   task counts and failures
+#   collect  merge the finished results into the stage's normal outputs
+#   retry    give failed tasks a fresh set of attempts
+########################################
+QUEUE_STAGES = {
+    "1": {"task": "1perplexity",
+          "input": os.path.join(input_dir, "apollo-contacts-export.csv"),
+          "outputs": [os.path.join(output_dir, "1perplexity_results.csv"),
+                      os.path.join(output_dir, "1perplexity_results.jsonl")]},
+    "3": {"task": "3email_generation",
+          "input": os.path.join(output_dir, "1perplexity_results.json"),
+          "outputs": [os.path.join(output_dir, "2final_combined_research_results.json"),
+                      os.path.join(output_dir, "2final_combined_research_results.csv")]},
+}
+
+def queue_items(stage: str, input_path: str, query_types: list, fused: bool = False, retrieval: bool = True,
+                delta: bool = True, priority: dict = None) -> list:
+    """
+    (email, payload) for every input contact of the stage not already in its
+    outputs, in input order or, with a priority config, by priority.
+    """
+    done = set()
+    for path in QUEUE_STAGES[stage]["outputs"]:
+        if os.path.exists(path):
+            done |= {(r.get("Email") or "").strip() for r in read_any_records(path)[0]}
+    if stage == "1":
+        perplexity = load_stage("1perplexity")
+        records, _ = read_any_records(input_path)
+        if priority is not None:
+            # Scored on the full rows, so custom columns count before contact_from_row drops them
+            records = load_stage("scheduler").order_by_priority(records, priority)
+        items = [(c["Email"], {"contact": c, "query_types": query_types, "delta": delta})
+                 for c in (perplexity.contact_from_row(r) for r in records)]
+    else:
+        generation = load_stage("3email_generation")
+        records = generation.load_input_records(input_path)
+        if priority is not None:
+            records = load_stage("scheduler").order_by_priority(records, priority)
+        items = [((r.get("Email") or "").strip(), {"record": r, "fused": fused, "retrieval": retrieval})
+                 for r in records]
+    return [(email, payload) for email, payload in items if email and email not in done]
+
+def queue_handlers() -> dict:
+    perplexity = load_stage("1perplexity")
+    generation = load_stage("3email_generation")
+    global_vars = generation.load_global_vars()
+    prompt_templates = generation.load_prompt_templates(generation.PROMPT_CONFIGS)
+
+    def research(payload):
+        return perplexity.research_contact(payload["contact"], payload["query_types"], payload.get("delta", True))
+
+    def email(payload):
+        record = payload["record"]
+        generation.process_record(record, prompt_templates, global_vars, fused=payload.get("fused", False),
+                                  retrieval=payload.get("retrieval", True))
+        return record
+
+    return {"1perplexity": research, "3email_generation": email}
+
+def queue_worker(db_path: str, stages: list, lease_seconds: int, worker_id: str, max_tasks: int):
+    work_queue = load_stage("work_queue")
+    token_budget = load_stage("token_budget")
+    work_queue.run_worker(work_queue.WorkQueue(db_path), queue_handlers(), worker_id=worker_id,
+                          stages=stages, lease_seconds=lease_seconds, max_tasks=max_tasks,
+                          stop_on=(token_budget.BudgetExceeded,))
+
+def collect_results(stage: str, results: list):
+    """
+    Merge queue results into the stage's outputs by Email, results winning,
+    in the order of the stage's input.
+    """
+    order = input_order(QUEUE_STAGES[stage]["input"])
+    for path in QUEUE_STAGES[stage]["outputs"]:
+        existing, fieldnames = read_any_records(path) if os.path.exists(path) else ([], None)
+        merged = merge_shard_records([existing, results], order)
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".csv":
+            if stage == "1":
+                query_types = [qt for qt in load_stage("1perplexity").QUERY_CONFIGS if any(qt in r for r in results)]
+                fieldnames = fieldnames or load_stage("1perplexity").get_output_fields(query_types)
+            else:
+                fieldnames = load_stage("3email_generation").get_desired_columns(None)
+            write_csv(merged, path, fieldnames)
+        elif ext == ".jsonl":
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in merged:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(tmp_path, path)
+        else:
+            write_json_atomic(merged, path)
+        print(f"Wrote {len(merged)} record(s) to {path}")
+
+def queue(args):
+    work_queue = load_stage("work_queue")
+    args.db = args.db or work_queue.DEFAULT_DB
+    args.max_attempts = args.max_attempts or work_queue.DEFAULT_MAX_ATTEMPTS
+    args.lease_seconds = args.lease_seconds or work_queue.DEFAULT_LEASE_SECONDS
+    task = QUEUE_STAGES[args.stage]["task"]
+    if args.action == "enqueue":
+        query_types = [qt.strip() for qt in args.query_types.split(",") if qt.strip()] if args.query_types \
+            else list(load_stage("1perplexity").QUERY_CONFIGS)
+        items = queue_items(args.stage, args.input or QUEUE_STAGES[args.stage]["input"], query_types, args.fused,
+                            args.retrieval, not args.full_research, load_stage("scheduler").priority_from_args(args))
+        added = work_queue.WorkQueue(args.db).enqueue(task, items, max_attempts=args.max_attempts, weight=args.weight)
+        print(f"Queued {added} new task(s) for stage {args.stage} ({len(items) - added} already queued)")
+    elif args.action == "work":
+        if args.processes <= 1:
+            queue_worker(args.db, [task], args.lease_seconds, args.worker_id, args.max_tasks)
+            return
+        workers = []
+        for i in range(args.processes):
+            worker_id = f"{args.worker_id}-{i}" if args.worker_id else None
+            process = multiprocessing.Process(target=queue_worker,
+                                              args=(args.db, [task], args.lease_seconds, worker_id, args.max_tasks))
+            process.start()
+            workers.append(process)
+        for process in workers:
+            process.join()
+    elif args.action == "status":
+        work_queue_db = work_queue.WorkQueue(args.db)
+        counts = work_queue_db.counts(task)
+        print(f"Stage {args.stage}: " + ", ".join(f"{status} {counts.get(status, 0)}"
+                                                  for status in ("pending", "leased", "done", "failed")))
+        for failure in work_queue_db.failures(task):
+            print(f"  failed after {failure['attempts']} attempt(s): {failure['email']}: {failure['error']}")
+    elif args.action == "collect":
+        results = [result for _, result in work_queue.WorkQueue(args.db).results(task)]
+        collect_results(args.stage, results)
+    elif args.action == "retry":
+        retried = work_queue.WorkQueue(args.db).retry_failed(task)
+        print(f"Re-queued {retried} failed task(s) for stage {args.stage}")
+
+########################################
+# budget: token and dollar limits for the model calls (see token_budget.py)
+#
+#   set     limit the whole run, one stage or each contact, in dollars and/or
+#           tokens; stages stop admitting contacts (or use cheaper models)
+#           once a limit would be crossed. Without --usd/--tokens the limit
+#           is removed.
+#   status  limits, spend so far, and spend per stage and model
+#   reset   clear the recorded spend (and with --limits, the limits)
+########################################
+def budget(args):
+    token_budget = load_stage("token_budget")
+    ledger = token_budget.Budget(args.db)
+    if args.action == "set":
+        name = {"run": "", "stage": args.name, "contact": args.name or token_budget.ANY_CONTACT}[args.scope]
+        if args.scope == "stage" and not name:
+            raise SystemExit("budget set --scope stage needs --name, e.g. --name 3email_generation")
+        ledger.set_limit(args.scope, name, args.usd, args.tokens)
+        print(" ".join(filter(None, [args.scope, name])) + ": " + ("limit removed" if args.usd is None and args.tokens is None else
+              f"usd {args.usd if args.usd is not None else '-'}, tokens {args.tokens if args.tokens is not None else '-'}"))
+    elif args.action == "status":
+        usd, tokens = ledger.spent()
+        print(f"Spent ${usd:.4f}, {tokens} tokens")
+        usd, tokens = ledger.reserved()
+        if usd or tokens:
+            print(f"Reserved by contacts in progress: ${usd:.4f}, {tokens} tokens")
+        for (scope, name), (limit_usd, limit_tokens) in sorted(ledger.limits().items()):
+            print(f"  limit {' '.join(filter(None, [scope, name]))}: usd {'-' if limit_usd is None else limit_usd}, "
+                  f"tokens {'-' if limit_tokens is None else limit_tokens}")
+        print(f"{'stage':<22}{'model':<22}{'calls':>7}{'prompt':>11}{'completion':>12}{'usd':>11}{'est/actual':>12}")
+        for stage, model, calls, prompt, completion, cost, ratio in ledger.status():
+            print(f"{stage:<22}{model:<22}{calls:>7}{prompt:>11}{completion:>12}{cost:>11.4f}"
+                  f"{'-' if ratio is None else f'{ratio:.2f}':>12}")
+    elif args.action == "reset":
+        ledger.reset(usage=True, limits=args.limits)
+        print("Recorded spend cleared" + (" and limits removed" if args.limits else ""))
+
+########################################
+# kb: the prospect knowledge base stage 1 builds on (see prospect_kb.py)
+########################################
+def kb(args):
+    prospect_kb = load_stage("prospect_kb")
+    store = prospect_kb.ProspectKB(args.db)
+    if args.action == "import":
+        # Earlier stage 1 results become full snapshots dated when they were written
+        perplexity = load_stage("1perplexity")
+        researched_at = args.date or datetime.date.fromtimestamp(os.path.getmtime(args.input)).isoformat()
+        records, _ = read_any_records(args.input)
+        stored = 0
+        for record in records:
+            email = (record.get("Email") or "").strip()
+            for qt in perplexity.QUERY_CONFIGS:
+                text = record.get(qt)
+                if not email or not isinstance(text, str) or not text.strip():
+                    continue
+                if store.latest(email, record.get("Person Linkedin Url"), qt) and not args.force:
+                    continue
+                citations = [c.strip() for c in (record.get(f"{qt}_citations") or "").split(";") if c.strip()]
+                store.store(email, record.get("Person Linkedin Url"), qt, text, citations, prospect_kb.FULL,
+                            researched_at=researched_at)
+                stored += 1
+        print(f"Stored {stored} snapshot(s) from {len(records)} record(s) in {args.input}, dated {researched_at}")
+    elif args.action == "status":
+        print(f"{'query type':<30}{'mode':<8}{'snapshots':>10}{'prospects':>11}{'latest':>13}")
+        for row in store.status():
+            print(f"{row['query_type']:<30}{row['mode']:<8}{row['snapshots']:>10}{row['prospects']:>11}{row['latest']:>13}")
+
+########################################
+# export: write upload CSVs for the declared lists (see exporter.py)
+########################################
+def export(args):
+    exporter = load_stage("exporter")
+    try:
+        results = exporter.run_export(args.lists or exporter.DEFAULT_EXPORTS, args.list_name,
+                                      out_dir=args.export_dir or exporter.export_dir,
+                                      workers=args.workers, mark_exported=not args.no_mark_exported)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    for name, (path, rows) in results.items():
+        print(f"{name}: {rows} record(s) -> {path}")
+
+########################################
+# CLI Argument Parsing
+########################################
+def parse_args():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the email pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_parser = subparsers.add_parser(
+        "rebuild",
+        help="Regenerate only the stage 3 fields whose prompt, model, parameters or inputs changed."
+    )
+    rebuild_parser.add_argument("--input-json", type=str,
+                                default=os.path.join(output_dir, "2final_combined_research_results.json"),
+                                help="Stage 3 JSON output to rebuild in place.")
+    rebuild_parser.add_argument("--output-csv", type=str,
+                                default=os.path.join(output_dir, "2final_combined_research_results.csv"),
+                                help="Stage 3 CSV output rewritten after the rebuild.")
+    rebuild_parser.add_argument("--research-json", type=str,
+                                default=os.path.join(output_dir, "1perplexity_results.json"),
+                                help="Stage 1 research merged in by Email before checking staleness. Pass '' to skip.")
+    rebuild_parser.add_argument("--dry-run", action="store_true",
+                                help="Only report which steps are stale; make no API calls.")
+    rebuild_parser.add_argument("--adopt-missing", action="store_true",
+                                help="Stamp current fingerprints on fields generated before fingerprints existed "
+                                     "instead of regenerating them.")
+    rebuild_parser.add_argument("--fused", action="store_true",
+                                help="Check and regenerate the fused step groups as one structured-output request "
+                                     "each (as 3email_generation.py --fused writes them).")
+    rebuild_parser.add_argument("--no-retrieval", dest="retrieval", action="store_false",
+                                help="Check and regenerate the steps with the full research fields instead of the "
+                                     "retrieved passages (as 3email_generation.py --no-retrieval writes them).")
+    rebuild_parser.set_defaults(func=rebuild)
+
+    export_parser = subparsers.add_parser(
+        "export",
+        help="Write CSV lists of reviewed records in one pass and mark them exported."
+    )
+    export_parser.add_argument("--list-name", type=str, required=True,
+                               help="Prefix of the CSV files, e.g. the campaign name.")
+    export_parser.add_argument("--lists", nargs="+", default=None,
+                               help="Export configs to write, by name (default: DEFAULT_EXPORTS in exporter.py, "
+                                    "reviewed and feedback).")
+    export_parser.add_argument("--export-dir", type=str, default=None,
+                               help="Directory for the CSVs (default: export/).")
+    export_parser.add_argument("--workers", type=int, default=None,
+                               help="Processes for HTML-to-text (default: CPU count; 1 disables the pool).")
+    export_parser.add_argument("--no-mark-exported", action="store_true",
+                               help="Write the CSVs without marking records exported.")
+    export_parser.set_defaults(func=export)
+
+    merge_parser = subparsers.add_parser(
+        "merge",
+        help="Combine the outputs of a stage run with --shard i/N into the normal output files."
+    )
+    target_group = merge_parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument("--stage", choices=sorted(MERGE_TARGETS),
+                              help="Stage whose default outputs to merge.")
+    target_group.add_argument("--output", type=str,
+                              help="Merge the shards of this output path instead (e.g. a custom --output-json).")
+    merge_parser.add_argument("--shards", type=int, required=True, help="N, the number of shards the stage ran with.")
+    merge_parser.add_argument("--order-from", type=str, default=None,
+                              help="File whose Email order the merged records follow (default: the stage's input).")
+    merge_parser.add_argument("--allow-missing", action="store_true",
+                              help="Merge the shards that exist instead of failing when some are missing.")
+    merge_parser.set_defaults(func=merge)
+
+    queue_parser = subparsers.add_parser(
+        "queue",
+        help="Process stage 1 or 3 from a lease-based work queue shared by any number of workers."
+    )
+    queue_parser.add_argument("action", choices=["enqueue", "work", "status", "collect", "retry"])
+    queue_parser.add_argument("--stage", choices=sorted(QUEUE_STAGES), required=True)
+    queue_parser.add_argument("--db", type=str, default=None,
+                              help="SQLite queue database (default: output/work_queue.db or $EMAILPIPE_QUEUE_DB).")
+    queue_parser.add_argument("--input", type=str, default=None,
+                              help="enqueue: the stage's input file (default: its usual input).")
+    queue_parser.add_argument("--query-types", type=str, default="",
+                              help="enqueue, stage 1: comma-separated query types (default: all).")
+    queue_parser.add_argument("--fused", action="store_true",
+                              help="enqueue, stage 3: run the fused step groups (3email_generation.py --fused).")
+    queue_parser.add_argument("--no-retrieval", dest="retrieval", action="store_false",
+                              help="enqueue, stage 3: use the full research fields (3email_generation.py --no-retrieval).")
+    queue_parser.add_argument("--full-research", action="store_true",
+                              help="enqueue, stage 1: run the full queries even for prospects in the knowledge base.")
+    queue_parser.add_argument("--priority", action="store_true",
+                              help="enqueue: queue the contacts by priority score instead of input order.")
+    queue_parser.add_argument("--priority-config", type=str, default=None,
+                              help="enqueue: JSON priority config (see scheduler.py). Implies --priority.")
+    queue_parser.add_argument("--weight", type=float, default=1.0,
+                              help="enqueue: share of the workers this list gets while other queued lists are "
+                                   "pending (weighted fair queuing).")
+    queue_parser.add_argument("--max-attempts", type=int, default=None,
+                              help="enqueue: attempts per task before it is marked failed (default: 3).")
+    queue_parser.add_argument("--processes", type=int, default=1, help="work: worker processes to start.")
+    queue_parser.add_argument("--lease-seconds", type=int, default=None,
+                              help="work: visibility timeout; heartbeats renew it every third of this (default: 300).")
+    queue_parser.add_argument("--worker-id", type=str, default=None, help="work: defaults to host-pid.")
+    queue_parser.add_argument("--max-tasks", type=int, default=None, help="work: stop after this many tasks.")
+    queue_parser.set_defaults(func=queue)
+
+    budget_parser = subparsers.add_parser(
+        "budget",
+        help="Set and inspect dollar/token limits on model calls (run, per stage, per contact)."
+    )
+    budget_parser.add_argument("action", choices=["set", "status", "reset"])
+    budget_parser.add_argument("--scope", choices=["run", "stage", "contact"], default="run",
+                               help="set: what the limit applies to.")
+    budget_parser.add_argument("--name", type=str, default="",
+                               help="set: the stage (e.g. 3email_generation) or contact email; "
+                                    "a contact limit without --name applies to every contact.")
+    budget_parser.add_argument("--usd", type=float, default=None, help="set: dollar limit.")
+    budget_parser.add_argument("--tokens", type=int, default=None, help="set: token limit (prompt + completion).")
+    budget_parser.add_argument("--limits", action="store_true", help="reset: also remove the limits.")
+    budget_parser.add_argument("--db", type=str, default=None,
+                               help="SQLite ledger (default: output/budget.db or $EMAILPIPE_BUDGET_DB).")
+    budget_parser.set_defaults(func=budget)
+
+    kb_parser = subparsers.add_parser(
+        "kb",
+        help="Fill and inspect the prospect knowledge base stage 1 runs delta queries against."
+    )
+    kb_parser.add_argument("action", choices=["import", "status"])
+    kb_parser.add_argument("--input", type=str, default=os.path.join(output_dir, "1perplexity_results.json"),
+                           help="import: stage 1 results (.json, .jsonl or .csv).")
+    kb_parser.add_argument("--date", type=str, default=None,
+                           help="import: research date, YYYY-MM-DD (default: the file's modification date).")
+    kb_parser.add_argument("--force", action="store_true",
+                           help="import: also store research for prospects that already have a snapshot.")
+    kb_parser.add_argument("--db", type=str, default=None,
+                           help="SQLite knowledge base (default: output/prospect_kb.db or $EMAILPIPE_KB_DB).")
+    kb_parser.set_defaults(func=kb)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    profiling = load_stage("profiling")
+    profiling.run("emailpipe", main)
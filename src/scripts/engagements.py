@@ -0,0 +1,173 @@
+import re
+import json
+
+########################################
+# Structured sections of the engagements_combined research
+#
+# The engagements_combined query asks for six sections (casual publications,
+# conferences, events, podcasts, peer-reviewed publications, webinars), and
+# many come back as "No information available". Stage 1 parses the answer
+# into ENGAGEMENT_SECTIONS_FIELD: a JSON list of the sections that have
+# content, each with the citation URLs its [n] markers refer to:
+#
+#   [{"section": "podcast_engagements", "title": "Podcast Engagements",
+#     "text": "...", "citations": {"2": "https://..."}}]
+#
+# Prompts that read {engagements_combined} get prompt_text() instead of the
+# whole answer: only the sections with content. Records without the field
+# (researched before it existed, or answers without recognisable section
+# headings) keep using the full text.
+########################################
+ENGAGEMENT_SECTIONS_FIELD = "engagements_combined_sections"
+NO_INFORMATION = "No information available"
+
+# (key, title as requested in the engagements_combined query)
+SECTIONS = [
+    ("casual_publications", "Casual Publications"),
+    ("conference_engagements", "Conference Engagements"),
+    ("events_engagements", "Events Engagements"),
+    ("podcast_engagements", "Podcast Engagements"),
+    ("peer_reviewed_publications", "Peer-Reviewed Publications"),
+    ("webinar_engagements", "Webinar Engagements"),
+]
+
+# An empty section is short, cites nothing and consists only of sentences
+# saying there is nothing to report
+EMPTY_SECTION_MAX_CHARS = 300
+EMPTY_SENTENCE = (
+    r"(?:no\b[^.!?\n]{0,60}?\b"
+    r"(?:information|results?|records?|data|details|publications?|engagements?|evidence|mentions?"
+    r"|conferences?|events?|podcasts?|webinars?|papers?)\b[^.!?\n]{0,60}"
+    r"|none\b[^.!?\n]{0,60}|not (?:available|found)|n/?a)"
+)
+EMPTY_PATTERN = re.compile(rf"(?:{EMPTY_SENTENCE}[.!]?\s*)+", re.IGNORECASE)
+CITATION_MARKER = re.compile(r"\[(\d+)\]")
+
+
+def heading_pattern(title):
+    # "Podcast Engagements" also matches "Podcasts", "Podcast engagement", ...
+    words = [re.escape(word.lower().rstrip("s")) + "s?" for word in title.replace("-", " ").split()]
+    if len(words) > 1 and words[-1] == "engagements?":
+        body = r"[\s\-]+".join(words[:-1]) + r"(?:[\s\-]+engagements?)?"
+    else:
+        body = r"[\s\-]+".join(words)
+    # At the start of a line, with optional markdown heading, list number and
+    # bold, and followed by a colon or the end of the line (so a sentence
+    # starting with "Conference ..." is not a heading)
+    return re.compile(
+        r"^[ \t]*(?:#{1,6}[ \t]*)?(?:\d+[.)][ \t]*)?(?:\*\*|__)?[ \t]*" + body +
+        r"[ \t]*(?:\*\*|__)?[ \t]*(?::[ \t]*(?:\*\*|__)?|(?=\n|$))",
+        re.IGNORECASE | re.MULTILINE,
+    )
+
+
+HEADINGS = [(key, title, heading_pattern(title)) for key, title in SECTIONS]
+
+
+def split_sections(text):
+    """
+    {section key: body} for the section headings found in text, in order.
+    """
+    found = []
+    for key, title, pattern in HEADINGS:
+        match = pattern.search(text or "")
+        if match:
+            found.append((match.start(), match.end(), key))
+    found.sort()
+    sections = {}
+    for i, (start, end, key) in enumerate(found):
+        stop = found[i + 1][0] if i + 1 < len(found) else len(text)
+        sections[key] = text[end:stop].strip()
+    return sections
+
+
+def is_empty(body):
+    """
+    True if a section body (or a whole answer) reports nothing: no text, or
+    only "no information"-style sentences without citation markers.
+    """
+    if CITATION_MARKER.search(body or ""):
+        return False
+    plain = re.sub(r"[*_`#>\-]", " ", body or "").strip(" \n\t.")
+    if not plain:
+        return True
+    return len(plain) <= EMPTY_SECTION_MAX_CHARS and bool(EMPTY_PATTERN.fullmatch(plain))
+
+
+def parse_sections(text, citations=()):
+    """
+    The sections of an engagements_combined answer that have content, with
+    their citations ({marker number: URL} from the answer's citation list).
+    None if the answer has no recognisable section headings.
+    """
+    bodies = split_sections(text)
+    if not bodies:
+        return None
+    citations = list(citations or [])
+    titles = dict(SECTIONS)
+    sections = []
+    for key, body in bodies.items():
+        if is_empty(body):
+            continue
+        markers = sorted({int(n) for n in CITATION_MARKER.findall(body)})
+        sections.append({
+            "section": key,
+            "title": titles[key],
+            "text": body,
+            "citations": {str(n): citations[n - 1] for n in markers if 0 < n <= len(citations)},
+        })
+    return sections
+
+
+def sections_field(text, citations=()):
+    """
+    The ENGAGEMENT_SECTIONS_FIELD value for a stage 1 record: the parsed
+    sections as JSON, or "" when the answer could not be parsed.
+    """
+    sections = parse_sections(text, citations)
+    return "" if sections is None else json.dumps(sections, ensure_ascii=False)
+
+
+def load_sections(record):
+    """
+    The record's parsed sections, or None if it has none (missing or unreadable field).
+    """
+    value = record.get(ENGAGEMENT_SECTIONS_FIELD)
+    if isinstance(value, list):
+        return value
+    if not isinstance(value, str) or not value.strip():
+        return None
+    try:
+        sections = json.loads(value)
+    except ValueError:
+        return None
+    return sections if isinstance(sections, list) else None
+
+
+def render_sections(sections, links=False):
+    """
+    Sections as prompt text. With links=True citation markers become
+    markdown links ([1](URL)), as stage 4 writes them.
+    """
+    if not sections:
+        return NO_INFORMATION
+    parts = []
+    for section in sections:
+        text = section["text"]
+        if links:
+            urls = section.get("citations") or {}
+            text = CITATION_MARKER.sub(lambda m: f"[{m.group(1)}]({urls[m.group(1)]})" if m.group(1) in urls
+                                       else m.group(0), text)
+        parts.append(f"{section['title']}:\n{text}")
+    return "\n\n".join(parts)
+
+
+def prompt_text(record, links=False):
+    """
+    What prompts get for {engagements_combined}: the sections with content,
+    or the full answer when the record has no parsed sections.
+    """
+    sections = load_sections(record)
+    if sections is None:
+        return record.get("engagements_combined") or ""
+    return render_sections(sections, links)
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are not serialized across processes
+    fcntl = None
+
+########################################
+# Pipeline event log
+#
+# Stages append one JSON object per line to output/events.jsonl, e.g.
+#   {"type": "record_completed", "time": ..., "file": "5html_converted_content.json",
+#    "email": "...", "record": {...}}
+# and readers (the review frontend, the feedback worker) follow the file by
+# byte offset, which doubles as the event id. The log is truncated when a new
+# run starts after it has grown past max_bytes; readers notice the file
+# shrinking and start again from offset 0.
+#
+# Event types:
+#   run_started / run_finished   a stage began or finished writing a file
+#   record_completed             one record of that file is ready
+#   records_replaced             the file was rewritten; reload it
+#   feedback_saved               a reviewer saved email_feedback (frontend)
+#   record_updated               a single record of a file changed (feedback worker)
+########################################
+script_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_EVENTS_FILE = os.path.join(script_dir, "../../output/events.jsonl")
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+
+
+@contextmanager
+def locked(f):
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class EventLog:
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path or os.getenv("EMAILPIPE_EVENTS_FILE", DEFAULT_EVENTS_FILE)
+        self.max_bytes = max_bytes
+
+    def publish(self, event_type, **payload):
+        """
+        Append one event. Failures are reported but never interrupt the stage publishing it.
+        """
+        event = {"type": event_type, "time": time.time(), **payload}
+        line = json.dumps(event, ensure_ascii=False) + "\n"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                with locked(f):
+                    if event_type == "run_started" and f.tell() > self.max_bytes:
+                        f.truncate(0)
+                    f.write(line)
+                    f.flush()
+        except OSError as e:
+            print(f"Could not publish {event_type} event to {self.path}: {e}")
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def read_from(self, offset=0):
+        """
+        Return (events, end_offset) for the complete lines after offset, where
+        events is a list of (offset_after_event, event). Restarts from 0 if the
+        log was truncated.
+        """
+        if self.size() < offset:
+            offset = 0
+        events = []
+        if not os.path.exists(self.path):
+            return events, 0
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # partially written line; pick it up next time
+                offset += len(raw)
+                try:
+                    events.append((offset, json.loads(raw)))
+                except json.JSONDecodeError:
+                    continue
+        return events, offset
+
+    def follow(self, offset=0, poll_interval=0.5, stop_event=None):
+        """
+        Yield (offset, event) pairs as they are appended, forever (or until stop_event is set).
+        """
+        while stop_event is None or not stop_event.is_set():
+            events, offset = self.read_from(offset)
+            for item in events:
+                yield item
+            if not events:
+                time.sleep(poll_interval)
+
+    def pending_run_records(self, file_name):
+        """
+        Records published for file_name by a run that has started but not finished,
+        in publish order, and the log offset they were read up to.
+        """
+        events, offset = self.read_from(0)
+        pending = []
+        for _, event in events:
+            if event.get("file") != file_name:
+                continue
+            if event["type"] in ("run_started", "run_finished"):
+                pending = []
+            elif event["type"] == "record_completed":
+                pending.append(event["record"])
+        return pending, offset
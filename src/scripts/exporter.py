@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+import os
+import csv
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor
+from record_files import iter_records_with_journal, append_journal_patches
+
+########################################
+# Export engine: reviewed records -> CSV lists for upload
+#
+# Each entry in EXPORT_CONFIGS declares one list:
+#   - source:        JSON file the records come from
+#   - filters:       field -> required truthiness
+#   - defaults:      value assumed for a filter field that is missing
+#   - fields:        (CSV column, record field, transform) in column order;
+#                    transform "text" converts HTML to plain text
+#   - mark_exported: set "exported" on the records written to the list
+#
+# Every source file is streamed once per run, one batch of records at a
+# time, however many lists use it; the records seen are the file plus the
+# frontend's unflushed journal, so exports include edits made seconds ago.
+# HTML-to-text runs across a process pool. "exported" marks are appended to the source's journal as
+# field patches (the frontend replays and flushes them) instead of
+# rewriting the whole JSON file.
+########################################
+script_dir = os.path.dirname(__file__)
+output_dir = os.path.join(script_dir, "../../output")
+export_dir = os.path.join(script_dir, "../../export")
+
+CONTACT_FIELDS = [
+    ("Email", "Email", None),
+    ("First Name", "First Name", None),
+    ("Last Name", "Last Name", None),
+    ("Person Linkedin Url", "Person Linkedin Url", None),
+    ("Title", "Title", None),
+]
+MAIN_EMAIL_FIELDS = CONTACT_FIELDS + [
+    ("email_subject_extract", "email_subject_extract", None),
+    ("email_output_final", "email_output_final", "text"),
+]
+FEEDBACK_EMAIL_FIELDS = CONTACT_FIELDS + [
+    ("email_subject_extract_after_feedback", "email_subject_extract_after_feedback", None),
+    ("email_after_feedback", "email_after_feedback", "text"),
+]
+
+EXPORT_CONFIGS = [
+    {
+        # Reviewed and approved without feedback (first review session)
+        "name": "reviewed",
+        "source": os.path.join(output_dir, "5html_converted_content.json"),
+        "filters": {"exclude": False, "email_feedback": False, "flag": False, "viewed": True},
+        "defaults": {"exclude": True, "viewed": True},
+        "fields": MAIN_EMAIL_FIELDS,
+        "mark_exported": True,
+    },
+    {
+        # Records reviewed after the first export (not exported yet)
+        "name": "reviewed_rerun",
+        "source": os.path.join(output_dir, "5html_converted_content.json"),
+        "filters": {"exclude": False, "email_feedback": False, "flag": False, "viewed": True, "exported": False},
+        "defaults": {"exclude": True, "viewed": True},
+        "fields": MAIN_EMAIL_FIELDS,
+        "mark_exported": True,
+    },
+    {
+        # Emails regenerated from reviewer feedback (second review session)
+        "name": "feedback",
+        "source": os.path.join(output_dir, "6email_feedback.json"),
+        "filters": {"exclude": False, "email_feedback": True},
+        "defaults": {"exclude": True},
+        "fields": FEEDBACK_EMAIL_FIELDS,
+        "mark_exported": True,
+    },
+    {
+        "name": "feedback_rerun",
+        "source": os.path.join(output_dir, "6email_feedback.json"),
+        "filters": {"exclude": False, "email_feedback": True, "exported": False},
+        "defaults": {"exclude": True},
+        "fields": FEEDBACK_EMAIL_FIELDS,
+        "mark_exported": True,
+    },
+]
+DEFAULT_EXPORTS = ["reviewed", "feedback"]
+BATCH_SIZE = 512
+MIN_PARALLEL_TEXTS = 256
+
+
+########################################
+# HTML to text
+########################################
+class TextExtractor(HTMLParser):
+    """
+    Collects text nodes; joined with newlines this matches
+    BeautifulSoup(html, "html.parser").get_text(separator="\n"), including its
+    collapsing of whitespace-only nodes to a single newline or space.
+    """
+    SKIP_TAGS = {"script", "style"}
+    PRESERVE_TAGS = {"pre", "textarea"}
+    ASCII_SPACES = str.maketrans("", "", " \t\n\r\f")
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.pending = []
+        self.skip_depth = 0
+        self.preserve_depth = 0
+
+    def flush_data(self):
+        if not self.pending:
+            return
+        data = "".join(self.pending)
+        self.pending = []
+        if self.skip_depth:
+            return
+        if not self.preserve_depth and data.translate(self.ASCII_SPACES) == "":
+            data = "\n" if "\n" in data else " "
+        self.parts.append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_data()
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.PRESERVE_TAGS:
+            self.preserve_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.flush_data()
+
+    def handle_endtag(self, tag):
+        self.flush_data()
+        if tag in self.SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in self.PRESERVE_TAGS and self.preserve_depth:
+            self.preserve_depth -= 1
+
+    def handle_data(self, data):
+        if data:
+            self.pending.append(data)
+
+    def handle_comment(self, data):
+        self.flush_data()
+
+    def handle_decl(self, decl):
+        self.flush_data()
+
+    def close(self):
+        super().close()
+        self.flush_data()
+
+
+def html_to_text(html) -> str:
+    if not isinstance(html, str) or not html:
+        return ""
+    parser = TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return "\n".join(parser.parts)
+
+
+########################################
+# Filtering and rows
+########################################
+def matches(record: dict, config: dict) -> bool:
+    defaults = config.get("defaults", {})
+    for field, wanted in config["filters"].items():
+        if bool(record.get(field, defaults.get(field))) != wanted:
+            return False
+    return True
+
+
+def convert_texts(texts: list, executor) -> list:
+    if executor is None or len(texts) < MIN_PARALLEL_TEXTS:
+        return [html_to_text(t) for t in texts]
+    return list(executor.map(html_to_text, texts, chunksize=64))
+
+
+def export_batch(batch: list, configs: list, writers: dict, exported: dict, executor):
+    # One (record, config) job per list the record belongs to, plus the HTML those rows need converted
+    jobs = []
+    texts = []
+    for record in batch:
+        for config in configs:
+            if matches(record, config):
+                jobs.append((record, config))
+                for _, field, transform in config["fields"]:
+                    if transform == "text":
+                        texts.append(record.get(field, ""))
+    converted = iter(convert_texts(texts, executor))
+    for record, config in jobs:
+        row = {}
+        for column, field, transform in config["fields"]:
+            row[column] = next(converted) if transform == "text" else record.get(field, "")
+        writers[config["name"]].writerow(row)
+        if config.get("mark_exported") and record.get("Email"):
+            exported[config["source"]].add(record["Email"])
+
+
+def run_export(names: list, list_name: str, out_dir: str = export_dir, workers: int = None, mark_exported: bool = True):
+    """
+    Write one CSV per named export config in a single pass over each source.
+    Returns {config name: (csv path, rows written)}.
+    """
+    configs = [c for c in EXPORT_CONFIGS if c["name"] in names]
+    unknown = set(names) - {c["name"] for c in configs}
+    if unknown:
+        raise ValueError(f"Unknown export(s): {', '.join(sorted(unknown))}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    sources = {}
+    for config in configs:
+        sources.setdefault(config["source"], []).append(config)
+
+    files, writers, paths, counts = {}, {}, {}, {}
+    exported = {source: set() for source in sources}
+    executor = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        for config in configs:
+            path = os.path.join(out_dir, f"{list_name}_{config['name']}.csv")
+            paths[config["name"]] = path
+            files[config["name"]] = open(path + ".tmp", "w", newline="", encoding="utf-8")
+            writer = csv.DictWriter(files[config["name"]], fieldnames=[c for c, _, _ in config["fields"]])
+            writer.writeheader()
+            writers[config["name"]] = CountingWriter(writer)
+
+        for source, source_configs in sources.items():
+            batch = []
+            for record in iter_records_with_journal(source):
+                batch.append(record)
+                if len(batch) >= BATCH_SIZE:
+                    export_batch(batch, source_configs, writers, exported, executor)
+                    batch = []
+            if batch:
+                export_batch(batch, source_configs, writers, exported, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for f in files.values():
+            f.close()
+
+    for name, path in paths.items():
+        os.replace(path + ".tmp", path)
+        counts[name] = (path, writers[name].rows)
+
+    if mark_exported:
+        for source, emails in exported.items():
+            if emails:
+                append_journal_patches(source, [{"email": e, "fields": {"exported": True}} for e in sorted(emails)])
+                print(f"Marked {len(emails)} record(s) exported in {source}")
+    return counts
+
+
+class CountingWriter:
+    def __init__(self, writer):
+        self.writer = writer
+        self.rows = 0
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.rows += 1
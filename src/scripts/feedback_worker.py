@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import os
+import time
+import argparse
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from events import EventLog
+from record_files import iter_records_with_journal
+
+########################################
+# On-save feedback regeneration worker
+#
+# Runs next to the review frontend and regenerates the feedback chain of
+# 9feedback.py (content_after_feedback -> email_after_feedback -> subject)
+# for one record as soon as a reviewer saves its email_feedback:
+#
+#   python3 ./src/scripts/feedback_worker.py
+#
+# The frontend publishes a "feedback_saved" event (with the record's Email) to
+# output/events.jsonl once a record's autosaves pause, and the worker reads
+# the record from the reviewed file plus its journal. Saves are debounced per
+# Email here as well, so a reviewer typing feedback triggers one run once
+# they pause; at most --max-workers records are regenerated at a time, and a
+# record saved again while it is running is regenerated once more afterwards.
+# Saves that leave the feedback fingerprint unchanged (see 9feedback.py) are
+# skipped. Each result is journaled into 6email_feedback.json under the
+# frontend's lock and announced with a "record_updated" event, so QA mode
+# shows it within seconds.
+########################################
+script_dir = os.path.dirname(__file__)
+feedback = importlib.import_module("9feedback")
+
+
+class FeedbackWorker:
+    def __init__(self, source_json, output_json, debounce, max_workers, event_log):
+        self.source_json = source_json
+        self.source_file = os.path.basename(source_json)
+        self.output_json = output_json
+        self.debounce = debounce
+        self.event_log = event_log
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.due = {}       # email -> time the debounce expires
+        self.running = set()
+
+    def handle(self, event):
+        if event.get("type") != "feedback_saved" or event.get("file") != self.source_file:
+            return
+        email = event.get("email")
+        if not email:
+            return
+        with self.lock:
+            self.due[email] = time.time() + self.debounce
+
+    def submit_due(self):
+        now = time.time()
+        with self.lock:
+            ready = [email for email, due in self.due.items() if due <= now and email not in self.running]
+            for email in ready:
+                del self.due[email]
+                self.running.add(email)
+                self.executor.submit(self.regenerate, email)
+
+    def saved_record(self, email):
+        """
+        The record as the frontend last saved it: the reviewed file plus its journal.
+        """
+        return next((r for r in iter_records_with_journal(self.source_json) if r.get("Email") == email), None)
+
+    def regenerate(self, email):
+        try:
+            record = self.saved_record(email)
+            if record is None or not (record.get("email_feedback") or "").strip():
+                return
+            prompt_templates = feedback.load_prompt_templates()
+            global_vars = feedback.load_global_vars()
+            existing = next((r for r in iter_records_with_journal(self.output_json) if r.get("Email") == email), None)
+            if feedback.is_feedback_current(record, existing, prompt_templates, global_vars):
+                print(f"Feedback for {email} is unchanged; skipping")
+                return
+            print(f"Regenerating feedback content for {email}")
+            record = feedback.process_feedback_record(dict(record), prompt_templates, global_vars)
+            feedback.upsert_record_to_json(record, self.output_json, existing)
+            self.event_log.publish("record_updated", stage="feedback_worker",
+                                   file=os.path.basename(self.output_json), email=email)
+            print(f"Updated {email} in {self.output_json} (cost ${record['total_cost']:.6f})")
+        except Exception as e:
+            # One failed record (API error, bad template) must not stop the worker.
+            print(f"Feedback regeneration failed for {email}: {e}")
+        finally:
+            with self.lock:
+                self.running.discard(email)
+
+    def run(self, poll_interval=0.5):
+        offset = self.event_log.size()
+        print(f"Watching {self.event_log.path} for saved feedback")
+        while True:
+            events, offset = self.event_log.read_from(offset)
+            for _, event in events:
+                self.handle(event)
+            self.submit_due()
+            time.sleep(poll_interval)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Regenerate QA emails as soon as reviewers save feedback.")
+    parser.add_argument("--input-json", type=str, default=feedback.input_name,
+                        help="JSON file the reviewers edit (events for other files are ignored).")
+    parser.add_argument("--output-json", type=str, default=f"{feedback.output_name}.json")
+    parser.add_argument("--debounce", type=float, default=5.0,
+                        help="Seconds without a new save before a record is regenerated.")
+    parser.add_argument("--max-workers", type=int, default=2,
+                        help="Records regenerated concurrently.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    worker = FeedbackWorker(args.input_json, args.output_json,
+                            args.debounce, args.max_workers, EventLog())
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
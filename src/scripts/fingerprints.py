@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+
+########################################
+# Content fingerprints for generated fields
+#
+# Every generated field (e.g. "email_body") is stored next to a
+# "<output_key>_fingerprint" entry. The fingerprint is a hash over:
+#   - the prompt template text
+#   - the model name and call parameters
+#   - the hash of every input variable the template actually references
+#
+# If any of these change, the fingerprint changes, and the field (plus every
+# field that reads it) is stale. Because downstream fingerprints include the
+# hash of upstream *outputs*, a regenerated field that comes back identical
+# does not invalidate anything after it.
+########################################
+FINGERPRINT_VERSION = 1
+
+
+def fingerprint_key(output_key: str) -> str:
+    return f"{output_key}_fingerprint"
+
+
+def hash_text(value) -> str:
+    """
+    Return a short, stable sha256 hex digest for a string (or any JSON-serialisable value).
+    """
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+
+
+def template_inputs(template: str, variables: dict) -> list:
+    """
+    Return the variable names (in sorted order) whose "{name}" placeholder appears in the template.
+    Mirrors get_prompt(), which only substitutes keys present in the variables dict.
+    """
+    return sorted(key for key in variables if "{" + key + "}" in template)
+
+
+def compute_fingerprint(template: str, model_name: str, params: dict, variables: dict) -> str:
+    """
+    Build the fingerprint for one prompt step from its template, model, parameters
+    and the current values of the input variables it references.
+    """
+    inputs = {key: hash_text(variables[key]) for key in template_inputs(template, variables)}
+    payload = {
+        "version": FINGERPRINT_VERSION,
+        "template": hash_text(template),
+        "model": model_name,
+        "params": params,
+        "inputs": inputs,
+    }
+    return hash_text(payload)
+
+
+def is_stale(record: dict, output_key: str, fingerprint: str) -> bool:
+    """
+    A field is stale when it was never generated or was generated from different inputs.
+    """
+    if output_key not in record or record.get(output_key) in (None, ""):
+        return True
+    return record.get(fingerprint_key(output_key)) != fingerprint
@@ -0,0 +1,116 @@
+import json
+
+########################################
+# Fused prompt steps with structured (JSON schema) output
+#
+# Some steps of a prompt chain only reshape the previous step's text
+# (email_body -> email_output_final, email_subject -> email_subject_extract).
+# A fused group runs such consecutive steps as one request: the steps'
+# prompt templates are combined into one prompt ("Task 1", "Task 2", ...,
+# later tasks referring to earlier results instead of the placeholders), and
+# the model answers with a JSON object holding every step's output key,
+# enforced with a JSON schema response_format.
+#
+# Groups are declared next to the chain's PROMPT_CONFIGS, e.g.
+#   {"name": "email_subject_fused", "steps": ["email_subject", "email_subject_extract"],
+#    "model_name": "o3-mini", "max_completion_tokens": 4000}
+# and only used when a stage runs with --fused. parse_outputs() returns the
+# outputs that validate, in step order; the stage runs the remaining steps
+# one by one as usual.
+########################################
+
+def execution_units(prompt_configs: list, fused_groups: list) -> list:
+    """
+    The chain as a list of units to run in order. A unit is a dict with the
+    step configs it covers, the model and max tokens of its request, and
+    whether it is fused. Steps not in a group are units of their own.
+    """
+    by_name = {cfg["name"]: cfg for cfg in prompt_configs}
+    first_steps = {group["steps"][0]: group for group in fused_groups}
+    grouped = {step for group in fused_groups for step in group["steps"]}
+    names = [cfg["name"] for cfg in prompt_configs]
+    units = []
+    for cfg in prompt_configs:
+        group = first_steps.get(cfg["name"])
+        if group:
+            start = names.index(cfg["name"])
+            if names[start:start + len(group["steps"])] != group["steps"]:
+                raise ValueError(f"Fused group {group['name']} must list consecutive steps of the chain in order")
+            units.append({
+                "name": group["name"],
+                "configs": [by_name[step] for step in group["steps"]],
+                "model_name": group["model_name"],
+                "max_completion_tokens": group.get("max_completion_tokens", 4000),
+                "fused": True,
+            })
+        elif cfg["name"] not in grouped:
+            units.append({
+                "name": cfg["name"],
+                "configs": [cfg],
+                "model_name": cfg["model_name"],
+                "max_completion_tokens": cfg.get("max_completion_tokens", 4000),
+                "fused": False,
+            })
+    return units
+
+
+def fused_template(configs: list, prompt_templates: dict) -> str:
+    """
+    One prompt template for the fused steps. Placeholders of outputs produced
+    inside the group become references to the task that produces them, so
+    the result only has the placeholders the group reads from outside.
+    """
+    keys = [cfg["output_key"] for cfg in configs]
+    parts = [
+        f"You will complete {len(configs)} tasks in order. Later tasks use the results of earlier tasks.",
+    ]
+    for i, cfg in enumerate(configs):
+        template = prompt_templates[cfg["name"]]
+        for j, key in enumerate(keys[:i]):
+            template = template.replace("{" + key + "}", f"[the result of Task {j + 1}]")
+        parts.append(f"### Task {i + 1} ({keys[i]})\n{template.strip()}")
+    parts.append(
+        "### Output\n"
+        "Respond with only a JSON object with the keys " + ", ".join(f'"{key}"' for key in keys) +
+        ". The value of each key is the complete result of its task as a string, exactly as you would "
+        "have answered that task on its own."
+    )
+    return "\n\n".join(parts) + "\n"
+
+
+def output_schema(configs: list) -> dict:
+    keys = [cfg["output_key"] for cfg in configs]
+    return {
+        "type": "object",
+        "properties": {key: {"type": "string"} for key in keys},
+        "required": keys,
+        "additionalProperties": False,
+    }
+
+
+def response_format(name: str, configs: list) -> dict:
+    """
+    The response_format for a structured-output chat completion of the group.
+    """
+    return {"type": "json_schema", "json_schema": {"name": name, "schema": output_schema(configs), "strict": True}}
+
+
+def parse_outputs(content: str, configs: list) -> dict:
+    """
+    The validated outputs of a fused response, keyed by output key. Steps are
+    accepted in order up to the first missing, empty or non-string value,
+    since later steps were derived from it; an unparseable response gives {}.
+    """
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    outputs = {}
+    for cfg in configs:
+        value = data.get(cfg["output_key"])
+        if not isinstance(value, str) or not value.strip():
+            break
+        outputs[cfg["output_key"]] = value.strip()
+    return outputs
@@ -0,0 +1,129 @@
+import os
+import json
+
+########################################
+# Incremental reading and writing of JSON array files
+#
+# The stage outputs are single JSON arrays of records. iter_records() yields
+# the records of such a file one at a time, reading it in chunks, and
+# ArrayWriter writes records one at a time as they are produced, so a stage
+# holds one record in memory instead of the whole list. ArrayWriter output
+# is byte-for-byte what json.dump(records, f, indent=2) writes, so files look
+# the same however they were produced.
+########################################
+CHUNK_SIZE = 1 << 16
+WHITESPACE = " \t\n\r"
+
+
+def iter_records(path, chunk_size=CHUNK_SIZE):
+    """
+    Yield the elements of the top-level JSON array in `path`, one at a time.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf, pos = "", 0
+        read_size = chunk_size
+        started = False
+
+        def more():
+            # Drop what has been consumed and append the next chunk; False at end of file
+            nonlocal buf, pos
+            chunk = f.read(read_size)
+            buf = buf[pos:] + chunk
+            pos = 0
+            return bool(chunk)
+
+        while True:
+            while True:
+                while pos < len(buf) and buf[pos] in WHITESPACE:
+                    pos += 1
+                if pos < len(buf) or not more():
+                    break
+            if pos >= len(buf):
+                message = "Unterminated array" if started else "Expecting value"
+                raise json.JSONDecodeError(message, buf, pos)
+
+            char = buf[pos]
+            if not started:
+                if char != "[":
+                    raise ValueError(f"{path} does not contain a JSON array")
+                started = True
+                pos += 1
+                continue
+            if char == "]":
+                return
+            if char == ",":
+                pos += 1
+                continue
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # The record continues past the buffer; read bigger chunks until it fits
+                if not more():
+                    raise
+                read_size *= 2
+                continue
+            if end == len(buf) and not isinstance(record, (dict, list, str)) and more():
+                continue  # a bare number may continue in the next chunk
+            pos = end
+            read_size = chunk_size
+            yield record
+
+
+def count_records(path):
+    return sum(1 for _ in iter_records(path))
+
+
+class ArrayWriter:
+    """
+    Write records to a JSON array file one at a time:
+
+        with ArrayWriter(path) as writer:
+            for record in records:
+                writer.write(record)
+
+    With atomic=True the array is written to "<path>.tmp" and moved over
+    `path` only when the block finishes without an error. With atomic=False
+    it is written in place and flushed after every record.
+    """
+    def __init__(self, path, indent=2, ensure_ascii=True, atomic=True):
+        self.path = path
+        self.indent = indent
+        self.ensure_ascii = ensure_ascii
+        self.atomic = atomic
+        self.write_path = path + ".tmp" if atomic else path
+        self.file = None
+        self.count = 0
+
+    def __enter__(self):
+        self.file = open(self.write_path, "w", encoding="utf-8")
+        return self
+
+    def write(self, record):
+        text = json.dumps(record, indent=self.indent, ensure_ascii=self.ensure_ascii)
+        if self.indent is not None:
+            pad = " " * self.indent if isinstance(self.indent, int) else self.indent
+            text = pad + text.replace("\n", "\n" + pad)
+            self.file.write(("[\n" if self.count == 0 else ",\n") + text)
+        else:
+            self.file.write(("[" if self.count == 0 else ", ") + text)
+        self.count += 1
+        if not self.atomic:
+            self.file.flush()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            if self.count == 0:
+                self.file.write("[]")
+            else:
+                self.file.write("\n]" if self.indent is not None else "]")
+            self.file.flush()
+            if self.atomic:
+                os.fsync(self.file.fileno())
+        self.file.close()
+        if self.atomic:
+            if exc_type is None:
+                os.replace(self.write_path, self.path)
+            elif os.path.exists(self.write_path):
+                os.remove(self.write_path)
+        return False
@@ -0,0 +1,185 @@
+import os
+import asyncio
+import threading
+import importlib.util
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from openai import AzureOpenAI, AsyncAzureOpenAI
+
+# Load environment variables from .env
+load_dotenv()
+
+########################################
+# Shared LLM clients
+#
+# One long-lived client per endpoint and process, so connection setup
+# (TCP + TLS) is paid once instead of on every call:
+#   - Azure OpenAI: AzureOpenAI / AsyncAzureOpenAI on pooled httpx clients
+#     (keep-alive, and HTTP/2 through httpx[http2] in requirements.txt;
+#     without the h2 package they fall back to HTTP/1.1)
+#   - Perplexity: a requests.Session with a pooled adapter; calls time out
+#     after PERPLEXITY_TIMEOUT unless the caller passes its own timeout
+#
+# MODEL_PROFILES holds the per-model request parameters (timeout and which
+# max-token parameter the model takes). Stages pass their own system prompt
+# and reasoning efforts, e.g.
+#   call_azure("o3-mini", prompt, 10000, system_prompt=..., reasoning_effort={"o3-mini": "medium"})
+# Settings are read from the environment when a client is first created.
+########################################
+API_VERSION = "2024-12-01-preview"
+DEFAULT_SYSTEM_PROMPT = "You are an early stage entrepreneur reaching out to people to conduct needs assessment."
+POOL_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=120)
+HTTP2 = importlib.util.find_spec("h2") is not None
+# (connect, read) seconds; reasoning models can take minutes to answer
+PERPLEXITY_TIMEOUT = (10, 600)
+
+# Matched by model name prefix
+MODEL_PROFILES = {
+    "o1": {"timeout": 600, "token_param": "max_completion_tokens"},
+    "o3-mini": {"timeout": 6000, "token_param": "max_completion_tokens"},
+    "gpt-4o": {"timeout": 600, "token_param": "max_tokens"},
+}
+DEFAULT_PROFILE = {"timeout": 60, "token_param": "max_completion_tokens"}
+
+_lock = threading.Lock()
+_azure_client = None
+_async_azure_clients = {}
+_perplexity_session = None
+
+
+def model_profile(model_name: str) -> dict:
+    for prefix, profile in MODEL_PROFILES.items():
+        if model_name.startswith(prefix):
+            return profile
+    return DEFAULT_PROFILE
+
+
+########################################
+# Azure OpenAI
+########################################
+def get_azure_client() -> AzureOpenAI:
+    global _azure_client
+    with _lock:
+        if _azure_client is None:
+            _azure_client = AzureOpenAI(
+                azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+                api_key=os.getenv("OPENAI_API_KEY"),
+                api_version=API_VERSION,
+                http_client=httpx.Client(http2=HTTP2, limits=POOL_LIMITS),
+            )
+        return _azure_client
+
+
+def get_async_azure_client() -> AsyncAzureOpenAI:
+    # httpx async pools belong to one event loop, so there is a client per loop
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_azure_clients.get(loop)
+        if client is None:
+            client = _async_azure_clients[loop] = AsyncAzureOpenAI(
+                azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+                api_key=os.getenv("OPENAI_API_KEY"),
+                api_version=API_VERSION,
+                http_client=httpx.AsyncClient(http2=HTTP2, limits=POOL_LIMITS),
+            )
+        return client
+
+
+def chat_request(model_name: str, prompt_text: str, max_tokens, system_prompt: str, reasoning_effort,
+                 response_format: dict = None) -> dict:
+    """
+    The chat.completions.create() arguments for one call. max_tokens=None
+    leaves the limit to the model; reasoning_effort maps a model prefix to
+    the effort to send (models without an entry get none); response_format
+    requests structured output (e.g. a JSON schema, see fused_prompts.py).
+    """
+    profile = model_profile(model_name)
+    request = {
+        "model": model_name,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt_text},
+        ],
+        "timeout": profile["timeout"],
+    }
+    if max_tokens is not None:
+        request[profile["token_param"]] = max_tokens
+    for prefix, effort in (reasoning_effort or {}).items():
+        if model_name.startswith(prefix) and effort:
+            request["reasoning_effort"] = effort
+            break
+    if response_format:
+        request["response_format"] = response_format
+    return request
+
+
+def parse_response(response) -> (str, dict):
+    content = response.choices[0].message.content.strip()
+    usage = response.usage if hasattr(response, "usage") else {}
+    if hasattr(usage, "dict"):
+        usage = usage.dict()
+    return content, usage
+
+
+def call_azure(model_name: str, prompt_text: str, max_tokens, system_prompt: str = DEFAULT_SYSTEM_PROMPT,
+               reasoning_effort: dict = None, response_format: dict = None) -> (str, dict):
+    """
+    Run one chat completion on the shared client; returns (content, usage dict).
+    """
+    request = chat_request(model_name, prompt_text, max_tokens, system_prompt, reasoning_effort, response_format)
+    client = get_azure_client()
+    try:
+        response = client.chat.completions.create(**request)
+    except TypeError as e:
+        # Older SDKs do not accept reasoning_effort
+        if "reasoning_effort" not in str(e):
+            raise
+        request.pop("reasoning_effort", None)
+        response = client.chat.completions.create(**request)
+    return parse_response(response)
+
+
+async def async_call_azure(model_name: str, prompt_text: str, max_tokens, system_prompt: str = DEFAULT_SYSTEM_PROMPT,
+                           reasoning_effort: dict = None, response_format: dict = None) -> (str, dict):
+    request = chat_request(model_name, prompt_text, max_tokens, system_prompt, reasoning_effort, response_format)
+    client = get_async_azure_client()
+    try:
+        response = await client.chat.completions.create(**request)
+    except TypeError as e:
+        if "reasoning_effort" not in str(e):
+            raise
+        request.pop("reasoning_effort", None)
+        response = await client.chat.completions.create(**request)
+    return parse_response(response)
+
+
+########################################
+# Perplexity
+########################################
+def perplexity_url() -> str:
+    return os.getenv("PERPLEXITY_API_URL", "https://api.perplexity.ai/chat/completions")
+
+
+def get_perplexity_session() -> requests.Session:
+    global _perplexity_session
+    with _lock:
+        if _perplexity_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Authorization": f"Bearer {os.getenv('PERPLEXITY_API_KEY')}",
+                "Content-Type": "application/json",
+            })
+            _perplexity_session = session
+        return _perplexity_session
+
+
+def post_perplexity(payload: dict, timeout=PERPLEXITY_TIMEOUT) -> requests.Response:
+    """
+    POST a chat completion payload to Perplexity on the shared session.
+    """
+    return get_perplexity_session().post(perplexity_url(), json=payload, timeout=timeout)
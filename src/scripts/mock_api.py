@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+########################################
+# Local stand-in for the Perplexity and Azure OpenAI chat APIs
+#
+# Serves the two contracts the pipeline uses, so stages can run end to end
+# without spending money:
+#   POST /chat/completions                                  (Perplexity, perform_query)
+#   POST /openai/deployments/<model>/chat/completions?...   (Azure OpenAI, call_azure)
+#
+# Each response is delayed by a lognormal latency drawn per model, and a
+# configurable fraction of requests fail with 429 (with Retry-After) or 500.
+# Perplexity answers carry a <think> block, inline [n] markers and a
+# citations list; Azure answers are markdown with [n](url) links, or HTML
+# when the system prompt asks for an HTML conversion (7convert_to_html.py).
+#
+# Point the pipeline at it with:
+#   PERPLEXITY_API_URL=http://127.0.0.1:<port>/chat/completions
+#   AZURE_ENDPOINT=http://127.0.0.1:<port>
+########################################
+# model -> (median latency in seconds, lognormal sigma)
+DEFAULT_LATENCIES = {
+    "sonar-reasoning-pro": (8.0, 0.5),
+    "sonar-reasoning": (6.0, 0.5),
+    "sonar-pro": (5.0, 0.5),
+    "sonar": (2.0, 0.4),
+    "o1": (20.0, 0.5),
+    "o3-mini": (6.0, 0.5),
+    "gpt-4o": (3.0, 0.4),
+}
+FALLBACK_LATENCY = (3.0, 0.5)
+
+FILLER = ("The prospect leads a team focused on improving clinical outcomes and operational efficiency "
+          "across the organization, with recent work on data platforms, partnerships and patient access").split()
+
+
+class MockConfig:
+    def __init__(self, latencies=None, latency_scale=1.0, rate_429=0.0, rate_500=0.0,
+                 retry_after=1.0, response_words=300, citations=4, seed=None):
+        self.latencies = dict(DEFAULT_LATENCIES)
+        self.latencies.update(latencies or {})
+        self.latency_scale = latency_scale
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.retry_after = retry_after
+        self.response_words = response_words
+        self.citations = citations
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def draw(self, model):
+        """
+        (latency in seconds, injected status or None) for one request.
+        """
+        median, sigma = self.latencies.get(model, FALLBACK_LATENCY)
+        with self.lock:
+            latency = self.random.lognormvariate(0, sigma) * median * self.latency_scale
+            roll = self.random.random()
+        if roll < self.rate_429:
+            return latency * 0.1, 429
+        if roll < self.rate_429 + self.rate_500:
+            return latency, 500
+        return latency, None
+
+    def count(self, model, status):
+        with self.lock:
+            model_stats = self.stats.setdefault(model, {})
+            model_stats[status] = model_stats.get(status, 0) + 1
+
+
+########################################
+# Canned responses
+########################################
+def words(count, seed_text):
+    offset = sum(map(ord, seed_text)) % len(FILLER)
+    return [FILLER[(offset + i) % len(FILLER)] for i in range(count)]
+
+
+def answer_text(prompt, config, max_tokens):
+    # Roughly response_words words, split into paragraphs, with one citation marker per paragraph.
+    count = max(20, min(config.response_words, int((max_tokens or 4000) * 0.75)))
+    body = words(count, prompt)
+    paragraphs = []
+    for i in range(0, count, 60):
+        marker = (len(paragraphs) % max(config.citations, 1)) + 1
+        paragraphs.append(" ".join(body[i:i + 60]) + f" [{marker}].")
+    return paragraphs
+
+
+def citation_urls(prompt, config):
+    slug = re.sub(r"[^a-z0-9]+", "-", prompt[:40].lower()).strip("-") or "source"
+    return [f"https://example.com/{slug}/{i + 1}" for i in range(config.citations)]
+
+
+def perplexity_response(payload, config):
+    prompt = " ".join(m.get("content", "") for m in payload.get("messages", []))
+    paragraphs = answer_text(prompt, config, payload.get("max_tokens"))
+    content = "<think>\n" + " ".join(words(80, prompt[::-1])) + "\n</think>\n\n" + "\n\n".join(paragraphs)
+    return {
+        "id": f"mock-{time.time_ns()}",
+        "model": payload.get("model"),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "citations": citation_urls(prompt, config),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": usage(prompt, content),
+    }
+
+
+def azure_response(model, payload, config):
+    messages = payload.get("messages", [])
+    system = " ".join(m.get("content", "") for m in messages if m.get("role") == "system")
+    prompt = " ".join(m.get("content", "") for m in messages if m.get("role") != "system")
+    max_tokens = payload.get("max_completion_tokens") or payload.get("max_tokens")
+    urls = citation_urls(prompt, config)
+    paragraphs = answer_text(prompt, config, max_tokens)
+
+    def link(match, html):
+        url = urls[(int(match.group(1)) - 1) % len(urls)]
+        return f'<a href="{url}" target="_blank">[{match.group(1)}]</a>' if html else f"[{match.group(1)}]({url})"
+
+    response_format = payload.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        # Structured output: every property of the schema gets an answer
+        keys = response_format.get("json_schema", {}).get("schema", {}).get("properties", {})
+        content = json.dumps({key: "\n\n".join(paragraphs) for key in keys})
+    elif "HTML" in system:
+        content = "\n".join("<p>" + re.sub(r"\[(\d+)\]", lambda m: link(m, True), p) + "</p>" for p in paragraphs)
+    else:
+        content = "\n\n".join(re.sub(r"\[(\d+)\]", lambda m: link(m, False), p) for p in paragraphs)
+    return {
+        "id": f"chatcmpl-mock-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": usage(prompt, content),
+    }
+
+
+def usage(prompt, content):
+    # About 4/3 tokens per word
+    prompt_tokens = len(prompt.split()) * 4 // 3
+    completion_tokens = len(content.split()) * 4 // 3
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+########################################
+# HTTP server
+########################################
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self.send_json(400, {"error": {"message": "Invalid JSON body"}})
+            return
+
+        path = self.path.split("?", 1)[0]
+        deployment = re.match(r"^/openai/deployments/([^/]+)/chat/completions$", path)
+        if deployment:
+            model = deployment.group(1)
+        elif path.rstrip("/").endswith("/chat/completions"):
+            model = payload.get("model", "")
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {path}"}})
+            return
+
+        latency, injected = self.config.draw(model)
+        time.sleep(latency)
+        self.config.count(model, injected or 200)
+        if injected == 429:
+            self.send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded. Try again later."}},
+                           {"Retry-After": str(self.config.retry_after),
+                            "retry-after-ms": str(int(self.config.retry_after * 1000))})
+        elif injected == 500:
+            self.send_json(500, {"error": {"code": "500", "message": "The server had an error processing your request."}})
+        elif deployment:
+            self.send_json(200, azure_response(model, payload, self.config))
+        else:
+            self.send_json(200, perplexity_response(payload, self.config))
+
+
+def make_server(config, host="127.0.0.1", port=0):
+    """
+    A ThreadingHTTPServer serving the mock APIs (port 0 picks a free port).
+    """
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_server(config, host="127.0.0.1", port=0):
+    """
+    Serve in a background thread; returns (server, base_url).
+    """
+    server = make_server(config, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def parse_latency(value):
+    """
+    argparse type for "model=median[:sigma]" (seconds).
+    """
+    try:
+        model, spec = value.split("=", 1)
+        median, _, sigma = spec.partition(":")
+        return model, (float(median), float(sigma) if sigma else FALLBACK_LATENCY[1])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected model=median[:sigma], got '{value}'")
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--latency", type=parse_latency, action="append", default=[],
+                        help="Per-model latency as model=median_seconds[:sigma]; repeatable.")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="Multiply every latency (e.g. 0.01 to measure pipeline overhead only).")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered with 429.")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="Fraction of requests answered with 500.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s.")
+    parser.add_argument("--response-words", type=int, default=300, help="Approximate words per answer.")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args):
+    return MockConfig(latencies=dict(args.latency), latency_scale=args.latency_scale,
+                      rate_429=args.rate_429, rate_500=args.rate_500, retry_after=args.retry_after,
+                      response_words=args.response_words, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve mock Perplexity and Azure OpenAI chat completion APIs.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    server = make_server(config_from_args(args), args.host, args.port)
+    base_url = f"http://{args.host}:{server.server_address[1]}"
+    print("Mock APIs listening. Point the pipeline at them with:")
+    print(f"  export PERPLEXITY_API_URL={base_url}/chat/completions")
+    print(f"  export AZURE_ENDPOINT={base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
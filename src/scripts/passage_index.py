@@ -0,0 +1,172 @@
+import re
+import math
+from collections import Counter
+from functools import lru_cache
+from token_budget import count_tokens
+
+########################################
+# Per-record passage retrieval (BM25) for prompt variables
+#
+# The research fields (engagements_combined, background,
+# roles_and_responsibilities) can add up to many thousands of tokens, and
+# several prompts of the chain read all of them. A step whose config has a
+# "retrieval" entry gets only the passages of those fields that best match a
+# query built from other variables, under a token budget:
+#
+#   "retrieval": {
+#       "fields": ["engagements_combined", "background", "roles_and_responsibilities"],
+#       "query": ["offering", "current_focus"],
+#       "top_k": 8,
+#       "max_tokens": 1500,
+#   }
+#
+# Passages are the fields' paragraphs (long ones split into lines, then
+# sentences), with citation markers kept as they are. Selected passages are
+# put back in their original order, per field. If the fields already fit
+# max_tokens they are left whole.
+########################################
+NO_PASSAGES = "No relevant information found"
+MAX_PASSAGE_TOKENS = 200
+DEFAULT_TOP_K = 8
+DEFAULT_MAX_TOKENS = 1500
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers
+him his how i if in into is it its itself just me more most my no nor not of off on once only or other our ours
+out over own same she should so some such than that the their theirs them then there these they this those
+through to too under until up very was we were what when where which while who whom why will with would you
+your yours also its it's
+""".split())
+WORD = re.compile(r"[a-z][a-z0-9'\-]*")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[A-Z\[\(\"'*-])")
+
+
+def tokenize(text: str) -> list:
+    """
+    Lowercased word terms of text, without stopwords and citation numbers.
+    """
+    return [w.strip("'-") for w in WORD.findall((text or "").lower()) if w.strip("'-") not in STOPWORDS]
+
+
+def split_passages(text: str, max_tokens: int = MAX_PASSAGE_TOKENS) -> list:
+    """
+    The paragraphs of text; paragraphs over max_tokens are split into their
+    lines, and lines still over it into sentences.
+    """
+    passages = []
+    for paragraph in re.split(r"\n\s*\n", text or ""):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= max_tokens:
+            passages.append(paragraph)
+            continue
+        for line in paragraph.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if count_tokens(line) <= max_tokens:
+                passages.append(line)
+            else:
+                passages.extend(s.strip() for s in SENTENCE_END.split(line) if s.strip())
+    return passages
+
+
+class PassageIndex:
+    """
+    BM25 index over the passages of some fields of a record.
+    """
+
+    def __init__(self, sources):
+        # sources: (field, text) pairs
+        self.passages = []  # (field, passage text)
+        self.terms = []     # Counter of terms per passage
+        for field, text in sources:
+            for passage in split_passages(text):
+                self.passages.append((field, passage))
+                self.terms.append(Counter(tokenize(passage)))
+        self.lengths = [sum(terms.values()) for terms in self.terms]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        df = Counter(term for terms in self.terms for term in terms)
+        n = len(self.passages)
+        self.idf = {term: math.log(1 + (n - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+
+    def scores(self, query: str) -> list:
+        # Sorted, so the float sums (and ties) come out the same in every process
+        query_terms = sorted(set(tokenize(query)))
+        scores = []
+        for terms, length in zip(self.terms, self.lengths):
+            score = 0.0
+            norm = K1 * (1 - B + B * length / self.avg_length) if self.avg_length else K1
+            for term in query_terms:
+                tf = terms.get(term)
+                if tf:
+                    score += self.idf[term] * tf * (K1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def search(self, query: str, top_k: int = DEFAULT_TOP_K, max_tokens: int = DEFAULT_MAX_TOKENS,
+               model: str = None) -> list:
+        """
+        Indexes of the best passages for query, at most top_k of them and
+        max_tokens in total, best first. Ties (including passages that match
+        nothing) go to the earlier passage, so the budget is always used.
+        """
+        scores = self.scores(query)
+        ranked = sorted(range(len(self.passages)), key=lambda i: (-scores[i], i))
+        selected = []
+        used = 0
+        for i in ranked:
+            if len(selected) >= top_k:
+                break
+            tokens = count_tokens(self.passages[i][1], model)
+            if used + tokens > max_tokens:
+                continue
+            selected.append(i)
+            used += tokens
+        return selected
+
+
+@lru_cache(maxsize=16)
+def build_index(sources: tuple) -> PassageIndex:
+    # The chain asks for the same record's fields once per step; index them once
+    return PassageIndex(sources)
+
+
+def retrieve(variables: dict, retrieval: dict, model: str = None) -> dict:
+    """
+    The retrieval fields of variables reduced to their selected passages,
+    as {field: text}. Empty if the fields fit the token budget as they are.
+    """
+    fields = [field for field in retrieval["fields"] if variables.get(field)]
+    max_tokens = retrieval.get("max_tokens", DEFAULT_MAX_TOKENS)
+    if sum(count_tokens(variables[field], model) for field in fields) <= max_tokens:
+        return {}
+    index = build_index(tuple((field, str(variables[field])) for field in fields))
+    query = "\n".join(str(variables.get(name) or "") for name in retrieval.get("query", []))
+    selected = sorted(index.search(query, retrieval.get("top_k", DEFAULT_TOP_K), max_tokens, model))
+    reduced = {}
+    for field in fields:
+        passages = [index.passages[i][1] for i in selected if index.passages[i][0] == field]
+        reduced[field] = "\n\n".join(passages) if passages else NO_PASSAGES
+    return reduced
+
+
+def apply_retrieval(variables: dict, retrieval: dict, model: str = None) -> dict:
+    """
+    variables with the retrieval fields reduced (a copy), or variables itself
+    when retrieval is None or nothing needs reducing.
+    """
+    if not retrieval:
+        return variables
+    reduced = retrieve(variables, retrieval, model)
+    if not reduced:
+        return variables
+    step_vars = dict(variables)
+    step_vars.update(reduced)
+    return step_vars
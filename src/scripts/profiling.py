@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from collections import Counter
+
+########################################
+# Opt-in profiling for the stage scripts
+#
+# Every stage runs its main() through profiling.run(). With profiling off
+# that is a direct call. Turn it on with "--profile" on the command line or
+# the EMAILPIPE_PROFILE environment variable:
+#
+#   python3 ./src/scripts/4add_citations.py --profile
+#   EMAILPIPE_PROFILE=cpu,memory python3 ./src/scripts/3email_generation.py
+#
+# Modes (comma-separated, "--profile=cpu,sample"; "1"/"all" or a bare
+# --profile means all of them):
+#   cpu     cProfile: <stage>-<time>.prof plus the top functions by cumulative time (.cpu.txt)
+#   memory  tracemalloc: peak traced memory and the top allocation sites (.alloc.txt)
+#   sample  a sampling thread recording the main thread's stack every
+#           EMAILPIPE_PROFILE_INTERVAL seconds (default 0.005) as collapsed
+#           stacks (.collapsed.txt) for flamegraph.pl or speedscope
+#
+# Files go to output/profiles (or EMAILPIPE_PROFILE_DIR).
+########################################
+script_dir = os.path.dirname(__file__)
+ALL_MODES = ("cpu", "memory", "sample")
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 30
+_modes = None
+
+
+def profile_modes():
+    """
+    The enabled modes; a "--profile[=modes]" argument is removed from sys.argv
+    so the stage's own argument parsing never sees it.
+    """
+    global _modes
+    if _modes is not None:
+        return _modes
+    value = os.getenv("EMAILPIPE_PROFILE", "")
+    for arg in list(sys.argv[1:]):
+        if arg == "--profile" or arg.startswith("--profile="):
+            sys.argv.remove(arg)
+            value = arg.partition("=")[2] or "all"
+    if value.strip().lower() in ("", "0", "false", "no"):
+        _modes = set()
+    elif value.strip().lower() in ("1", "true", "yes", "all"):
+        _modes = set(ALL_MODES)
+    else:
+        _modes = {mode.strip() for mode in value.split(",") if mode.strip() in ALL_MODES}
+    return _modes
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples one thread's Python stack at a fixed interval into collapsed-stack counts.
+    """
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def run(stage_name, func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs), profiled as stage_name when profiling is on.
+    """
+    modes = profile_modes()
+    if not modes:
+        return func(*args, **kwargs)
+
+    out_dir = os.getenv("EMAILPIPE_PROFILE_DIR", os.path.join(script_dir, "../../output/profiles"))
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.join(out_dir, f"{stage_name}-{time.strftime('%Y%m%d-%H%M%S')}")
+
+    profiler = cProfile.Profile() if "cpu" in modes else None
+    sampler = None
+    if "sample" in modes:
+        sampler = StackSampler(threading.get_ident(), float(os.getenv("EMAILPIPE_PROFILE_INTERVAL", "0.005")))
+        sampler.start()
+    if "memory" in modes:
+        tracemalloc.start()
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        if profiler:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+        written = []
+        if sampler:
+            sampler.stop()
+            sampler.write(base + ".collapsed.txt")
+            written.append(base + ".collapsed.txt")
+        if "memory" in modes:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(base + ".alloc.txt", "w", encoding="utf-8") as f:
+                f.write(f"{stage_name}: peak traced memory {peak / 1024 / 1024:.1f} MiB, "
+                        f"still allocated at exit {current / 1024 / 1024:.1f} MiB\n\n")
+                for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    f.write(f"{stat}\n")
+            written.append(base + ".alloc.txt")
+        if profiler:
+            profiler.dump_stats(base + ".prof")
+            with open(base + ".cpu.txt", "w", encoding="utf-8") as f:
+                stats = pstats.Stats(profiler, stream=f)
+                stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+            written += [base + ".prof", base + ".cpu.txt"]
+        print(f"Profiled {stage_name} ({elapsed:.2f}s): " + ", ".join(written))
@@ -0,0 +1,202 @@
+import os
+import re
+import json
+import sqlite3
+import datetime
+import threading
+from engagements import SECTIONS, NO_INFORMATION, CITATION_MARKER, split_sections, is_empty
+
+########################################
+# Prospect knowledge base: dated research snapshots across campaigns
+#
+# Stage 1 stores every research answer it gets, with its citations, as a
+# dated snapshot in a SQLite database (output/prospect_kb.db, or
+# EMAILPIPE_KB_DB) keyed by email and LinkedIn URL. When a prospect comes up
+# again in a later campaign, query types with a delta query (DELTA_QUERY_CONFIGS
+# in 1perplexity.py) only ask what is new since the last snapshot, and the
+# answer is merged into it:
+#   - engagements_combined is merged section by section
+#   - other answers get the new findings appended under "New since <date>"
+#   - the new answer's citation markers are renumbered after the snapshot's
+#     citations (a URL already cited keeps its number)
+# The merged research is stored as the new snapshot, so snapshots are
+# always complete. Research older than FULL_REFRESH_DAYS is redone in full,
+# and research from today (a resumed run) is reused without a query.
+########################################
+script_dir = os.path.dirname(__file__)
+DEFAULT_DB = os.getenv("EMAILPIPE_KB_DB", os.path.join(script_dir, "../../output/prospect_kb.db"))
+FULL_REFRESH_DAYS = 365
+FULL, DELTA = "full", "delta"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id               INTEGER PRIMARY KEY AUTOINCREMENT,
+    email            TEXT NOT NULL,
+    linkedin_url     TEXT NOT NULL,
+    query_type       TEXT NOT NULL,
+    researched_at    TEXT NOT NULL,
+    full_research_at TEXT NOT NULL,
+    mode             TEXT NOT NULL,
+    text             TEXT NOT NULL,
+    citations        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_email ON snapshots (email, query_type);
+CREATE INDEX IF NOT EXISTS snapshots_linkedin ON snapshots (linkedin_url, query_type);
+"""
+
+
+def today() -> str:
+    return datetime.date.today().isoformat()
+
+
+def normalize_email(email) -> str:
+    return (email or "").strip().lower()
+
+
+def normalize_linkedin(url) -> str:
+    # http://www.linkedin.com/in/jane-doe/ and https://linkedin.com/in/jane-doe are the same profile
+    url = (url or "").strip().lower()
+    url = re.sub(r"^https?://", "", url)
+    url = re.sub(r"^www\.", "", url)
+    return url.split("?")[0].rstrip("/")
+
+
+########################################
+# Merging a delta answer into a snapshot
+########################################
+def renumber_citations(text: str, citations: list, existing: list) -> (str, list):
+    """
+    text with its [n] markers pointing into existing + the new citations,
+    and that merged citation list.
+    """
+    merged = list(existing)
+    numbers = {}
+    for i, url in enumerate(citations):
+        if url in merged:
+            numbers[str(i + 1)] = merged.index(url) + 1
+        else:
+            merged.append(url)
+            numbers[str(i + 1)] = len(merged)
+    text = CITATION_MARKER.sub(lambda m: f"[{numbers[m.group(1)]}]" if m.group(1) in numbers else m.group(0), text)
+    return text, merged
+
+
+def merge_sections(old_text: str, new_text: str, since: str):
+    """
+    An engagements_combined answer with the new sections' findings added to
+    the old ones, or None if either answer has no section headings.
+    """
+    old_sections = split_sections(old_text)
+    new_sections = split_sections(new_text)
+    if not old_sections or not new_sections:
+        return None
+    parts = []
+    for key, title in SECTIONS:
+        bodies = [body for body in (old_sections.get(key), new_sections.get(key)) if body and not is_empty(body)]
+        if len(bodies) == 2:
+            bodies[1] = f"New since {since}:\n{bodies[1]}"
+        parts.append(f"**{title}**:\n" + ("\n\n".join(bodies) if bodies else NO_INFORMATION))
+    return "\n\n".join(parts)
+
+
+def merge_research(query_type: str, old_text: str, old_citations: list, new_text: str, new_citations: list,
+                   since: str) -> (str, list):
+    """
+    A snapshot's research with the answer of a delta query merged in, and
+    the merged citations. An answer that reports nothing new (only
+    no-information sentences and no citations, see engagements.is_empty)
+    leaves it as is.
+    """
+    if not new_text or is_empty(new_text):
+        return old_text, list(old_citations)
+    new_text, citations = renumber_citations(new_text, new_citations, old_citations)
+    merged = merge_sections(old_text, new_text, since) if query_type == "engagements_combined" else None
+    if merged is None:
+        merged = f"{old_text.rstrip()}\n\nNew since {since}:\n{new_text.strip()}"
+    return merged, citations
+
+
+########################################
+# Snapshot store
+########################################
+class ProspectKB:
+    def __init__(self, db_path=None):
+        self.db_path = db_path or DEFAULT_DB
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def query(self, sql, params=()):
+        conn = self.connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def latest(self, email, linkedin_url, query_type):
+        """
+        The newest snapshot of a query type for the prospect, found by email
+        or LinkedIn URL, as a dict (citations as a list); None if there is none.
+        """
+        keys = [("email", normalize_email(email)), ("linkedin_url", normalize_linkedin(linkedin_url))]
+        keys = [(column, value) for column, value in keys if value]
+        if not keys:
+            return None
+        where = " OR ".join(f"{column} = ?" for column, _ in keys)
+        rows = self.query(f"SELECT * FROM snapshots WHERE query_type = ? AND ({where}) "
+                          "ORDER BY researched_at DESC, id DESC LIMIT 1",
+                          [query_type] + [value for _, value in keys])
+        if not rows:
+            return None
+        snapshot = dict(rows[0])
+        snapshot["citations"] = json.loads(snapshot["citations"])
+        return snapshot
+
+    def delta_base(self, email, linkedin_url, query_type, max_age_days=FULL_REFRESH_DAYS):
+        """
+        The snapshot a delta query can build on: the latest one, unless its
+        last full research is more than max_age_days old.
+        """
+        snapshot = self.latest(email, linkedin_url, query_type)
+        if snapshot is None:
+            return None
+        full_age = datetime.date.today() - datetime.date.fromisoformat(snapshot["full_research_at"])
+        return snapshot if full_age.days <= max_age_days else None
+
+    def store(self, email, linkedin_url, query_type, text, citations, mode=FULL, researched_at=None,
+              full_research_at=None):
+        researched_at = researched_at or today()
+        conn = self.connect()
+        try:
+            conn.execute(
+                "INSERT INTO snapshots (email, linkedin_url, query_type, researched_at, full_research_at, mode, "
+                "text, citations) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (normalize_email(email), normalize_linkedin(linkedin_url), query_type, researched_at,
+                 full_research_at or researched_at, mode, text, json.dumps(list(citations))))
+        finally:
+            conn.close()
+
+    def status(self) -> list:
+        rows = self.query("SELECT query_type, mode, COUNT(*) AS snapshots, COUNT(DISTINCT email) AS prospects, "
+                          "MAX(researched_at) AS latest FROM snapshots GROUP BY query_type, mode ORDER BY query_type, mode")
+        return [dict(row) for row in rows]
+
+
+_kb = None
+_kb_lock = threading.Lock()
+
+
+def get_kb() -> ProspectKB:
+    """
+    The process-wide knowledge base.
+    """
+    global _kb
+    with _kb_lock:
+        if _kb is None:
+            _kb = ProspectKB()
+        return _kb
@@ -0,0 +1,230 @@
+import os
+import json
+from contextlib import contextmanager
+from jsonstream import iter_records, ArrayWriter
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to no cross-process locking
+    fcntl = None
+
+########################################
+# Safe writes to JSON files the review frontend is serving
+#
+# The frontend (frontend/record_store.py) journals reviewer edits and holds
+# "<json_file>.lock" while it patches or flushes. Pipeline stages that
+# rewrite or update those files take the same lock, keep the reviewer-owned
+# fields of records that already exist (matched by Email), and replace the
+# file atomically. Edits the frontend has journaled but not yet flushed are
+# folded in first and the journal is cleared, exactly as the frontend's own
+# flush does, so they are neither lost nor replayed over the new content.
+########################################
+# Fields set by reviewers rather than by the pipeline (see 5add_feedback_exclusion_keys.py)
+REVIEW_FIELDS = {"exclude", "email_feedback", "flag", "viewed", "exported"}
+VERSION_FIELD = "record_version"
+FIELD_VERSIONS_FIELD = "field_versions"
+
+
+@contextmanager
+def file_lock(json_file):
+    if fcntl is None:
+        yield
+        return
+    with open(json_file + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def read_records(json_file):
+    if not os.path.exists(json_file):
+        return []
+    with open(json_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_journal(json_file):
+    """
+    The complete entries of "<json_file>.journal" in order (a torn last line is ignored).
+    """
+    journal_file = json_file + ".journal"
+    if not os.path.exists(journal_file):
+        return []
+    entries = []
+    with open(journal_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return entries
+
+
+def iter_records_with_journal(json_file):
+    """
+    Yield the records as the frontend sees them: the file plus its
+    "<json_file>.journal" patches, reading the file one record at a time.
+
+    A patch applies to the first record with its Email, or to the record at
+    its index when it has no Email. Upserted Emails missing from the file are
+    yielded last, in journal order.
+    """
+    by_email, by_index, upserts = {}, {}, {}
+    for seq, entry in enumerate(read_journal(json_file)):
+        fields = entry.get("fields", {})
+        email = entry.get("email")
+        if email:
+            by_email.setdefault(email, []).append((seq, fields))
+            if entry.get("upsert"):
+                upserts.setdefault(email, seq)
+        elif entry.get("index") is not None:
+            by_index.setdefault(entry["index"], []).append((seq, fields))
+
+    seen = set()
+    position = -1
+    if os.path.exists(json_file):
+        for position, record in enumerate(iter_records(json_file)):
+            email = record.get("Email")
+            patches = list(by_index.get(position, ()))
+            if email and email not in seen:
+                seen.add(email)
+                patches += by_email.get(email, ())
+            for _, fields in sorted(patches, key=lambda patch: patch[0]):
+                record.update(fields)
+            yield record
+
+    for email, first_seq in sorted(upserts.items(), key=lambda item: item[1]):
+        if email in seen:
+            continue
+        position += 1
+        record = {}
+        # Only patches written once the upsert had created the record apply to it
+        patches = [p for p in by_email[email] + by_index.get(position, []) if p[0] >= first_seq]
+        for _, fields in sorted(patches, key=lambda patch: patch[0]):
+            record.update(fields)
+        yield record
+
+
+def read_records_with_journal(json_file):
+    """
+    The records as the frontend sees them: the file plus its "<json_file>.journal" patches.
+    """
+    return list(iter_records_with_journal(json_file))
+
+
+def clear_journal(json_file):
+    journal_file = json_file + ".journal"
+    if os.path.exists(journal_file):
+        open(journal_file, "w").close()
+
+
+def append_journal_patches(json_file, patches):
+    """
+    Record field patches ({"email": ..., "fields": {...}}) in "<json_file>.journal"
+    without rewriting json_file. The frontend replays them on its next read and
+    folds them into the file on its next flush.
+    """
+    with file_lock(json_file):
+        with open(json_file + ".journal", "a", encoding="utf-8") as f:
+            for patch in patches:
+                f.write(json.dumps(patch, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def write_records_atomic(json_file, records, indent=2):
+    tmp_file = json_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(records, f, indent=indent, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, json_file)
+
+
+def reviewer_fields(record):
+    """
+    The fields of an existing record that a pipeline rerun must not overwrite:
+    review flags, version counters and anything a reviewer has edited.
+    """
+    owned = set(REVIEW_FIELDS) | {VERSION_FIELD, FIELD_VERSIONS_FIELD}
+    owned |= set(record.get(FIELD_VERSIONS_FIELD, {}))
+    return {k: record[k] for k in owned if k in record}
+
+
+def replace_records(json_file, new_records):
+    """
+    Replace json_file with new_records (any iterable; it is consumed one record
+    at a time), keeping reviewer-owned fields of records that already exist in
+    it. Only those fields of the existing records are held in memory.
+    Returns the number of records merged.
+    """
+    with file_lock(json_file):
+        kept = {}
+        for existing in iter_records_with_journal(json_file):
+            if existing.get("Email"):
+                kept[existing["Email"]] = reviewer_fields(existing)
+        merged = 0
+        with ArrayWriter(json_file, ensure_ascii=False) as writer:
+            for record in new_records:
+                fields = kept.get(record.get("Email"))
+                if fields is not None:
+                    record.update(fields)
+                    merged += 1
+                writer.write(record)
+        clear_journal(json_file)
+    return merged
+
+
+def merge_upsert(existing, record, keep_reviewer_fields=True, overwrite_fields=()):
+    """
+    existing (a record with the same Email, or None) updated with record:
+    reviewer-owned fields are kept unless listed in overwrite_fields, which
+    always take the new value and get a new version so a stale editor sees
+    a conflict.
+    """
+    if existing is None:
+        return dict(record)
+    updated = dict(existing)
+    updated.update(record)
+    if keep_reviewer_fields:
+        kept = reviewer_fields(existing)
+        for field in overwrite_fields:
+            kept.pop(field, None)
+        updated.update(kept)
+    if overwrite_fields:
+        new_version = existing.get(VERSION_FIELD, 0) + 1
+        field_versions = dict(existing.get(FIELD_VERSIONS_FIELD, {}))
+        for field in overwrite_fields:
+            field_versions[field] = new_version
+        updated[VERSION_FIELD] = new_version
+        updated[FIELD_VERSIONS_FIELD] = field_versions
+    return updated
+
+
+def journal_upsert(json_file, record, existing=None, overwrite_fields=()):
+    """
+    Insert or update one record (by Email) without rewriting json_file: the
+    fields merge_upsert changes are appended to its journal as one upsert
+    patch. existing is the record with the same Email as last read, or None.
+    Returns the merged record.
+    """
+    updated = merge_upsert(existing, record, overwrite_fields=overwrite_fields)
+    fields = {k: v for k, v in updated.items() if existing is None or existing.get(k) != v}
+    append_journal_patches(json_file, [{"email": record.get("Email"), "fields": fields, "upsert": True}])
+    return updated
+
+
+def fold_journal(json_file):
+    """
+    Write json_file's journal patches into it and clear the journal, as the
+    frontend's flush does.
+    """
+    with file_lock(json_file):
+        if not read_journal(json_file):
+            return
+        write_records_atomic(json_file, read_records_with_journal(json_file))
+        clear_journal(json_file)
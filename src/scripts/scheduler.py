@@ -0,0 +1,135 @@
+import re
+import json
+
+########################################
+# Priority scheduling of contacts
+#
+# By default the stages work through their input in file order. With
+# --priority, stage 1 and stage 3 (and "emailpipe.py queue enqueue")
+# order the work by a priority score computed from the Apollo columns:
+#   - the first title tier whose keywords appear in Title
+#   - a bonus per Company
+#   - custom numeric columns times a weight
+# Equal scores keep their input order. The scoring comes from
+# DEFAULT_PRIORITY, or from a JSON file with the same keys (--priority-config):
+#
+#   {"title_tiers": [{"score": 100, "keywords": ["chief", "vp"]}],
+#    "companies": {"Contoso Pharma": 20},
+#    "columns": {"Lead Score": 0.5}}
+#
+# Several lists running together share the work in proportion to their
+# weights (weighted fair queuing): the k-th contact of a list of weight w
+# gets the virtual finish time start + k / w, and work is done in order of
+# finish time. A list of weight 2 gets two contacts done for every one of
+# a list of weight 1, and no list waits for another to finish.
+########################################
+DEFAULT_PRIORITY = {
+    "title_tiers": [
+        {"score": 100, "keywords": ["chief", "ceo", "cmo", "cfo", "coo", "cto", "cio", "cso", "president",
+                                    "founder", "co-founder", "owner", "partner"]},
+        {"score": 70, "keywords": ["vice president", "vp", "svp", "evp", "head of", "head"]},
+        {"score": 50, "keywords": ["director"]},
+        {"score": 25, "keywords": ["senior manager", "manager", "lead", "principal"]},
+    ],
+    "companies": {},
+    "columns": {},
+}
+
+
+def load_priority_config(path: str = None) -> dict:
+    """
+    DEFAULT_PRIORITY, with the keys of the JSON file at path replacing its own.
+    """
+    config = dict(DEFAULT_PRIORITY)
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            config.update(json.load(f))
+    return config
+
+
+def add_priority_arguments(parser):
+    parser.add_argument("--priority", action="store_true",
+                        help="Work through the contacts by priority score instead of input order.")
+    parser.add_argument("--priority-config", type=str, default=None,
+                        help="JSON file with title_tiers, companies and columns for the priority score "
+                             "(default: DEFAULT_PRIORITY in scheduler.py). Implies --priority.")
+
+
+def priority_from_args(args):
+    """
+    The priority config a stage was asked to schedule by, or None for input order.
+    """
+    if not args.priority and not args.priority_config:
+        return None
+    return load_priority_config(args.priority_config)
+
+
+def keyword_pattern(keywords: list):
+    # Whole words only: "cto" must not match "Director"
+    return re.compile(r"\b(?:" + "|".join(re.escape(k) for k in keywords) + r")\b", re.IGNORECASE)
+
+
+def priority_score(record: dict, config: dict = None) -> float:
+    config = config or DEFAULT_PRIORITY
+    title = record.get("Title") or ""
+    score = 0.0
+    for tier in config.get("title_tiers", []):
+        if tier.get("keywords") and keyword_pattern(tier["keywords"]).search(title):
+            score += tier["score"]
+            break
+    companies = {name.strip().lower(): bonus for name, bonus in config.get("companies", {}).items()}
+    score += companies.get((record.get("Company") or "").strip().lower(), 0)
+    for column, weight in config.get("columns", {}).items():
+        try:
+            score += weight * float(record.get(column) or 0)
+        except (TypeError, ValueError):
+            pass
+    return score
+
+
+def order_by_priority(records: list, config: dict = None) -> list:
+    """
+    records by descending priority score; equal scores keep their order.
+    """
+    scores = [priority_score(record, config) for record in records]
+    return [records[i] for i in sorted(range(len(records)), key=lambda i: -scores[i])]
+
+
+def finish_times(count: int, weight: float = 1.0, start: float = 0.0) -> list:
+    """
+    Virtual finish times of the count contacts of a list of the given weight.
+    """
+    if weight <= 0:
+        raise ValueError("List weights must be positive")
+    return [start + (k + 1) / weight for k in range(count)]
+
+
+def interleave(lists: list) -> list:
+    """
+    The items of (weight, items) lists merged in weighted fair order; ties
+    go to the earlier list.
+    """
+    tagged = []
+    for list_index, (weight, items) in enumerate(lists):
+        for k, (finish, item) in enumerate(zip(finish_times(len(items), weight), items)):
+            tagged.append((finish, list_index, k, item))
+    tagged.sort(key=lambda t: t[:3])
+    return [item for _, _, _, item in tagged]
+
+
+def schedule(lists: list, config: dict = None) -> list:
+    """
+    Contacts of (weight, records) lists: each list by priority, then merged
+    in weighted fair order.
+    """
+    return interleave([(weight, order_by_priority(records, config)) for weight, records in lists])
+
+
+def parse_weights(value: str, count: int) -> list:
+    """
+    Weights from a comma-separated --weights value, one per list (default 1).
+    """
+    weights = [float(w) for w in (value or "").split(",") if w.strip()]
+    if weights and len(weights) != count:
+        raise ValueError(f"Expected {count} weight(s), got {len(weights)}")
+    return weights or [1.0] * count
@@ -0,0 +1,65 @@
+import os
+import hashlib
+import argparse
+
+########################################
+# Sharded execution
+#
+# A stage run with "--shard i/N" (0 <= i < N) processes only the contacts
+# whose Email hashes to shard i, and writes its outputs next to the normal
+# ones with a ".shard-i-of-N" suffix, e.g.
+#   output/2final_combined_research_results.shard-0-of-4.json
+# so each shard keeps its own checkpoint (resume) files. Shards can run in
+# separate processes or on separate hosts with separate API keys; once all N
+# are done, "emailpipe.py merge" combines them in a deterministic order.
+#
+# The hash is sha256 of the normalised Email, so the assignment is stable
+# across machines, Python versions and input orderings.
+########################################
+def parse_shard(value):
+    """
+    argparse type for "i/N": returns (i, N).
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a shard like 0/4, got '{value}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be in 0..{count - 1}, got '{value}'")
+    return index, count
+
+
+def add_shard_argument(parser):
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="Process only shard i of N (e.g. 0/4), partitioned by a stable hash of Email. "
+                             "Outputs get a .shard-i-of-N suffix; combine them with 'emailpipe.py merge'.")
+
+
+def shard_of(email, count):
+    normalized = (email or "").strip().lower()
+    return int(hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16], 16) % count
+
+
+def in_shard(record, shard):
+    """
+    True if the record belongs to the shard (always True when shard is None).
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(record.get("Email"), count) == index
+
+
+def shard_path(path, shard):
+    """
+    "dir/name.json" -> "dir/name.shard-i-of-N.json" (unchanged when shard is None).
+    """
+    if shard is None:
+        return path
+    index, count = shard
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{index}-of-{count}{ext}"
+
+
+def shard_paths(path, count):
+    return [shard_path(path, (index, count)) for index in range(count)]
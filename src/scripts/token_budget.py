@@ -0,0 +1,482 @@
+import os
+import time
+import atexit
+import sqlite3
+import threading
+from collections import namedtuple
+
+try:
+    import tiktoken
+except ImportError:  # optional (installed by requirements.txt): fall back to a character-based estimate
+    tiktoken = None
+
+########################################
+# Token accounting and budget admission control
+#
+# Every model call is estimated with a local tokenizer before it is made and
+# recorded with the usage the API reports after it, in a SQLite ledger
+# (output/budget.db, or EMAILPIPE_BUDGET_DB) shared by all stage processes.
+# The tokenizer is tiktoken, which is optional: without it (or offline,
+# before it has its vocabularies) prompts are estimated at about 4
+# characters per token, and a warning says so the first time.
+#
+# Limits in dollars and/or tokens can be set for the whole run, per stage and
+# per contact ("emailpipe.py budget set"). Before a stage spends anything on
+# a contact it asks admit() with the calls it plans to make; if the
+# projected spend would cross a limit, the most expensive models in the plan
+# are swapped for cheaper ones (DOWNGRADES) until it fits, and if nothing
+# fits the contact is refused with BudgetExceeded and the stage stops
+# admitting contacts. Without limits everything is admitted and only
+# recorded.
+#
+# Admission is checked and reserved in one transaction: an admitted
+# contact's projected spend is held as a reservation, counted against the
+# limits next to recorded usage, until its calls are recorded (each one
+# draws it down) and the thread admits its next contact or the process
+# exits. Concurrent stage processes therefore cannot all admit against the
+# same remaining budget. Reservations of a process that died expire after
+# RESERVATION_TTL seconds.
+#
+# Each Budget keeps one connection, shared by its threads under a lock.
+# What has been spent per scope (the run, each stage, each contact) is kept
+# as a running total next to the usage rows, so checking a limit does not
+# sum a usage table that grows with every run.
+#
+# Output tokens are not known before a call: the estimate uses the average
+# completion tokens observed for the stage and model once there are
+# MIN_OBSERVATIONS calls, and the call's max tokens until then.
+########################################
+script_dir = os.path.dirname(__file__)
+DEFAULT_DB = os.getenv("EMAILPIPE_BUDGET_DB", os.path.join(script_dir, "../../output/budget.db"))
+
+# Dollars per 1,000,000 input/output tokens, and per 1,000 searches
+MODEL_PRICING = {
+    "sonar-reasoning-pro": {"input": 2, "output": 8, "search": 5},
+    "sonar-reasoning":     {"input": 1, "output": 5, "search": 5},
+    "sonar-pro":           {"input": 3, "output": 15, "search": 5},
+    "sonar":               {"input": 1, "output": 1, "search": 5},
+    "o1":                  {"input": 5.00, "output": 20.00},
+    "o3-mini":             {"input": 1.10, "output": 4.40},
+    "gpt-4o":              {"input": 2.50, "output": 10.00},
+}
+# Cheaper model to fall back to when a plan does not fit the budget
+DOWNGRADES = {
+    "o1": "o3-mini",
+    "sonar-reasoning-pro": "sonar-reasoning",
+    "sonar-pro": "sonar",
+}
+PRO_SEARCH_MODELS = {"sonar-reasoning-pro", "sonar-pro"}
+DEFAULT_OUTPUT_TOKENS = 4000
+MIN_OBSERVATIONS = 3
+RESERVATION_TTL = 3600
+
+RUN, STAGE, CONTACT = "run", "stage", "contact"
+ANY_CONTACT = "*"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id                      INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage                   TEXT NOT NULL,
+    email                   TEXT NOT NULL,
+    model                   TEXT NOT NULL,
+    estimated_prompt_tokens INTEGER,
+    prompt_tokens           INTEGER NOT NULL,
+    completion_tokens       INTEGER NOT NULL,
+    searches                INTEGER NOT NULL DEFAULT 0,
+    usd                     REAL NOT NULL,
+    at                      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usage_stage ON usage (stage, model);
+CREATE INDEX IF NOT EXISTS usage_email ON usage (email);
+CREATE TABLE IF NOT EXISTS limits (
+    scope  TEXT NOT NULL,
+    name   TEXT NOT NULL,
+    usd    REAL,
+    tokens INTEGER,
+    PRIMARY KEY (scope, name)
+);
+CREATE TABLE IF NOT EXISTS reservations (
+    id     INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage  TEXT NOT NULL,
+    email  TEXT NOT NULL,
+    usd    REAL NOT NULL,
+    tokens INTEGER NOT NULL,
+    at     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reservations_contact ON reservations (stage, email);
+CREATE TABLE IF NOT EXISTS totals (
+    scope  TEXT NOT NULL,
+    name   TEXT NOT NULL,
+    usd    REAL NOT NULL,
+    tokens INTEGER NOT NULL,
+    PRIMARY KEY (scope, name)
+);
+"""
+
+Admission = namedtuple("Admission", "admitted substitutions usd tokens reason")
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+########################################
+# Token counting and pricing
+########################################
+_encodings = {}
+_fallback_warned = False
+
+
+def warn_fallback(reason):
+    global _fallback_warned
+    if not _fallback_warned:
+        _fallback_warned = True
+        print(f"Token counts are estimated at 4 characters per token ({reason}); budgets may be off")
+
+
+def encoding_for(model):
+    if tiktoken is None:
+        warn_fallback("tiktoken is not installed")
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            try:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                _encodings[model] = None
+        except Exception:
+            # tiktoken fetches its vocabularies on first use; offline that can fail
+            _encodings[model] = None
+        if _encodings[model] is None:
+            warn_fallback(f"no tiktoken encoding for {model}")
+    return _encodings[model]
+
+
+def count_tokens(text, model=None) -> int:
+    """
+    Tokens in text for the model (tiktoken when available, else about 4 characters per token).
+    """
+    if not text:
+        return 0
+    text = str(text)
+    encoding = encoding_for(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def estimate_prompt_tokens(template: str, variables: dict, model=None, pending: dict = None) -> int:
+    """
+    Tokens of a prompt template once its {placeholders} are filled in from
+    variables; placeholders listed in pending (outputs of earlier steps that
+    have not run yet) count as their expected token counts.
+    """
+    pending = pending or {}
+    tokens = count_tokens(template, model)
+    for key, value in variables.items():
+        if "{" + key + "}" in template and key not in pending:
+            tokens += count_tokens(value, model)
+    for key, expected in pending.items():
+        if "{" + key + "}" in template:
+            tokens += expected
+    return tokens
+
+
+def expected_searches(model) -> int:
+    # Perplexity bills searches; Pro models run about three per query
+    if "search" not in MODEL_PRICING.get(model, {}):
+        return 0
+    return 3 if model in PRO_SEARCH_MODELS else 1
+
+
+def call_cost(model, prompt_tokens, completion_tokens, searches=0) -> float:
+    pricing = MODEL_PRICING.get(model)
+    if not pricing:
+        return 0.0
+    return (prompt_tokens / 1_000_000 * pricing["input"]
+            + completion_tokens / 1_000_000 * pricing["output"]
+            + searches / 1000 * pricing.get("search", 0))
+
+
+########################################
+# Ledger and admission control
+########################################
+class Budget:
+    def __init__(self, db_path=None):
+        self.db_path = db_path or DEFAULT_DB
+        self.conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.RLock()
+        self.transaction(self.backfill_totals)
+        # The reservation of the contact each thread is working on, and all of this process's
+        self.local = threading.local()
+        self.reservation_ids = set()
+        self.reservation_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def close(self):
+        self.release_all()
+        with self.lock:
+            self.conn.close()
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def transaction(self, work):
+        """
+        work(conn) in a write transaction, so no other thread or process
+        reads or writes the ledger in between; returns its result.
+        """
+        with self.lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    def backfill_totals(self, conn):
+        # Ledgers written before the running totals existed
+        if conn.execute("SELECT 1 FROM totals LIMIT 1").fetchone():
+            return
+        for scope, column in ((RUN, "''"), (STAGE, "stage"), (CONTACT, "email")):
+            conn.execute(f"INSERT INTO totals (scope, name, usd, tokens) SELECT ?, {column}, SUM(usd), "
+                         f"SUM(prompt_tokens + completion_tokens) FROM usage GROUP BY {column}", (scope,))
+
+    def set_limit(self, scope, name="", usd=None, tokens=None):
+        """
+        Limit spend for a scope: RUN (name ""), STAGE (a stage name) or
+        CONTACT (an email, or ANY_CONTACT for every contact). With neither
+        usd nor tokens the limit is removed.
+        """
+        if usd is None and tokens is None:
+            self.query("DELETE FROM limits WHERE scope = ? AND name = ?", (scope, name))
+            return
+        self.query("INSERT OR REPLACE INTO limits (scope, name, usd, tokens) VALUES (?, ?, ?, ?)",
+                   (scope, name, usd, tokens))
+
+    def limits(self) -> dict:
+        return {(scope, name): (usd, tokens) for scope, name, usd, tokens in
+                self.query("SELECT scope, name, usd, tokens FROM limits")}
+
+    def reset(self, usage=True, limits=False):
+        def work(conn):
+            if usage:
+                conn.execute("DELETE FROM usage")
+                conn.execute("DELETE FROM totals")
+                conn.execute("DELETE FROM reservations")
+            if limits:
+                conn.execute("DELETE FROM limits")
+
+        self.transaction(work)
+
+    def where(self, stage, email):
+        clauses, params = [], []
+        if stage:
+            clauses.append("stage = ?")
+            params.append(stage)
+        if email:
+            clauses.append("email = ?")
+            params.append(email)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def spent(self, stage=None, email=None) -> tuple:
+        """
+        (dollars, tokens) recorded so far, optionally for one stage and/or contact.
+        """
+        if stage and email:
+            where, params = self.where(stage, email)
+            sql = "SELECT COALESCE(SUM(usd), 0), COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM usage"
+            usd, tokens = self.query(sql + where, params)[0]
+            return usd, tokens
+        scope, name = (STAGE, stage) if stage else (CONTACT, email) if email else (RUN, "")
+        row = self.query("SELECT usd, tokens FROM totals WHERE scope = ? AND name = ?", (scope, name))
+        return row[0] if row else (0.0, 0)
+
+    def reserved(self, stage=None, email=None) -> tuple:
+        """
+        (dollars, tokens) reserved by admitted contacts and not recorded yet.
+        """
+        where, params = self.where(stage, email)
+        where += (" AND" if where else " WHERE") + " at > ?"
+        sql = "SELECT COALESCE(SUM(usd), 0), COALESCE(SUM(tokens), 0) FROM reservations"
+        usd, tokens = self.query(sql + where, params + [time.time() - RESERVATION_TTL])[0]
+        return usd, tokens
+
+    def expected_output_tokens(self, stage, model, max_tokens=None) -> int:
+        count, average = self.query("SELECT COUNT(*), AVG(completion_tokens) FROM usage WHERE stage = ? AND model = ?",
+                                    (stage, model))[0]
+        if count >= MIN_OBSERVATIONS:
+            return int(average)
+        return max_tokens or DEFAULT_OUTPUT_TOKENS
+
+    def estimate(self, stage, calls) -> tuple:
+        """
+        Projected (dollars, tokens) of calls, a list of (model, prompt tokens, max tokens).
+        """
+        usd, tokens = 0.0, 0
+        for model, prompt_tokens, max_tokens in calls:
+            completion_tokens = self.expected_output_tokens(stage, model, max_tokens)
+            usd += call_cost(model, prompt_tokens, completion_tokens, expected_searches(model))
+            tokens += prompt_tokens + completion_tokens
+        return usd, tokens
+
+    def over_limit(self, stage, email, usd, tokens, limits):
+        """
+        The first limit the projected spend would cross, as a message, or None.
+        Reserved spend counts as spent.
+        """
+        checks = [((RUN, ""), None, None), ((STAGE, stage), stage, None)]
+        contact_limit = (CONTACT, email) if (CONTACT, email) in limits else (CONTACT, ANY_CONTACT)
+        checks.append((contact_limit, None, email))
+        for key, spent_stage, spent_email in checks:
+            if key not in limits:
+                continue
+            limit_usd, limit_tokens = limits[key]
+            spent_usd, spent_tokens = self.spent(spent_stage, spent_email)
+            reserved_usd, reserved_tokens = self.reserved(spent_stage, spent_email)
+            spent_usd += reserved_usd
+            spent_tokens += reserved_tokens
+            label = " ".join(part for part in key if part and part != ANY_CONTACT) or key[0]
+            if limit_usd is not None and spent_usd + usd > limit_usd:
+                return f"{label} budget ${limit_usd:.2f}: spent ${spent_usd:.4f} + projected ${usd:.4f}"
+            if limit_tokens is not None and spent_tokens + tokens > limit_tokens:
+                return f"{label} budget {limit_tokens} tokens: spent {spent_tokens} + projected {tokens}"
+        return None
+
+    def plan_admission(self, stage, email, calls, limits) -> Admission:
+        substitutions = {}
+        while True:
+            plan = [(substitutions.get(model, model), prompt_tokens, max_tokens)
+                    for model, prompt_tokens, max_tokens in calls]
+            usd, tokens = self.estimate(stage, plan)
+            reason = self.over_limit(stage, email, usd, tokens, limits) if limits else None
+            if reason is None:
+                return Admission(True, substitutions, usd, tokens, None)
+            # Downgrade the planned model that costs the most and still has a cheaper alternative
+            costs = {}
+            for (model, _, _), (current, prompt_tokens, max_tokens) in zip(calls, plan):
+                if current in DOWNGRADES:
+                    costs[model] = costs.get(model, 0.0) + self.estimate(stage, [(current, prompt_tokens, max_tokens)])[0]
+            if not costs:
+                return Admission(False, substitutions, usd, tokens, reason)
+            model = max(costs, key=costs.get)
+            substitutions[model] = DOWNGRADES[substitutions.get(model, model)]
+
+    def admit(self, stage, email, calls) -> Admission:
+        """
+        Decide whether a contact's planned calls fit the budget, and reserve
+        their projected spend if they do (releasing the calling thread's
+        previous reservation). substitutions maps planned models to the
+        cheaper models to use instead.
+        """
+        def work(conn):
+            self.release(conn)
+            limits = self.limits()
+            admission = self.plan_admission(stage, email, calls, limits)
+            if admission.admitted and limits:
+                self.reserve(stage, email, admission.usd, admission.tokens, conn)
+            return admission
+
+        return self.transaction(work)
+
+    def admit_or_raise(self, stage, email, calls) -> dict:
+        admission = self.admit(stage, email, calls)
+        if not admission.admitted:
+            raise BudgetExceeded(f"{email}: {admission.reason}")
+        for planned, used in admission.substitutions.items():
+            print(f"Budget: using {used} instead of {planned} for {email}")
+        return admission.substitutions
+
+    ########################################
+    # Reservations
+    ########################################
+    def reserve(self, stage, email, usd, tokens, conn):
+        cursor = conn.execute("INSERT INTO reservations (stage, email, usd, tokens, at) VALUES (?, ?, ?, ?, ?)",
+                              (stage, email or "", usd, int(tokens), time.time()))
+        self.local.reservation = cursor.lastrowid
+        with self.reservation_lock:
+            self.reservation_ids.add(cursor.lastrowid)
+
+    def release(self, conn):
+        """
+        Drop the calling thread's reservation and any that have expired.
+        """
+        reservation = getattr(self.local, "reservation", None)
+        if reservation is not None:
+            conn.execute("DELETE FROM reservations WHERE id = ?", (reservation,))
+            self.local.reservation = None
+            with self.reservation_lock:
+                self.reservation_ids.discard(reservation)
+        conn.execute("DELETE FROM reservations WHERE at <= ?", (time.time() - RESERVATION_TTL,))
+
+    def release_all(self):
+        with self.reservation_lock:
+            ids, self.reservation_ids = list(self.reservation_ids), set()
+        if not ids:
+            return
+        try:
+            with self.lock:
+                self.conn.executemany("DELETE FROM reservations WHERE id = ?", [(i,) for i in ids])
+        except sqlite3.Error as e:
+            print(f"Could not release budget reservations: {e}")
+
+    def record(self, stage, email, model, prompt_tokens, completion_tokens, searches=0,
+               estimated_prompt_tokens=None) -> float:
+        """
+        Record one call's actual usage, drawing down the contact's
+        reservation by as much; returns its cost in dollars.
+        """
+        usd = call_cost(model, prompt_tokens, completion_tokens, searches)
+        prompt_tokens, completion_tokens = int(prompt_tokens or 0), int(completion_tokens or 0)
+
+        def work(conn):
+            conn.execute(
+                "INSERT INTO usage (stage, email, model, estimated_prompt_tokens, prompt_tokens, completion_tokens, "
+                "searches, usd, at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (stage, email or "", model, estimated_prompt_tokens, prompt_tokens, completion_tokens,
+                 int(searches or 0), usd, time.time()))
+            conn.execute(
+                "UPDATE reservations SET usd = MAX(usd - ?, 0), tokens = MAX(tokens - ?, 0) WHERE id = "
+                "(SELECT id FROM reservations WHERE stage = ? AND email = ? ORDER BY id LIMIT 1)",
+                (usd, prompt_tokens + completion_tokens, stage, email or ""))
+            conn.executemany(
+                "INSERT INTO totals (scope, name, usd, tokens) VALUES (?, ?, ?, ?) ON CONFLICT (scope, name) "
+                "DO UPDATE SET usd = usd + excluded.usd, tokens = tokens + excluded.tokens",
+                [(scope, name, usd, prompt_tokens + completion_tokens)
+                 for scope, name in ((RUN, ""), (STAGE, stage), (CONTACT, email or ""))])
+
+        self.transaction(work)
+        return usd
+
+    def status(self) -> list:
+        """
+        Per stage and model: calls, prompt/completion tokens, dollars, and the
+        tokenizer's prompt estimate relative to the reported prompt tokens.
+        """
+        return self.query(
+            "SELECT stage, model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(usd), "
+            "SUM(estimated_prompt_tokens) * 1.0 / NULLIF(SUM(prompt_tokens), 0) "
+            "FROM usage GROUP BY stage, model ORDER BY stage, model")
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_budget() -> Budget:
+    """
+    The process-wide ledger.
+    """
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = Budget()
+        return _budget
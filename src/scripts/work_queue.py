@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from scheduler import finish_times
+
+########################################
+# Lease-based work queue (SQLite)
+#
+# Tasks are (stage, Email) pairs with a JSON payload. Any number of worker
+# processes lease the next pending task for a limited time (the visibility
+# timeout) and renew the lease with heartbeats while they work on it. A
+# worker that dies stops heartbeating; once its lease expires the task goes
+# back to pending for another worker, until it has used max_attempts. Failed
+# attempts are retried after an exponential backoff. Results are stored in
+# the database and written to the stage's normal output files by
+# "emailpipe.py queue collect".
+#
+# SQLite in WAL mode is the broker: workers on one machine (or on a shared
+# filesystem with working locks) need nothing else running.
+#
+# Each enqueue call is a list: its tasks get ranks that are weighted fair
+# queuing finish times (scheduler.py), starting from the lowest rank still
+# pending, and workers lease the lowest rank first. One list at a time is
+# worked through in enqueue order; lists queued together share the workers
+# by their weights.
+########################################
+script_dir = os.path.dirname(__file__)
+DEFAULT_DB = os.getenv("EMAILPIPE_QUEUE_DB", os.path.join(script_dir, "../../output/work_queue.db"))
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage         TEXT NOT NULL,
+    email         TEXT NOT NULL,
+    payload       TEXT NOT NULL,
+    status        TEXT NOT NULL DEFAULT 'pending',
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    max_attempts  INTEGER NOT NULL,
+    available_at  REAL NOT NULL,
+    lease_owner   TEXT,
+    lease_expires REAL,
+    result        TEXT,
+    error         TEXT,
+    updated_at    REAL NOT NULL,
+    rank          REAL NOT NULL DEFAULT 0,
+    UNIQUE (stage, email)
+);
+CREATE INDEX IF NOT EXISTS tasks_pending ON tasks (status, available_at, id);
+"""
+# Queues created before tasks had a rank
+MIGRATIONS = [
+    ("rank", "ALTER TABLE tasks ADD COLUMN rank REAL NOT NULL DEFAULT 0"),
+]
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(self, db_path=None):
+        self.db_path = db_path or DEFAULT_DB
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(tasks)")}
+            for column, sql in MIGRATIONS:
+                if column not in columns:
+                    conn.execute(sql)
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_rank ON tasks (status, rank, id)")
+
+    def connect(self):
+        # A connection per operation keeps heartbeat threads and workers independent.
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    ########################################
+    # Producer side
+    ########################################
+    def enqueue(self, stage, items, max_attempts=DEFAULT_MAX_ATTEMPTS, weight=1.0):
+        """
+        Add (email, payload) tasks for a stage, to be worked through in the
+        given order and sharing the workers with other pending lists by
+        weight. Emails already queued for the stage (in any status) are left
+        alone. Returns the number added.
+        """
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # The list starts at the current virtual time: the lowest rank still pending
+            start = conn.execute("SELECT MIN(rank) FROM tasks WHERE stage = ? AND status = 'pending'",
+                                 (stage,)).fetchone()[0] or 0.0
+            ranks = finish_times(len(items), weight, start)
+            rows = [(stage, email, json.dumps(payload, default=str), max_attempts, now, now, rank)
+                    for (email, payload), rank in zip(items, ranks)]
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (stage, email, payload, max_attempts, available_at, updated_at, rank) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            added = conn.total_changes - before
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return added
+
+    def retry_failed(self, stage):
+        """
+        Give failed tasks of a stage a fresh set of attempts.
+        """
+        conn = self.connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0, available_at = ?, error = NULL, updated_at = ? "
+                "WHERE stage = ? AND status = 'failed'", (time.time(), time.time(), stage))
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    ########################################
+    # Worker side
+    ########################################
+    def _expire_leases(self, conn, now):
+        conn.execute(
+            "UPDATE tasks SET status = 'failed', error = 'lease expired after final attempt', "
+            "lease_owner = NULL, updated_at = ? "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= max_attempts", (now, now))
+        conn.execute(
+            "UPDATE tasks SET status = 'pending', lease_owner = NULL, updated_at = ? "
+            "WHERE status = 'leased' AND lease_expires < ?", (now, now))
+
+    def lease(self, worker_id, stages=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Lease the available task with the lowest rank (optionally only of the given stages).
+        Returns a dict with id, stage, email, payload and attempts, or None.
+        """
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._expire_leases(conn, now)
+            query = "SELECT * FROM tasks WHERE status = 'pending' AND available_at <= ?"
+            params = [now]
+            if stages:
+                query += f" AND stage IN ({','.join('?' * len(stages))})"
+                params.extend(stages)
+            row = conn.execute(query + " ORDER BY rank, id LIMIT 1", params).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'leased', attempts = attempts + 1, lease_owner = ?, "
+                "lease_expires = ?, updated_at = ? WHERE id = ?",
+                (worker_id, now + lease_seconds, now, row["id"]))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return {"id": row["id"], "stage": row["stage"], "email": row["email"],
+                "payload": json.loads(row["payload"]), "attempts": row["attempts"] + 1}
+
+    def heartbeat(self, task_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Extend a lease. False if the worker no longer holds it (it expired and
+        the task was handed to someone else).
+        """
+        return self._update_leased(
+            "UPDATE tasks SET lease_expires = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+            (time.time() + lease_seconds, time.time(), task_id, worker_id))
+
+    def complete(self, task_id, worker_id, result):
+        return self._update_leased(
+            "UPDATE tasks SET status = 'done', result = ?, error = NULL, lease_owner = NULL, updated_at = ? "
+            "WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+            (json.dumps(result, default=str), time.time(), task_id, worker_id))
+
+    def fail(self, task_id, worker_id, error):
+        """
+        Record a failed attempt: back to pending after a backoff, or 'failed'
+        once max_attempts is used up.
+        """
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT attempts, max_attempts FROM tasks WHERE id = ? AND status = 'leased' "
+                               "AND lease_owner = ?", (task_id, worker_id)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return False
+            now = time.time()
+            if row["attempts"] >= row["max_attempts"]:
+                conn.execute("UPDATE tasks SET status = 'failed', error = ?, lease_owner = NULL, updated_at = ? "
+                             "WHERE id = ?", (error, now, task_id))
+            else:
+                delay = min(RETRY_BASE_DELAY * 2 ** (row["attempts"] - 1), RETRY_MAX_DELAY)
+                conn.execute("UPDATE tasks SET status = 'pending', error = ?, lease_owner = NULL, "
+                             "available_at = ?, updated_at = ? WHERE id = ?", (error, now + delay, now, task_id))
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+    def release(self, task_id, worker_id):
+        """
+        Hand a leased task back as pending without counting the attempt.
+        """
+        return self._update_leased(
+            "UPDATE tasks SET status = 'pending', attempts = attempts - 1, lease_owner = NULL, updated_at = ? "
+            "WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+            (time.time(), task_id, worker_id))
+
+    def _update_leased(self, sql, params):
+        conn = self.connect()
+        try:
+            return conn.execute(sql, params).rowcount == 1
+        finally:
+            conn.close()
+
+    ########################################
+    # Status and results
+    ########################################
+    def counts(self, stage=None):
+        """
+        {status: number of tasks}, counting expired leases as pending.
+        """
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._expire_leases(conn, time.time())
+            query = "SELECT status, COUNT(*) AS n FROM tasks"
+            params = []
+            if stage:
+                query += " WHERE stage = ?"
+                params.append(stage)
+            rows = conn.execute(query + " GROUP BY status", params).fetchall()
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return {row["status"]: row["n"] for row in rows}
+
+    def results(self, stage):
+        """
+        (email, result) for every finished task of the stage, in enqueue order.
+        """
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT email, result FROM tasks WHERE stage = ? AND status = 'done' ORDER BY id",
+                                (stage,)).fetchall()
+        finally:
+            conn.close()
+        return [(row["email"], json.loads(row["result"])) for row in rows]
+
+    def failures(self, stage):
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT email, attempts, error FROM tasks WHERE stage = ? AND status = 'failed' "
+                                "ORDER BY id", (stage,)).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+
+########################################
+# Worker loop
+########################################
+class Heartbeat(threading.Thread):
+    """
+    Renews a task's lease every `interval` seconds until stopped.
+    """
+    def __init__(self, queue, task_id, worker_id, lease_seconds, interval):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.task_id = task_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.task_id, self.worker_id, self.lease_seconds):
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:
+                # A busy database delays this renewal; the next one may still make it.
+                print(f"Heartbeat for task {self.task_id} failed: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_worker(queue, handlers, worker_id=None, stages=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+               poll_interval=5.0, max_tasks=None, stop_on=()):
+    """
+    Lease and run tasks until none are pending or leased for the given stages
+    (or max_tasks have been run). handlers maps a stage to a function taking
+    the task payload and returning the result to store. A handler raising one
+    of the stop_on exception types hands its task back and stops the worker.
+    Returns the number of tasks completed.
+    """
+    worker_id = worker_id or default_worker_id()
+    stages = stages or sorted(handlers)
+    completed = 0
+    while max_tasks is None or completed < max_tasks:
+        task = queue.lease(worker_id, stages, lease_seconds)
+        if task is None:
+            remaining = sum(queue.counts(stage).get(status, 0)
+                            for stage in stages for status in ("pending", "leased"))
+            if not remaining:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        print(f"[{worker_id}] {task['stage']} {task['email']} (attempt {task['attempts']})")
+        heartbeat = Heartbeat(queue, task["id"], worker_id, lease_seconds, max(lease_seconds / 3, 1))
+        heartbeat.start()
+        try:
+            result = handlers[task["stage"]](task["payload"])
+        except stop_on as e:
+            heartbeat.stop()
+            queue.release(task["id"], worker_id)
+            print(f"[{worker_id}] Stopping: {e}")
+            break
+        except Exception as e:
+            heartbeat.stop()
+            print(f"[{worker_id}] {task['stage']} {task['email']} failed: {e}")
+            queue.fail(task["id"], worker_id, f"{type(e).__name__}: {e}")
+            continue
+        heartbeat.stop()
+        if queue.complete(task["id"], worker_id, result):
+            completed += 1
+        else:
+            print(f"[{worker_id}] Lease on {task['email']} expired before it finished; result discarded")
+    print(f"[{worker_id}] Done: {completed} task(s) completed")
+    return completed
@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src/scripts"))
+
+import engagements
+
+
+class IsEmptyTests(unittest.TestCase):
+    def test_no_information_phrases_are_empty(self):
+        for body in ["No information available", "No peer-reviewed publications were found.", "None found.",
+                     "N/A", "No information available. No conferences found.", ""]:
+            self.assertTrue(engagements.is_empty(body), body)
+
+    def test_cited_content_with_trailing_phrase_is_not_empty(self):
+        self.assertFalse(engagements.is_empty(
+            'Published "Scaling ML" in IEEE Software [4]. No other publications found.'))
+
+    def test_uncited_content_with_trailing_phrase_is_not_empty(self):
+        self.assertFalse(engagements.is_empty("Spoke at HIMSS 2024 about AI adoption. No other details found."))
+
+    def test_short_cited_section_is_kept(self):
+        text = ("**Podcast Engagements**:\nGuest on Pharma Pod [1]. No other podcasts found.\n\n"
+                "**Webinar Engagements**:\nNo information available.")
+        sections = json.loads(engagements.sections_field(text, ["https://example.com/pod"]))
+        self.assertEqual([s["section"] for s in sections], ["podcast_engagements"])
+        self.assertEqual(sections[0]["citations"], {"1": "https://example.com/pod"})
+
+
+if __name__ == "__main__":
+    unittest.main()
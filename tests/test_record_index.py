@@ -0,0 +1,48 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../frontend"))
+
+from record_store import JournaledRecordStore
+from record_index import RecordIndex
+
+
+class RecordIndexReloadTests(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.json_file = os.path.join(self.data_dir, "records.json")
+        self.write([
+            {"Email": "ada@example.com", "Company": "Acme", "email_output_final": "Hello Ada", "flag": True},
+            {"Email": "bob@example.com", "Company": "Acme", "email_output_final": "Hello Bob"},
+        ])
+        self.store = JournaledRecordStore(self.json_file)
+        self.index = RecordIndex(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def write(self, records):
+        with open(self.json_file, "w", encoding="utf-8") as f:
+            json.dump(records, f)
+
+    def test_reload_replaces_the_index(self):
+        self.assertEqual(self.index.search("hello"), [0, 1])
+        self.write([{"Email": "cy@example.com", "Company": "Initech", "email_output_final": "Dear Cy"}])
+        self.assertEqual(self.index.search("hello"), [])
+        self.assertEqual(self.index.search("dear"), [0])
+        self.assertEqual(self.index.search(flags={"flag": True}), [])
+
+    def test_reload_to_an_empty_list_clears_the_index(self):
+        self.assertEqual(self.index.search("hello"), [0, 1])
+        self.write([])
+        self.assertEqual(self.index.search("hello"), [])
+        self.assertEqual(self.index.search(sorted_filters={"company": "acme"}), [])
+        self.assertEqual(self.index.size, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
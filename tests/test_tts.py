@@ -0,0 +1,165 @@
+import os
+import sys
+import shutil
+import tempfile
+import time
+import threading
+import unittest
+
+FRONTEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../frontend")
+sys.path.insert(0, FRONTEND_DIR)
+os.environ["TTS_WORKER"] = "fake"
+
+from tts_worker import TTSWorkerClient, TTSWorkerError, NoAudioError, default_worker_command, wav_header
+from tts_cache import AudioCache, PrefetchWorker
+
+HEADER_SIZE = len(wav_header(0))
+
+
+class CountingSynthesizer:
+    """
+    The fake worker client, counting the syntheses it is asked for.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def stream(self, text, voice, rate):
+        with self.lock:
+            self.calls += 1
+        return self.client.stream(text, voice, rate)
+
+
+class TTSTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = TTSWorkerClient(default_worker_command(FRONTEND_DIR), cwd=FRONTEND_DIR, job_timeout=30)
+        self.synthesizer = CountingSynthesizer(self.client)
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = AudioCache(self.cache_dir, 50 * 1024 * 1024, self.synthesizer)
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def cached_files(self):
+        return sorted(os.listdir(self.cache_dir))
+
+
+class WorkerClientTests(TTSTestCase):
+    def test_streams_pcm_chunks(self):
+        chunks = list(self.client.stream("Hello there", "voice", "2"))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(chunks))
+
+    def test_failure_raises(self):
+        with self.assertRaises(TTSWorkerError):
+            list(self.client.stream("__fail__", "voice", "2"))
+
+    def test_empty_text_streams_nothing(self):
+        self.assertEqual(list(self.client.stream("", "voice", "2")), [])
+
+
+class AudioCacheTests(TTSTestCase):
+    def test_stream_writes_the_cache(self):
+        key = self.cache.register("Hello there")
+        audio = b"".join(self.cache.stream(key))
+        self.assertEqual(self.cached_files(), [key + ".wav"])
+        with open(self.cache.path_for(key), "rb") as f:
+            cached = f.read()
+        # Same PCM as streamed; only the header's sizes differ
+        self.assertEqual(cached[HEADER_SIZE:], audio[HEADER_SIZE:])
+        self.assertEqual(cached[:HEADER_SIZE], wav_header(len(cached) - HEADER_SIZE))
+
+    def test_cache_hit_does_not_synthesize(self):
+        key = self.cache.synthesize("Hello there")
+        first = b"".join(self.cache.stream(key))
+        second = b"".join(self.cache.stream(key))
+        self.assertEqual(self.synthesizer.calls, 1)
+        self.assertEqual(first, second)
+
+    def test_failure_caches_nothing(self):
+        key = self.cache.register("__fail__")
+        with self.assertRaises(TTSWorkerError):
+            list(self.cache.stream(key))
+        self.assertEqual(self.cached_files(), [])
+
+    def test_empty_synthesis_caches_nothing(self):
+        key = self.cache.register("")
+        with self.assertRaises(NoAudioError):
+            list(self.cache.stream(key))
+        self.assertEqual(self.cached_files(), [])
+
+    def test_concurrent_requests_share_one_synthesis(self):
+        key = self.cache.register("Two tabs open the same email")
+        results = []
+
+        def request():
+            results.append(b"".join(self.cache.stream(key)))
+
+        threads = [threading.Thread(target=request) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.synthesizer.calls, 1)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0][HEADER_SIZE:], results[1][HEADER_SIZE:])
+        self.assertEqual(self.cache._key_locks, {})
+
+    def test_prefetch_does_not_delay_requests(self):
+        background = TTSWorkerClient(default_worker_command(FRONTEND_DIR), cwd=FRONTEND_DIR, job_timeout=30)
+        self.addCleanup(background.close)
+        cache = AudioCache(self.cache_dir, 50 * 1024 * 1024, self.synthesizer, background_synthesizer=background)
+        cache.synthesize("Warm up")
+        prefetcher = PrefetchWorker(cache)
+        long_text = "An upcoming email long enough for ten seconds of audio. " * 10
+        prefetcher.enqueue(long_text)
+        time.sleep(0.2)
+        list(cache.stream(cache.register("The email being played")))
+        self.assertIn(cache.cache_key(long_text), prefetcher.pending)
+        prefetcher.jobs.join()
+        self.assertEqual(self.synthesizer.calls, 2)
+
+
+class SpeechRouteTests(TTSTestCase):
+    def setUp(self):
+        super().setUp()
+        try:
+            import main
+        except ImportError as e:
+            self.skipTest(f"frontend dependencies not installed: {e}")
+        self.main = main
+        self.original_cache = main.audio_cache
+        main.audio_cache = self.cache
+        self.app = main.app.test_client()
+
+    def tearDown(self):
+        self.main.audio_cache = self.original_cache
+        super().tearDown()
+
+    def test_streams_wav(self):
+        key = self.cache.register("Hello there")
+        response = self.app.get(f"/speech/{key}.wav")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "audio/wav")
+        self.assertTrue(response.data.startswith(b"RIFF"))
+        self.assertGreater(len(response.data), HEADER_SIZE)
+
+    def test_failure_is_500(self):
+        key = self.cache.register("__fail__")
+        self.assertEqual(self.app.get(f"/speech/{key}.wav").status_code, 500)
+
+    def test_empty_synthesis_is_502_and_not_cached(self):
+        key = self.cache.register("")
+        self.assertEqual(self.app.get(f"/speech/{key}.wav").status_code, 502)
+        self.assertEqual(self.cached_files(), [])
+        self.assertEqual(self.app.get(f"/speech/{key}.wav").status_code, 502)
+
+    def test_unknown_key_is_404(self):
+        self.assertEqual(self.app.get("/speech/0123.wav").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()